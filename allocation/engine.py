@@ -49,7 +49,15 @@ def get_allocation_window(allocation,
 
 
 # Main ###
-def calculate_allocation(allocation, print_logs=False):
+def calculate_allocation(allocation, print_logs=False, engine='python'):
+    """
+    engine - 'python' applies the rules history by history, in every
+             time period.
+             'numpy' computes every time period at once
+             (See allocation.numpy_engine). The results are identical.
+    """
+    if engine not in ('python', 'numpy'):
+        raise ValueError("Unknown allocation engine: %s" % engine)
     (window_start_date, window_end_date) = get_allocation_window(allocation)
 
     # FYI: Calculates time periods based on allocation.credits
@@ -73,8 +81,13 @@ def calculate_allocation(allocation, print_logs=False):
             instance_rules.append(rule)
         else:
             raise Exception("Unknown Type of Rule: %s" % rule)
+    history_arrays = None
+    if engine == 'numpy':
+        from allocation.numpy_engine import InstanceHistoryArrays
+        history_arrays = InstanceHistoryArrays(
+            allocation.instances, instance_rules, current_result.time_periods)
     time_forward = timedelta(0)
-    for current_period in current_result.time_periods:
+    for period_index, current_period in enumerate(current_result.time_periods):
         if current_result.carry_forward and time_forward:
             current_period.increase_credit(time_forward, carry_forward=True)
 
@@ -85,24 +98,12 @@ def calculate_allocation(allocation, print_logs=False):
                              % current_period.total_credit)
         # Second loop - Go through all the instances and apply
         #              the specific rules (This loop relates to time USED)
-        instance_results = []
-
-        for instance in allocation.instances:
-            # "Chatty" Warning - Uncomment at your own risk
-            # logger.debug("> > Calculating Instance history:%s"
-            #             % instance.identifier)
-            if not instance:
-                continue
-            history_list = _calculate_instance_history_list(
-                instance, instance_rules,
-                current_period.start_counting_date,
-                current_period.stop_counting_date,
+        if history_arrays:
+            instance_results = history_arrays.instance_results(period_index)
+        else:
+            instance_results = _calculate_instance_results(
+                allocation.instances, instance_rules, current_period,
                 print_logs=print_logs)
-            if not history_list:
-                continue
-            instance_result = InstanceResult(
-                identifier=instance.identifier, history_list=history_list)
-            instance_results.append(instance_result)
 
         if print_logs:
             logger.debug("> > Instance history Results:")
@@ -123,6 +124,28 @@ def calculate_allocation(allocation, print_logs=False):
     return current_result
 
 
+def _calculate_instance_results(instances, instance_rules, current_period,
+                                print_logs=False):
+    instance_results = []
+    for instance in instances:
+        # "Chatty" Warning - Uncomment at your own risk
+        # logger.debug("> > Calculating Instance history:%s"
+        #             % instance.identifier)
+        if not instance:
+            continue
+        history_list = _calculate_instance_history_list(
+            instance, instance_rules,
+            current_period.start_counting_date,
+            current_period.stop_counting_date,
+            print_logs=print_logs)
+        if not history_list:
+            continue
+        instance_result = InstanceResult(
+            identifier=instance.identifier, history_list=history_list)
+        instance_results.append(instance_result)
+    return instance_results
+
+
 def _multiply_time_delta(timedelta1, timedelta2):
     time_seconds = timedelta1.total_seconds() *\
         timedelta2.total_seconds()
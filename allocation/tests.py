@@ -14,6 +14,9 @@ Questions:
     # in some way??
 """
 
+import os
+import time
+
 from dateutil.relativedelta import relativedelta
 import pytz
 
@@ -27,7 +30,7 @@ from allocation.models import Provider, Machine, Size, Instance,\
     InstanceHistory
 from allocation.models import Allocation, MultiplySizeCPU, MultiplySizeRAM,\
     MultiplySizeDisk, MultiplyBurnTime, AllocationIncrease, TimeUnit,\
-    IgnoreStatusRule, CarryForwardTime, Rule
+    IgnoreStatusRule, IgnoreProviderRule, CarryForwardTime, Rule, InstanceRule
 from allocation.models import \
     FixedStartSlidingWindow, FixedEndSlidingWindow, FixedWindow,\
     PythonAllocationStrategy, RecurringRefresh, OneTimeRefresh
@@ -522,6 +525,139 @@ class TestAllocationEngine(AllocationTestCase):
         self.assertTotalRuntimeEquals(allocation, timedelta(days=45))
 
 
+def _summarize_result(allocation_result):
+    """
+    Returns every value of an AllocationResult that the engines compute
+    """
+    return [
+        (period.start_counting_date, period.stop_counting_date,
+         period.total_credit, period.get_burn_rate(),
+         [(instance_result.identifier,
+           [(history.status_name, history.clock_time, history.total_time,
+             history.burn_rate)
+            for history in instance_result.history_list])
+          for instance_result in period.instance_results])
+        for period in allocation_result.time_periods]
+
+
+class DoubleActiveTime(InstanceRule):
+
+    """
+    An InstanceRule the numpy engine can not compile
+    """
+
+    def apply_rule(self, instance, history, running_time, print_logs=False):
+        if history.status == "active":
+            running_time *= 2
+        return running_time
+
+
+class TestNumpyEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.start_window = datetime(2014, 7, 1, tzinfo=pytz.utc)
+        self.stop_window = datetime(2014, 12, 1, tzinfo=pytz.utc)
+        self.allocation_helper = AllocationHelper(
+            self.start_window, self.stop_window, self.start_window,
+            interval_delta=relativedelta(months=1))
+        self.allocation_helper.add_rule(multiply_by_disk)
+        sizes = ["test.tiny", "test.small", "test.medium", "test.large"]
+        current_time = datetime(2014, 6, 20, hour=12, tzinfo=pytz.utc)
+        for idx in range(0, 12):
+            helper = InstanceHelper(
+                provider="openstack" if idx % 3 else "workshop")
+            start_time = current_time
+            end_time = start_time + timedelta(days=11, microseconds=idx)
+            helper.add_history_entry(start_time, end_time,
+                                     size=sizes[idx % len(sizes)])
+            helper.add_history_entry(end_time, end_time + timedelta(days=5),
+                                     status="suspended")
+            # The last history of every other instance is still running
+            helper.add_history_entry(
+                end_time + timedelta(days=5),
+                None if idx % 2 else end_time + timedelta(days=40),
+                status="build" if idx == 5 else "active",
+                size=sizes[-1 - idx % len(sizes)])
+            self.allocation_helper.add_instance(
+                helper.to_instance("Instance %s" % idx))
+            current_time += timedelta(days=13, hours=7)
+
+    def assertEnginesMatch(self, allocation):
+        python_result = engine.calculate_allocation(allocation)
+        numpy_result = engine.calculate_allocation(allocation, engine='numpy')
+        self.assertEqual(_summarize_result(python_result),
+                         _summarize_result(numpy_result))
+        self.assertEqual(python_result.total_runtime(),
+                         numpy_result.total_runtime())
+        self.assertEqual(python_result.total_difference(),
+                         numpy_result.total_difference())
+        return numpy_result
+
+    def test_engines_match_by_interval(self):
+        result = self.assertEnginesMatch(
+            self.allocation_helper.to_allocation())
+        self.assertEqual(len(result.time_periods), 5)
+
+    def test_engines_match_without_interval(self):
+        self.allocation_helper.set_interval(None)
+        self.assertEnginesMatch(self.allocation_helper.to_allocation())
+
+    def test_engines_match_with_uncompiled_rule(self):
+        self.allocation_helper.add_rule(DoubleActiveTime("Double active"))
+        self.assertEnginesMatch(self.allocation_helper.to_allocation())
+
+    def test_engines_match_with_ignored_provider(self):
+        self.allocation_helper.add_rule(IgnoreProviderRule(
+            "Ignore workshop", openstack_workshop.identifier))
+        self.assertEnginesMatch(self.allocation_helper.to_allocation())
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            engine.calculate_allocation(
+                self.allocation_helper.to_allocation(), engine='fortran')
+
+
+@unittest.skipUnless(os.environ.get('ATMO_BENCHMARK'),
+                     'Set ATMO_BENCHMARK=1 to run allocation benchmarks')
+class BenchmarkAllocationEngines(unittest.TestCase):
+
+    """
+    10,000 instances (5 histories each) over 12 monthly time periods
+    """
+
+    def setUp(self):
+        start_window = datetime(2015, 1, 1, tzinfo=pytz.utc)
+        stop_window = datetime(2016, 1, 1, tzinfo=pytz.utc)
+        self.allocation_helper = AllocationHelper(
+            start_window, stop_window, start_window,
+            credit_hours=24 * 365 * 10000,
+            interval_delta=relativedelta(months=1))
+        for idx in xrange(10000):
+            helper = InstanceHelper()
+            start_time = start_window + timedelta(hours=idx)
+            for history_idx in xrange(5):
+                end_time = start_time + timedelta(days=17)
+                helper.add_history_entry(
+                    start_time, end_time if history_idx < 4 else None,
+                    size="test.small",
+                    status="suspended" if history_idx % 2 else "active")
+                start_time = end_time
+            self.allocation_helper.add_instance(
+                helper.to_instance("Instance %s" % idx))
+
+    def test_benchmark_engines(self):
+        allocation = self.allocation_helper.to_allocation()
+        results = {}
+        for engine_name in ('python', 'numpy'):
+            start = time.time()
+            results[engine_name] = engine.calculate_allocation(
+                allocation, engine=engine_name)
+            print "%s engine: %.2fs" % (engine_name, time.time() - start)
+        self.assertEqual(len(results['numpy'].time_periods), 12)
+        self.assertEqual(_summarize_result(results['python']),
+                         _summarize_result(results['numpy']))
+
+
 # From the REPL
 def repl_profile_test_1():
     """
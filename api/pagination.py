@@ -1,7 +1,16 @@
 """
 custom pagination support
 """
+import base64
+import json
+import operator
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 # NOTE: this value is set here for v1 api support
 DEFAULT_PAGINATION_SIZE = 20
@@ -28,6 +37,133 @@ class StandardResultsSetPagination(PageNumberPagination):
     page_size = 100
     page_size_query_param = 'page_size'
 
+class KeysetPagination(StandardResultsSetPagination):
+    """
+    Page numbers by default, keyset pagination once the client passes
+    `cursor` (empty for the first page): pages are selected by the
+    position of the last item on `ordering` (the view's `keyset_ordering`)
+    instead of a COUNT(*) and an OFFSET scan.
+
+    Passing `page_size=all` asks for the full set, which
+    `StreamingListMixin` streams `stream_chunk_size` items at a time.
+    """
+    cursor_query_param = 'cursor'
+    full_set_page_size = 'all'
+    ordering = ('-start_date', '-id')
+    stream_chunk_size = 500
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_ordering(self, view):
+        return getattr(view, 'keyset_ordering', self.ordering)
+
+    def is_keyset(self, queryset, request):
+        # DISTINCT ON querysets are ordered by their distinct fields
+        return self.cursor_query_param in request.query_params\
+            and not queryset.query.distinct_fields
+
+    def can_iterate(self, queryset):
+        # `iterate` re-orders the queryset, DISTINCT ON must keep its ordering
+        return not queryset.query.distinct_fields
+
+    def is_full_set(self, request):
+        return request.query_params.get(
+            self.page_size_query_param) == self.full_set_page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.is_keyset(queryset, request)
+        if not self.keyset:
+            return super(KeysetPagination, self).paginate_queryset(
+                queryset, request, view=view)
+        self.request = request
+        self.ordering = self.get_ordering(view)
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+        page = list(self.keyset_page(queryset, position, page_size + 1))
+        self.next_position = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_position = self.get_position(page[-1])
+        return page
+
+    def iterate(self, queryset, view=None):
+        """
+        Yield every item of `queryset`, querying one chunk at a time
+        (with the queryset's select/prefetch_related) to keep memory flat.
+        """
+        self.ordering = self.get_ordering(view)
+        position = None
+        while True:
+            chunk = list(self.keyset_page(
+                queryset, position, self.stream_chunk_size))
+            for item in chunk:
+                yield item
+            if len(chunk) < self.stream_chunk_size:
+                return
+            position = self.get_position(chunk[-1])
+
+    def keyset_page(self, queryset, position, size):
+        queryset = queryset.order_by(*self.ordering)
+        if position:
+            queryset = queryset.filter(self.after(position))
+        return queryset[:size]
+
+    def after(self, position):
+        """
+        Items after `position`, e.g. for ('-start_date', '-id'):
+        start_date < x OR (start_date = x AND id < y)
+        """
+        queries = []
+        for index, field in enumerate(self.ordering):
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            query = Q(**{field.lstrip('-') + lookup: position[index]})
+            for equal_field, value in zip(self.ordering[:index], position):
+                query &= Q(**{equal_field.lstrip('-'): value})
+            queries.append(query)
+        return reduce(operator.or_, queries)
+
+    def get_position(self, item):
+        position = []
+        for field in self.ordering:
+            value = item
+            for attr in field.lstrip('-').split('__'):
+                value = getattr(value, attr)
+            position.append(
+                value.isoformat() if hasattr(value, 'isoformat') else value)
+        return position
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def encode_cursor(self, position):
+        return base64.urlsafe_b64encode(json.dumps(position))
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_next_link()
+        if not self.next_position:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param,
+            self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+
 class OptionalPagination(PageNumberPagination):
 
     """
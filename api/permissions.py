@@ -309,14 +309,13 @@ class InMaintenance(permissions.BasePermission):
     """
 
     def has_permission(self, request, view):
-        records = MaintenanceRecord.active()\
-                                   .filter(provider__isnull=True)
+        records = MaintenanceRecord.active_global()
         if records:
             session_username = request.session.get('username','')
             request_username = request.user.username
             #TODO: Optional logic related to session_username -- the one who is 'Authenticated'..
-            atmo_user = AtmosphereUser.objects.filter(username=request_username).first()
-            if atmo_user and request_username in settings.MAINTENANCE_EXEMPT_USERNAMES:
+            if request_username in settings.MAINTENANCE_EXEMPT_USERNAMES \
+                    and AtmosphereUser.objects.filter(username=request_username).exists():
                 return True
             else:
                 raise ServiceUnavailable(
@@ -41,6 +41,21 @@ class PandasExcelRenderer(CSVRenderer):
         return response
 
 
+class StreamingJSONRenderer(renderers.JSONRenderer):
+    """
+    Renders an iterable of serialized items as a JSON array, one item at a
+    time, for use as the content of a StreamingHttpResponse
+    """
+
+    def stream(self, items, renderer_context=None):
+        yield b'['
+        for index, item in enumerate(items):
+            if index:
+                yield b','
+            yield self.render(item, renderer_context=renderer_context)
+        yield b']'
+
+
 class PNGRenderer(renderers.BaseRenderer):
     media_type = "image/png"
     format = "png"
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+API application tasks
+"""
+import os
+
+from celery.decorators import task
+from django.http import QueryDict
+
+from threepio import celery_logger
+
+from api.v2.report_export import report_queryset, report_rows, write_report
+from core.models import AtmosphereUser
+
+
+@task(name="export_instance_report")
+def export_instance_report(user_id, query_string, export_format, path, frequency='MS'):
+    """
+    Write the instance report of `user_id` (filtered by `query_string`)
+    to `path`, for download from the reporting API.
+    A failed export leaves `path`.failed, so the download reports the failure.
+    """
+    try:
+        user = AtmosphereUser.objects.get(id=user_id)
+        queryset = report_queryset(user, QueryDict(query_string))
+        write_report(report_rows(queryset), export_format, path, frequency)
+    except Exception:
+        celery_logger.exception("Could not export the instance report to %s", path)
+        if os.path.exists(path + '.partial'):
+            os.rename(path + '.partial', path + '.failed')
+        else:
+            open(path + '.failed', 'wb').close()
+        raise
+    celery_logger.info("Exported the instance report of %s to %s", user_id, path)
+    return path
@@ -0,0 +1,167 @@
+"""
+Query-count and latency benchmarks for every v2 list and detail route.
+
+Seeds `ATMO_BENCHMARK_SCALE` users and instances (with two histories each),
+plus images, volumes and allocation sources in proportion, then requests
+each route registered in `api.v2.urls.router` as a superuser and records
+the queries, serialized bytes and wall time of the response.
+
+Routes fail when they do not answer with a 2xx status, exceed their
+budget in `benchmark_budgets.json`, or have no budget there. Run with:
+
+    ATMO_BENCHMARK=1 ./manage.py test api.tests.v2.test_benchmarks
+
+and add ATMO_BENCHMARK_RECORD=1 to write the measured values as the new
+budgets.
+"""
+import json
+import os
+import time
+import uuid
+from unittest import skipUnless
+
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.timezone import timedelta
+
+from rest_framework.test import APITestCase, APIClient
+
+from api.tests.factories import (
+    UserFactory, IdentityFactory, ProviderFactory, ProviderMachineFactory,
+    InstanceStatusFactory, SizeFactory, UserAllocationSourceFactory)
+from api.v2.urls import router
+from core.models import (
+    AtmosphereUser, AllocationSource, Instance, InstanceStatusHistory,
+    InstanceSource, Volume)
+
+BENCHMARK_SCALE = int(os.environ.get('ATMO_BENCHMARK_SCALE', 2000))
+BUDGETS_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_budgets.json')
+# Recorded budgets leave room for slower machines
+RECORDED_SECONDS_FACTOR = 3
+# ... and for a few queries more (i.e. session and permission lookups)
+RECORDED_QUERIES_HEADROOM = 2
+
+
+@skipUnless(os.environ.get('ATMO_BENCHMARK'), 'Set ATMO_BENCHMARK=1 to run API benchmarks')
+class APIRouteBenchmark(APITestCase):
+    scale = BENCHMARK_SCALE
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserFactory.create(username='benchmark', is_superuser=True, is_staff=True)
+        cls.provider = ProviderFactory.create()
+        cls.identity = IdentityFactory.create_identity(created_by=cls.user, provider=cls.provider)
+        cls.size = SizeFactory.create(provider=cls.provider)
+        active = InstanceStatusFactory.create(name='active')
+        suspended = InstanceStatusFactory.create(name='suspended')
+
+        AtmosphereUser.objects.bulk_create([
+            AtmosphereUser(username='benchmark-%d' % index)
+            for index in xrange(cls.scale)])
+        machines = [
+            ProviderMachineFactory.create_provider_machine(cls.user, cls.identity)
+            for _ in xrange(max(cls.scale // 20, 1))]
+
+        now = timezone.now()
+        Instance.objects.bulk_create([
+            Instance(name='benchmark-%d' % index, provider_alias=str(uuid.uuid4()),
+                     source=machines[index % len(machines)].instance_source,
+                     created_by=cls.user, created_by_identity=cls.identity,
+                     start_date=now - timedelta(days=2))
+            for index in xrange(cls.scale)])
+        histories = []
+        for instance in Instance.objects.filter(created_by=cls.user):
+            histories.append(InstanceStatusHistory(
+                instance=instance, size=cls.size, status=active,
+                start_date=instance.start_date, end_date=now - timedelta(days=1)))
+            histories.append(InstanceStatusHistory(
+                instance=instance, size=cls.size, status=suspended,
+                start_date=now - timedelta(days=1)))
+        InstanceStatusHistory.objects.bulk_create(histories)
+
+        InstanceSource.objects.bulk_create([
+            InstanceSource(identifier='benchmark-volume-%d' % index, provider=cls.provider,
+                           created_by=cls.user, created_by_identity=cls.identity)
+            for index in xrange(max(cls.scale // 4, 1))])
+        Volume.objects.bulk_create([
+            Volume(name=source.identifier, size=1, instance_source=source)
+            for source in InstanceSource.objects.filter(identifier__startswith='benchmark-volume-')])
+
+        AllocationSource.objects.bulk_create([
+            AllocationSource(name='TG-BENCHMARK%d' % index, compute_allowed=1000)
+            for index in xrange(max(cls.scale // 20, 1))])
+        for allocation_source in AllocationSource.objects.all()[:10]:
+            UserAllocationSourceFactory.create(user=cls.user, allocation_source=allocation_source)
+
+    def _load_budgets(self):
+        with open(BUDGETS_PATH) as budgets_file:
+            return json.load(budgets_file)
+
+    def _save_budgets(self, budgets):
+        with open(BUDGETS_PATH, 'w') as budgets_file:
+            json.dump(budgets, budgets_file, indent=2, sort_keys=True)
+            budgets_file.write('\n')
+
+    def _measure(self, client, url):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.time()
+            response = client.get(url)
+            elapsed = time.time() - started
+        return response, {
+            'status': response.status_code,
+            'queries': len(queries.captured_queries),
+            'bytes': len(response.content),
+            'seconds': elapsed,
+        }
+
+    def _routes(self):
+        """
+        Yield (route name, url) for every list route, followed by the
+        detail route of the first listed object.
+        """
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        for _, _, base_name in router.registry:
+            route = '%s-list' % base_name
+            try:
+                url = reverse('api:v2:%s' % route)
+            except NoReverseMatch:
+                continue
+            response, measurement = self._measure(client, url)
+            yield route, measurement
+            data = getattr(response, 'data', None)
+            results = data.get('results') if isinstance(data, dict) else None
+            if results and isinstance(results[0], dict) and results[0].get('url'):
+                yield '%s-detail' % base_name, self._measure(client, results[0]['url'])[1]
+
+    def test_routes_are_within_budget(self):
+        budgets = self._load_budgets()
+        recording = bool(os.environ.get('ATMO_BENCHMARK_RECORD'))
+        failures = []
+        print "\n%-45s %6s %8s %10s %8s" % ('route', 'status', 'queries', 'bytes', 'seconds')
+        for route, measurement in self._routes():
+            print "%-45s %6s %8s %10s %8.3f" % (
+                route, measurement['status'], measurement['queries'],
+                measurement['bytes'], measurement['seconds'])
+            if not 200 <= measurement['status'] < 300:
+                failures.append("%s: status %s" % (route, measurement['status']))
+                continue
+            if recording:
+                budgets['routes'][route] = {
+                    'queries': measurement['queries'] + RECORDED_QUERIES_HEADROOM,
+                    'seconds': round(max(measurement['seconds'] * RECORDED_SECONDS_FACTOR,
+                                         budgets['min_seconds']), 3)}
+                continue
+            budget = budgets['routes'].get(route)
+            if not budget:
+                failures.append("%s: no budget, record one with ATMO_BENCHMARK_RECORD=1" % route)
+                continue
+            for key in ('queries', 'seconds'):
+                if measurement[key] > budget[key]:
+                    failures.append("%s: %s %s > %s" % (route, measurement[key], key, budget[key]))
+        if recording:
+            self._save_budgets(budgets)
+        self.assertFalse(failures, "Routes failing or over budget at scale %s:\n%s" % (
+            self.scale, "\n".join(failures)))
@@ -14,7 +14,8 @@ from api.tests.factories import (
 )
 from .base import APISanityTestCase
 
-from core.metrics.application import get_application_metrics
+from core.metrics.application import refresh_application_metrics
+from core.models import ApplicationMetric, InstanceStatusHistory
 
 
 class ImageMetricsTest(APITestCase, APISanityTestCase):
@@ -157,7 +158,7 @@ class ImageMetricsTest(APITestCase, APISanityTestCase):
                 instance=self.active_instance,
                 start_date=start_date + delta_time*3,
             )
-        get_application_metrics(self.application)
+        refresh_application_metrics()
 
     def test_user_sees_no_statistics(self):
         """Non-staff users should see an empty set of data."""
@@ -189,6 +190,23 @@ class ImageMetricsTest(APITestCase, APISanityTestCase):
 
         self.assertEquals(metrics, expected_metrics)
 
+    def test_refresh_replaces_the_newest_buckets(self):
+        """Older buckets are kept, the newest are counted again."""
+        old_bucket = ApplicationMetric.objects.create(
+            application=self.application, interval='MONTHLY',
+            bucket=timezone.now() - timezone.timedelta(days=62), total=10, active=5)
+        InstanceStatusHistory.objects.filter(
+            instance=self.networking_instance, status=self.status_networking
+        ).update(status=self.status_active)
+        refresh_application_metrics()
+
+        self.assertEqual(ApplicationMetric.objects.get(id=old_bucket.id).total, 10)
+        newest = ApplicationMetric.objects.filter(
+            application=self.application, interval='DAILY').latest('bucket')
+        self.assertEqual((newest.active, newest.total), (2, 4))
+        location = self.provider.location
+        self.assertEqual(newest.versions.values()[0][location], {'active': 2, 'total': 4})
+
     @skip("Skipping until we know how we want to measure statistics like these.")
     def test_complex_instance_affect_on_metrics(self):
         """
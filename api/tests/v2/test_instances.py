@@ -1,7 +1,10 @@
+import json
 import uuid
 from unittest import skip, skipIf
 
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from rest_framework.test import APIClient
@@ -10,10 +13,10 @@ from rest_framework.test import APITestCase, APIRequestFactory, force_authentica
 from api.tests.factories import (
     GroupFactory, UserFactory, AnonymousUserFactory, InstanceFactory, InstanceHistoryFactory, InstanceStatusFactory, SizeFactory,
     ImageFactory, ApplicationVersionFactory, InstanceSourceFactory, ProviderMachineFactory, IdentityFactory, ProviderFactory,
-    IdentityMembershipFactory, QuotaFactory)
+    IdentityMembershipFactory, QuotaFactory, AllocationSourceFactory)
 from .base import APISanityTestCase
 from api.v2.views import InstanceViewSet
-from core.models import AtmosphereUser
+from core.models import AtmosphereUser, InstanceAllocationSourceSnapshot
 
 
 class InstanceTests(APITestCase, APISanityTestCase):
@@ -64,6 +67,7 @@ class InstanceTests(APITestCase, APISanityTestCase):
             start_date=timezone.now())
 
         active = InstanceStatusFactory.create(name='active')
+        self.active = active
         networking = InstanceStatusFactory.create(name='networking')
         deploying = InstanceStatusFactory.create(name='deploying')
         deploy_error = InstanceStatusFactory.create(name='deploy_error')
@@ -137,3 +141,76 @@ class InstanceTests(APITestCase, APISanityTestCase):
         self.assertEquals(data['status'], 'active')
         self.assertEquals(data['activity'], '')
 
+
+    def test_list_query_count_does_not_grow_with_instances(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        url = reverse(self.url_route + "-list")
+        allocation_source = AllocationSourceFactory.create(name='TG-TRA110001', compute_allowed=1000)
+        InstanceAllocationSourceSnapshot.objects.create(
+            instance=self.active_instance, allocation_source=allocation_source)
+
+        client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        self.assertEquals(len(response.data['results']), 4)
+
+        for index in range(5):
+            instance = InstanceFactory.create(
+                name="Instance %s" % index,
+                provider_alias=uuid.uuid4(),
+                source=self.machine.instance_source,
+                created_by=self.user,
+                created_by_identity=self.user_identity,
+                start_date=timezone.now())
+            InstanceHistoryFactory.create(status=self.active, activity="", instance=instance)
+            InstanceAllocationSourceSnapshot.objects.create(
+                instance=instance, allocation_source=allocation_source)
+        with self.assertNumQueries(len(queries.captured_queries)):
+            response = client.get(url)
+        self.assertEquals(len(response.data['results']), 9)
+        self.assertEquals(
+            set(instance['allocation_source']['name'] for instance in response.data['results']
+                if instance['allocation_source']),
+            set(['TG-TRA110001']))
+
+    def test_cursor_pagination(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        url = reverse(self.url_route + "-list")
+        response = client.get(url, {'cursor': '', 'page_size': 3})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotIn('count', response.data)
+        first_page = [instance['id'] for instance in response.data['results']]
+        self.assertEquals(len(first_page), 3)
+
+        response = client.get(response.data['next'])
+        second_page = [instance['id'] for instance in response.data['results']]
+        self.assertEquals(len(second_page), 1)
+        self.assertIsNone(response.data['next'])
+        self.assertEquals(len(set(first_page + second_page)), 4)
+
+        response = client.get(url, {'cursor': 'not-a-cursor'})
+        self.assertEquals(response.status_code, 404)
+
+    def test_full_set_is_streamed(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        url = reverse(self.url_route + "-list")
+        response = client.get(url, {'page_size': 'all'})
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        instances = json.loads(b''.join(response.streaming_content))
+        self.assertEquals(
+            set(instance['name'] for instance in instances),
+            set(["Instance in active", "Instance in networking",
+                 "Instance in deploying", "Instance in deploy_error"]))
+
+    def test_unique_histories_are_not_streamed(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        url = reverse('api:v2:instancestatushistory-list')
+        response = client.get(url, {'unique': 'true', 'page_size': 'all'})
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse(response.streaming)
+        self.assertTrue(response.data['results'])
@@ -1,10 +1,19 @@
 import json
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import datetime
 from unittest import skip, skipUnless
 
+import mock
 from django.core.urlresolvers import reverse
+from django.test import SimpleTestCase, override_settings
 from rest_framework.test import APITestCase, APIRequestFactory, force_authenticate
 
+from api import tasks
 from api.tests.factories import UserFactory, AnonymousUserFactory, InstanceFactory
+from api.v2.report_export import ReportSummaries, period_of, stream_csv
 from api.v2.views import ReportingViewSet
 from core.models import AtmosphereUser
 
@@ -127,6 +136,26 @@ class ReportingTests(APITestCase):
             self.assertEquals(response.status_code, 400)
             self.assertEqual(response.data['errors'][0]['message'], 'Invalid filter parameters')
 
+    def test_failed_export_is_reported(self):
+        export_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_root)
+        job = str(uuid.uuid4())
+        path = os.path.join(export_root, str(self.user.id), '%s.csv' % job)
+        os.makedirs(os.path.dirname(path))
+        open(path + '.partial', 'wb').close()
+        with mock.patch.object(tasks, 'report_queryset'), \
+                mock.patch.object(tasks, 'write_report', side_effect=IOError('Disk full')):
+            with self.assertRaises(IOError):
+                tasks.export_instance_report(self.user.id, '', 'csv', path)
+
+        factory = APIRequestFactory()
+        request = factory.get(reverse('api:v2:reporting-download'), {'job': job})
+        force_authenticate(request, user=self.user)
+        with override_settings(REPORT_EXPORT_ROOT=export_root):
+            response = ReportingViewSet.as_view({'get': 'download'})(request)
+        self.assertEquals(response.status_code, 500)
+        self.assertEquals(response.data['status'], 'failed')
+
     @skip('skip for now')
     def test_access_invalid_provider(self):
         raise NotImplementedError
@@ -134,3 +163,39 @@ class ReportingTests(APITestCase):
     @skip('skip for now')
     def test_access_not_allowed_provider(self):
         raise NotImplementedError
+
+
+class ReportExportTests(SimpleTestCase):
+    def _row(self, username, image_name, hit_active=True, is_featured_image=True):
+        return {'username': username, 'image_name': image_name, 'is_featured_image': is_featured_image,
+                'hit_active': hit_active, 'hit_deploy_error': False, 'hit_aborted': not hit_active,
+                'hit_active_or_aborted': 1, 'hit_active_or_aborted_or_error': 1}
+
+    def test_periods(self):
+        date = datetime(2017, 2, 15, 10, 30)
+        self.assertEqual(period_of(date, 'AS'), datetime(2017, 1, 1))
+        self.assertEqual(period_of(date, 'QS'), datetime(2017, 1, 1))
+        self.assertEqual(period_of(date, 'MS'), datetime(2017, 2, 1))
+        # Weeks are labelled by the Sunday ending them
+        self.assertEqual(period_of(date, 'W'), datetime(2017, 2, 19))
+        self.assertEqual(period_of(date, 'H'), datetime(2017, 2, 15, 10))
+
+    def test_summaries_are_aggregated_while_streaming(self):
+        summaries = ReportSummaries('MS')
+        summaries.add(self._row('alice', 'Ubuntu'), datetime(2017, 1, 10))
+        summaries.add(self._row('alice', 'Ubuntu', hit_active=False), datetime(2017, 1, 20))
+        summaries.add(self._row('bob', 'CentOS'), datetime(2017, 3, 5))
+        summaries.add(self._row('bob', 'CentOS', is_featured_image=False), datetime(2017, 3, 6))
+
+        self.assertEqual(list(summaries.global_rows()), [
+            (datetime(2017, 1, 1), [1.0, 2, 1.0, 2]),
+            (datetime(2017, 2, 1), [None, 0, None, 0]),
+            (datetime(2017, 3, 1), [1.0, 1, 1.0, 1])])
+        user_rows = dict(summaries.user_summary.rows())
+        self.assertEqual(user_rows[(datetime(2017, 1, 1), 'alice')][:6], [0.5, 1, 0.0, 0, 0.5, 1])
+        self.assertEqual(sorted(dict(summaries.image_summary.rows())),
+                         [(datetime(2017, 1, 1), 'Ubuntu'), (datetime(2017, 3, 1), 'CentOS')])
+
+    def test_csv_is_streamed_line_by_line(self):
+        lines = list(stream_csv(iter([{'id': 1, 'username': u'alice'}]), headers=['id', 'username']))
+        self.assertEqual(lines, ['id,username\r\n', '1,alice\r\n'])
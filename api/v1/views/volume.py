@@ -24,6 +24,7 @@ from core.models.volume import convert_esh_volume
 from core.models.volume import Volume as CoreVolume
 from core.models.instance_source import InstanceSource
 from core.models.group import IdentityMembership
+from core.models.quota import QuotaUsageLedger
 
 from service.driver import prepare_driver
 from service.volume import create_esh_volume,\
@@ -524,7 +525,9 @@ class Volume(AuthAPIView):
         core_volume = convert_esh_volume(esh_volume, provider_uuid,
                                          identity_uuid, user)
         # Delete the object, update the DB
-        esh_driver.destroy_volume(esh_volume)
+        if esh_driver.destroy_volume(esh_volume):
+            QuotaUsageLedger.adjust(core_volume.instance_source.created_by_identity,
+                                    storage=-esh_volume.size, storage_count=-1)
         core_volume.end_date = now()
         core_volume.save()
         # Return the object
@@ -0,0 +1,359 @@
+"""
+Streaming export of the instance report (See ReportingViewSet)
+
+Rows are read through a server-side cursor and written as soon as they are
+serialized. The summary sheets are aggregated along the way, so neither the
+raw table nor a DataFrame is ever held in memory.
+"""
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pytz
+import unicodecsv as csv
+import xlsxwriter
+from dateutil.parser import parse
+from dateutil.relativedelta import relativedelta
+from django.db.models import Exists, OuterRef, Q, Subquery
+
+from api.v2.serializers.details import InstanceReportingSerializer
+from core.models import Instance, InstanceStatusHistory
+
+REPORT_HEADERS = [
+    "id", "instance_id", "username", "staff_user", "provider", "start_date", "end_date",
+    "image_name", "version_name", "size.active", "size.start_date", "size.end_date",
+    "size.name", "size.id", "size.uuid", "size.url", "size.alias", "size.cpu", "size.mem",
+    "size.disk", "is_featured_image", "hit_active", "hit_deploy_error", "hit_error",
+    "hit_aborted", "hit_active_or_aborted", "hit_active_or_aborted_or_error"]
+# Columns left out of the 'Raw Data' sheet
+RAW_DATA_EXCLUDED = ['size.id', 'size.uuid', 'size.alias', 'size.active',
+                     'size.start_date', 'size.end_date', 'size.url']
+RAW_DATA_HEADERS = [header for header in REPORT_HEADERS
+                    if header not in RAW_DATA_EXCLUDED]
+# Averaged/summed columns of each summary sheet: (column, title)
+GLOBAL_SUMMARY_COLUMNS = [
+    ('hit_active_or_aborted', 'Active/Aborted'),
+    ('hit_active_or_aborted_or_error', 'Active/Aborted/Error')]
+IMAGE_SUMMARY_COLUMNS = GLOBAL_SUMMARY_COLUMNS
+USER_SUMMARY_COLUMNS = [
+    ('hit_active', 'Active'),
+    ('hit_deploy_error', 'Deploy Error'),
+    ('hit_aborted', 'Aborted')] + GLOBAL_SUMMARY_COLUMNS
+DATE_FORMAT = "%x %X"
+FREQUENCIES = {
+    'as': 'AS', 'yearly': 'AS',
+    'qs': 'QS', 'quarterly': 'QS',
+    'ms': 'MS', 'monthly': 'MS',
+    'w': 'W', 'weekly': 'W',
+    'd': 'D', 'daily': 'D',
+    'h': 'H', 'hourly': 'H',
+}
+PERIOD_STEPS = {
+    'AS': relativedelta(years=1),
+    'QS': relativedelta(months=3),
+    'MS': relativedelta(months=1),
+    'W': relativedelta(weeks=1),
+    'D': relativedelta(days=1),
+    'H': relativedelta(hours=1),
+}
+SUMMARY_DATE_FORMATS = {
+    'AS': 'yyyy',
+    'QS': 'mmmm yyyy',
+    'MS': 'mmmm yyyy',
+    'W': 'mmm d yyyy',
+    'D': 'mmm d yyyy',
+    'H': 'mmm d yyyy hh:mm:ss',
+}
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.ms-excel',
+}
+
+
+def get_frequency(value):
+    """
+    Returns the summary frequency for `value`, monthly by default
+    """
+    return FREQUENCIES.get((value or '').lower(), 'MS')
+
+
+def get_filter_query(query_params):
+    query = Q()
+
+    if 'provider_id' in query_params:
+        provider_id_list = query_params.getlist('provider_id')
+        provider_ids = [int(pid) for pid in provider_id_list]
+        query &= Q(created_by_identity__provider__id__in=provider_ids)
+    # NOTE: All times assumed UTC.. Trust me on this one.
+    if 'start_date' in query_params:
+        start_date = parse(query_params['start_date']).replace(tzinfo=pytz.utc)
+        query &= Q(start_date__gt=start_date)
+
+    if 'end_date' in query_params:
+        end_date = parse(query_params['end_date']).replace(tzinfo=pytz.utc)
+        query &= Q(start_date__lt=end_date)
+    if 'name' in query_params:
+        query &= Q(source__providermachine__application_version__application__name__icontains=query_params['name'])
+    if 'username' in query_params:
+        query &= Q(created_by__username=query_params['username'])
+    if 'source_alias' in query_params:
+        query &= Q(source__identifier=query_params['source_alias'])
+    if 'status' in query_params:
+        query &= Q(instancestatushistory__status__name=query_params['status'])
+
+    return query
+
+
+def _has_status(status_name):
+    return Exists(InstanceStatusHistory.objects.filter(
+        instance=OuterRef('pk'), status__name=status_name))
+
+
+def report_queryset(user, query_params):
+    """
+    Instances reported to `user`, annotated with everything
+    InstanceReportingSerializer would otherwise query for each row.
+    """
+    if user.is_staff or user.is_superuser:
+        instances_qs = Instance.objects.all()
+    else:
+        instances_qs = Instance.shared_with_user(user)
+    last_size = InstanceStatusHistory.objects.filter(
+        instance=OuterRef('pk')).order_by('-start_date').values('size')[:1]
+    return instances_qs.select_related(
+        'created_by',
+        'created_by_identity__provider',
+        'source__providermachine__application_version__application',
+    ).annotate(
+        has_active=_has_status('active'),
+        has_deploy_error=_has_status('deploy_error'),
+        has_error=_has_status('error'),
+        last_size_id=Subquery(last_size),
+    ).filter(get_filter_query(query_params))
+
+
+def flatten(data, prefix=''):
+    """
+    Flatten nested serializer output into 'parent.child' keys
+    """
+    row = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            row.update(flatten(value, prefix='%s%s.' % (prefix, key)))
+        else:
+            row[prefix + key] = value
+    return row
+
+
+def report_rows(queryset, context=None):
+    """
+    Yield the flattened report row of each instance, read through a
+    server-side cursor.
+    """
+    if context is None:
+        # Hyperlinks are relative without a request
+        context = {'request': None}
+    for instance in queryset.iterator():
+        yield flatten(InstanceReportingSerializer(instance, context=context).data)
+
+
+class _Echo(object):
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows, headers=REPORT_HEADERS):
+    """
+    Yield the CSV report one line at a time
+    """
+    writer = csv.writer(_Echo(), encoding='utf-8')
+    yield writer.writerow(headers)
+    for row in rows:
+        yield writer.writerow([row.get(header) for header in headers])
+
+
+def period_of(date, frequency):
+    """
+    Returns the label of the `frequency` period containing `date`
+    (the start of the period, or the Sunday ending a week, like pandas)
+    """
+    if frequency == 'AS':
+        return datetime(date.year, 1, 1)
+    elif frequency == 'QS':
+        return datetime(date.year, date.month - (date.month - 1) % 3, 1)
+    elif frequency == 'MS':
+        return datetime(date.year, date.month, 1)
+    elif frequency == 'W':
+        return datetime(date.year, date.month, date.day) + timedelta(days=6 - date.weekday())
+    elif frequency == 'D':
+        return datetime(date.year, date.month, date.day)
+    return date.replace(minute=0, second=0, microsecond=0)
+
+
+class SummaryAggregator(object):
+    """
+    Running count and sums of `columns` for each group of rows
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        self.counts = defaultdict(int)
+        self.sums = defaultdict(lambda: [0] * len(columns))
+
+    def add(self, key, row):
+        self.counts[key] += 1
+        sums = self.sums[key]
+        for index, (column, _) in enumerate(self.columns):
+            sums[index] += int(bool(row.get(column)))
+
+    def headers(self):
+        headers = []
+        for _, title in self.columns:
+            headers += ['Average of %s' % title, 'Sum of %s' % title]
+        return headers
+
+    def values(self, key):
+        count = self.counts.get(key, 0)
+        values = []
+        for total in self.sums[key] if count else [0] * len(self.columns):
+            values += [float(total) / count if count else None, total]
+        return values
+
+    def rows(self):
+        for key in sorted(self.counts):
+            yield key, self.values(key)
+
+
+class ReportSummaries(object):
+    """
+    The global, image and user summaries of the featured images, by period
+    """
+    def __init__(self, frequency):
+        self.frequency = frequency
+        self.global_summary = SummaryAggregator(GLOBAL_SUMMARY_COLUMNS)
+        self.image_summary = SummaryAggregator(IMAGE_SUMMARY_COLUMNS)
+        self.user_summary = SummaryAggregator(USER_SUMMARY_COLUMNS)
+
+    def add(self, row, start_date):
+        if not row.get('is_featured_image'):
+            return
+        period = period_of(start_date, self.frequency)
+        self.global_summary.add(period, row)
+        self.image_summary.add((period, row.get('image_name')), row)
+        self.user_summary.add((period, row.get('username')), row)
+
+    def global_rows(self):
+        """
+        Every period from the first to the last, including empty ones
+        """
+        periods = sorted(self.global_summary.counts)
+        if not periods:
+            return
+        period, last = periods[0], periods[-1]
+        while period <= last:
+            yield period, self.global_summary.values(period)
+            period = period_of(period + PERIOD_STEPS[self.frequency], self.frequency)
+
+
+def _parse_date(value):
+    return datetime.strptime(value, DATE_FORMAT) if value else None
+
+
+def write_xlsx(rows, path, frequency='MS'):
+    """
+    Write the report workbook to `path`, keeping only the summaries in
+    memory (rows are flushed to disk as they are written).
+    """
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    header_format = workbook.add_format({'bold': True, 'border': 1})
+    summary_date_format = workbook.add_format(
+        {'num_format': SUMMARY_DATE_FORMATS[frequency], 'align': 'left'})
+    date_format = workbook.add_format({'num_format': 'mmm d yyyy hh:mm:ss'})
+    pct_format = workbook.add_format({'num_format': '0.00%'})
+    name_format = workbook.add_format()
+    name_format.set_align('left')
+
+    # Summaries come first in the workbook but are written last
+    global_summary_ws = workbook.add_worksheet('Monthly Summary')
+    image_summary_ws = workbook.add_worksheet('Image Summary')
+    user_summary_ws = workbook.add_worksheet('User Summary')
+    raw_ws = workbook.add_worksheet('Raw Data')
+
+    summaries = ReportSummaries(frequency)
+    raw_ws.write_row(0, 1, RAW_DATA_HEADERS, header_format)
+    row_total = 0
+    for row in rows:
+        row_total += 1
+        start_date = _parse_date(row['start_date'])
+        summaries.add(row, start_date)
+        raw_ws.write_number(row_total, 0, row_total - 1)
+        for column, header in enumerate(RAW_DATA_HEADERS, 1):
+            value = row.get(header)
+            if header in ('start_date', 'end_date'):
+                if value:
+                    raw_ws.write_datetime(row_total, column, _parse_date(value), date_format)
+            elif value is not None:
+                raw_ws.write(row_total, column, value)
+    raw_ws.autofilter(0, 0, row_total, len(RAW_DATA_HEADERS))
+
+    global_summary_ws.write_row(
+        0, 0, ['Start Date'] + summaries.global_summary.headers(), header_format)
+    for index, (period, values) in enumerate(summaries.global_rows(), 1):
+        global_summary_ws.write_datetime(index, 0, period, summary_date_format)
+        global_summary_ws.write_row(index, 1, values)
+    for worksheet, summary, name in (
+            (image_summary_ws, summaries.image_summary, 'Image Name'),
+            (user_summary_ws, summaries.user_summary, 'Username')):
+        worksheet.write_row(0, 0, ['Start Date', name] + summary.headers(), header_format)
+        for index, ((period, group), values) in enumerate(summary.rows(), 1):
+            worksheet.write_datetime(index, 0, period, summary_date_format)
+            worksheet.write(index, 1, group)
+            worksheet.write_row(index, 2, values)
+
+    # Format column widths on the worksheets
+    raw_ws.set_column('C:C', 32)
+    raw_ws.set_column('D:D', 13)
+    raw_ws.set_column('F:F', 23)
+    raw_ws.set_column('G:G', 17)
+    raw_ws.set_column('H:H', 17)
+    raw_ws.set_column('I:I', 34)
+    raw_ws.set_column('J:J', 17)
+    raw_ws.set_column('K:K', 14)
+    raw_ws.set_column('L:L', 14)
+    raw_ws.set_column('M:M', 14)
+    raw_ws.set_column('N:N', 14)
+    raw_ws.set_column('O:O', 14)
+
+    global_summary_ws.set_column('A:A', 34)
+    global_summary_ws.set_column('B:B', 21, pct_format)
+    global_summary_ws.set_column('D:D', 26, pct_format)
+
+    image_summary_ws.set_column('A:A', 34)
+    image_summary_ws.set_column('B:B', 36, name_format)
+    image_summary_ws.set_column('C:C', 21, pct_format)
+    image_summary_ws.set_column('E:E', 26, pct_format)
+
+    user_summary_ws.set_column('A:A', 34)
+    user_summary_ws.set_column('B:B', 13, name_format)
+    user_summary_ws.set_column('C:C', 17, pct_format)
+    user_summary_ws.set_column('E:E', 17, pct_format)
+    user_summary_ws.set_column('G:G', 21, pct_format)
+    user_summary_ws.set_column('I:I', 21, pct_format)
+    user_summary_ws.set_column('K:K', 26, pct_format)
+    workbook.close()
+    return path
+
+
+def write_report(rows, export_format, path, frequency='MS'):
+    """
+    Write the `export_format` report to `path`.
+    The file is moved into place once complete.
+    """
+    partial_path = path + '.partial'
+    if export_format == 'xlsx':
+        write_xlsx(rows, partial_path, frequency)
+    else:
+        with open(partial_path, 'wb') as report_file:
+            for line in stream_csv(rows):
+                report_file.write(line)
+    os.rename(partial_path, path)
+    return path
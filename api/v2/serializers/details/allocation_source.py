@@ -22,9 +22,9 @@ class AllocationSourceSerializer(serializers.HyperlinkedModelSerializer):
     )
 
     def _get_allocation_source_snapshot(self, allocation_source, attr_name):
-        snapshot = AllocationSourceSnapshot.objects.filter(
-            allocation_source=allocation_source).first()
-        if not snapshot:
+        try:
+            snapshot = allocation_source.snapshot
+        except AllocationSourceSnapshot.DoesNotExist:
             return None
         attr = getattr(snapshot, attr_name)
         return attr
@@ -34,10 +34,20 @@ class AllocationSourceSerializer(serializers.HyperlinkedModelSerializer):
             raise ValueError("Expected 'request' context for this serializer")
         return self.context['request'].user
 
+    def _get_user_allocation_snapshots(self):
+        """
+        The request user's snapshots by allocation source, queried once and
+        shared by every serializer rendered with this context.
+        """
+        if 'user_allocation_snapshots' not in self.context:
+            user = self._get_request_user()
+            self.context['user_allocation_snapshots'] = dict(
+                (snapshot.allocation_source_id, snapshot)
+                for snapshot in UserAllocationSnapshot.objects.filter(user=user))
+        return self.context['user_allocation_snapshots']
+
     def _get_user_allocation_snapshot(self, allocation_source, attr_name):
-        user = self._get_request_user()
-        snapshot = UserAllocationSnapshot.objects.filter(
-            allocation_source=allocation_source, user=user).first()
+        snapshot = self._get_user_allocation_snapshots().get(allocation_source.id)
         if not snapshot:
             return None
         attr = getattr(snapshot, attr_name)
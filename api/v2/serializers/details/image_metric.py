@@ -45,7 +45,7 @@ class ImageMetricSerializer(serializers.HyperlinkedModelSerializer):
                 interval = rrule.WEEKLY
             elif 'day' in interval_str or 'daily' in interval_str:
                 interval = rrule.DAILY
-        return _get_application_metrics(application, interval=interval, day_limit=limit, read_only=True)
+        return _get_application_metrics(application, interval=interval, day_limit=limit)
 
     class Meta:
         model = Image
@@ -1,5 +1,5 @@
 from core.models import (
-    Project, BootScript, Instance, Application as Image,
+    Project, BootScript, Instance, AllocationSourceSnapshot,
     InstanceAllocationSourceSnapshot
 )
 from rest_framework import serializers
@@ -48,20 +48,28 @@ class InstanceSerializer(serializers.HyperlinkedModelSerializer):
         uuid_field='provider_alias'
     )
 
+    def _get_allocation_source(self, instance):
+        # Joined by `InstanceViewSet.get_queryset`, so no query per instance
+        try:
+            return instance.instanceallocationsourcesnapshot.allocation_source
+        except InstanceAllocationSourceSnapshot.DoesNotExist:
+            return None
+
     def get_allocation_source(self, instance):
-        snapshot = InstanceAllocationSourceSnapshot.objects.filter(
-            instance=instance).first()
-        if not snapshot:
+        allocation_source = self._get_allocation_source(instance)
+        if not allocation_source:
             return None
-        serializer = AllocationSourceSerializer(snapshot.allocation_source, context=self.context)
+        serializer = AllocationSourceSerializer(allocation_source, context=self.context)
         return serializer.data
 
-
     def get_usage(self, instance):
-        if not instance.allocation_source\
-                or not instance.allocation_source.snapshot:
+        allocation_source = self._get_allocation_source(instance)
+        if not allocation_source:
+            return -1
+        try:
+            return allocation_source.snapshot.compute_used
+        except AllocationSourceSnapshot.DoesNotExist:
             return -1
-        return instance.allocation_source.snapshot.compute_used
 
     def get_size(self, obj):
         size = obj.get_size()
@@ -71,8 +79,7 @@ class InstanceSerializer(serializers.HyperlinkedModelSerializer):
     def get_image(self, obj):
         if not obj.source.is_machine():
             return {}
-        image_uuid = obj.application_uuid()
-        image = Image.objects.get(uuid=image_uuid)
+        image = obj.source.providermachine.application_version.application
         serializer = ImageSuperSummarySerializer(image, context=self.context)
         return serializer.data
 
@@ -4,7 +4,7 @@ from api.v2.serializers.summaries import (
     SizeSummarySerializer,
 )
 from core.models import (
-    Instance
+    Instance, Size
 )
 
 
@@ -27,14 +27,25 @@ class InstanceReportingSerializer(serializers.ModelSerializer):
     hit_active_or_aborted_or_error = serializers.SerializerMethodField()
 
     def get_size(self, obj):
-        size = obj.get_size()
+        # `last_size_id` is annotated by `api.v2.report_export.report_queryset`
+        size_id = getattr(obj, 'last_size_id', None)
+        if size_id:
+            sizes = self.context.setdefault('report_sizes', {})
+            if size_id not in sizes:
+                sizes[size_id] = Size.objects.get(id=size_id)
+            size = sizes[size_id]
+        else:
+            size = obj.get_size()
         serializer = SizeSummarySerializer(size, context=self.context)
         return serializer.data
 
     def get_is_featured_image(self, instance):
         try:
             application = self.get_application(instance)
-            return application.tags.filter(name__icontains='featured').count() > 0
+            featured = self.context.setdefault('report_featured_applications', {})
+            if application.id not in featured:
+                featured[application.id] = application.tags.filter(name__icontains='featured').count() > 0
+            return featured[application.id]
         except Exception:
             return False
 
@@ -91,18 +102,25 @@ class InstanceReportingSerializer(serializers.ModelSerializer):
             not self.get_hit_error(instance)
         )
 
+    def _has_status(self, instance, status_name):
+        # `has_<status>` is annotated by `api.v2.report_export.report_queryset`
+        annotation = 'has_%s' % status_name
+        if hasattr(instance, annotation):
+            return getattr(instance, annotation)
+        return instance.instancestatushistory_set.filter(status__name=status_name).count() > 0
+
     def get_hit_active(self, instance):
-        return instance.instancestatushistory_set.filter(status__name='active').count() > 0
+        return self._has_status(instance, 'active')
 
     def get_hit_deploy_error(self, instance):
         if self.get_hit_active(instance):
             return False
-        return instance.instancestatushistory_set.filter(status__name='deploy_error').count() > 0
+        return self._has_status(instance, 'deploy_error')
 
     def get_hit_error(self, instance):
         if self.get_hit_active(instance):
             return False
-        return instance.instancestatushistory_set.filter(status__name='error').count() > 0
+        return self._has_status(instance, 'error')
 
     class Meta:
         model = Instance
@@ -2,9 +2,10 @@ from rest_framework import filters
 import django_filters
 
 from api import permissions
+from api.pagination import KeysetPagination
 from api.v2.serializers.details import ImageSerializer
 from api.v2.views.base import AuthOptionalViewSet
-from api.v2.views.mixins import MultipleFieldLookup
+from api.v2.views.mixins import MultipleFieldLookup, StreamingListMixin
 
 from core.models import Application as Image
 
@@ -85,11 +86,12 @@ class FeaturedFilterBackend(filters.BaseFilterBackend):
         return queryset
 
 
-class ImageViewSet(MultipleFieldLookup, AuthOptionalViewSet):
+class ImageViewSet(StreamingListMixin, MultipleFieldLookup, AuthOptionalViewSet):
 
     """
     API endpoint that allows images to be viewed or edited.
     """
+    pagination_class = KeysetPagination
     lookup_fields = ("id", "uuid")
     http_method_names = ['get', 'put', 'patch', 'head', 'options', 'trace']
     permission_classes = (permissions.InMaintenance,
@@ -1,7 +1,8 @@
 from api.v2.serializers.details import InstanceSerializer, InstanceActionSerializer
 from api.v2.serializers.post import InstanceSerializer as POST_InstanceSerializer
 from api.v2.views.base import AuthModelViewSet
-from api.v2.views.mixins import MultipleFieldLookup
+from api.pagination import KeysetPagination
+from api.v2.views.mixins import MultipleFieldLookup, StreamingListMixin
 from api.v2.views.instance_action import InstanceActionViewSet
 
 from core.exceptions import ProviderNotActive
@@ -36,11 +37,12 @@ from socket import error as socket_error
 from rtwo.exceptions import ConnectionFailure
 
 
-class InstanceViewSet(MultipleFieldLookup, AuthModelViewSet):
+class InstanceViewSet(StreamingListMixin, MultipleFieldLookup, AuthModelViewSet):
 
     """
     API endpoint that allows providers to be viewed or edited.
     """
+    pagination_class = KeysetPagination
 
     queryset = Instance.objects.all()
     serializer_class = InstanceSerializer
@@ -65,10 +67,21 @@ class InstanceViewSet(MultipleFieldLookup, AuthModelViewSet):
         if 'archived' not in self.request.query_params:
             qs = qs.filter(only_current())
         # logger.info("DEBUG- User %s querying for instances, available IDs are:%s" % (user, qs.values_list('id',flat=True)))
-        qs = qs.select_related("created_by")\
-            .select_related('created_by_identity')\
-            .select_related('source')\
-            .select_related('project')
+        # Everything InstanceSerializer renders, so listing N instances
+        # costs a constant number of queries.
+        qs = qs.select_related(
+            'created_by',
+            'created_by_identity__provider',
+            'project__created_by',
+            'project__owner',
+            'source__providermachine__application_version__application',
+            'instanceallocationsourcesnapshot__allocation_source__snapshot',
+        ).prefetch_related(
+            'created_by_identity__credential_set',
+            'scripts__script_type',
+        )
+        if self.action in ('list', 'retrieve'):
+            qs = qs.prefetch_related(Instance.last_history_prefetch())
         return qs
 
     @detail_route(methods=['post'])
@@ -7,7 +7,8 @@ from core.models import InstanceStatusHistory
 
 from api.v2.serializers.details import InstanceStatusHistorySerializer
 from api.v2.views.base import AuthReadOnlyViewSet
-from api.v2.views.mixins import MultipleFieldLookup
+from api.pagination import KeysetPagination
+from api.v2.views.mixins import MultipleFieldLookup, StreamingListMixin
 
 class InstanceStatusHistoryFilter(django_filters.FilterSet):
     instance = django_filters.CharFilter(method='filter_instance_id')
@@ -29,11 +30,12 @@ class InstanceStatusHistoryFilter(django_filters.FilterSet):
 
 
 
-class InstanceStatusHistoryViewSet(MultipleFieldLookup, AuthReadOnlyViewSet):
+class InstanceStatusHistoryViewSet(StreamingListMixin, MultipleFieldLookup, AuthReadOnlyViewSet):
 
     """
     API endpoint that allows instance tags to be viewed
     """
+    pagination_class = KeysetPagination
     queryset = InstanceStatusHistory.objects.all()
     serializer_class = InstanceStatusHistorySerializer
     ordering = ('-instance__start_date', 'instance__id')
@@ -2,9 +2,11 @@ import operator
 
 from django.db import models
 from django.db.models import Q
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from rest_framework.generics import get_object_or_404
 
+from api.renderers import StreamingJSONRenderer
+
 
 class MultipleFieldLookup(object):
     lookup_fields = None
@@ -60,3 +62,29 @@ class MultipleFieldLookup(object):
         obj = get_object_or_404(queryset, filter_chain)
         self.check_object_permissions(self.request, obj)
         return obj
+
+
+class StreamingListMixin(object):
+    """
+    Stream the full list as a JSON array when the client asks for it
+    (See `api.pagination.KeysetPagination.is_full_set`), instead of
+    serializing the whole queryset in memory.
+    DISTINCT ON querysets keep their ordering, and are paginated as usual.
+    """
+
+    def list(self, request, *args, **kwargs):
+        paginator = self.paginator
+        if not paginator or not paginator.is_full_set(request):
+            return super(StreamingListMixin, self).list(
+                request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        if not paginator.can_iterate(queryset):
+            return super(StreamingListMixin, self).list(
+                request, *args, **kwargs)
+        serializer_class = self.get_serializer_class()
+        context = self.get_serializer_context()
+        items = (serializer_class(item, context=context).data
+                 for item in paginator.iterate(queryset, view=self))
+        return StreamingHttpResponse(
+            StreamingJSONRenderer().stream(items),
+            content_type=StreamingJSONRenderer.media_type)
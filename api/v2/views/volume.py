@@ -8,10 +8,11 @@ from rest_framework.response import Response
 from rest_framework import status
 
 from api.exceptions import (inactive_provider)
+from api.pagination import KeysetPagination
 from api.v2.serializers.details import VolumeSerializer, UpdateVolumeSerializer
 from api.v2.serializers.post import VolumeSerializer as POSTVolumeSerializer
 from api.v2.views.base import AuthModelViewSet
-from api.v2.views.mixins import MultipleFieldLookup
+from api.v2.views.mixins import MultipleFieldLookup, StreamingListMixin
 
 from core.exceptions import ProviderNotActive
 from core.models.volume import Volume, find_volume
@@ -35,11 +36,13 @@ class VolumeFilter(django_filters.FilterSet):
         fields = ['min_size', 'max_size', 'project']
 
 
-class VolumeViewSet(MultipleFieldLookup, AuthModelViewSet):
+class VolumeViewSet(StreamingListMixin, MultipleFieldLookup, AuthModelViewSet):
 
     """
     API endpoint that allows providers to be viewed or edited.
     """
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-instance_source__start_date', '-id')
     lookup_fields = ("id", "instance_source__identifier")
     serializer_class = VolumeSerializer
     filter_class = VolumeFilter
@@ -63,9 +63,15 @@ PERIODIC_TASKS = [
     "report_allocations_to_tas",
     "update_snapshot",
     "monitor_jetstream_allocation_sources",
+    "refresh_tacc_usernames",
     #ALLOCATION SOURCES - PERIODIC TASKS
-    "update_snapshot_cyverse",
+    "update_snapshot_cyverse", "update_snapshot_cyverse_for",
     "allocation_threshold_check",
+    "check_allocation_checkpoints",
+    "build_usage_rollups",
+]
+EVENT_TASKS = [
+    "deliver_events", "deliver_pending_events",
 ]
 SHORT_TASKS = [
     "wait_for_instance",
@@ -107,6 +113,8 @@ class CloudRouter(PredeclareRouter):
             return {"queue": "imaging", "routing_key": "imaging"}
         elif task_name in EMAIL_TASKS:
             return {"queue": "email", "routing_key": "email.sending"}
+        elif task_name in EVENT_TASKS:
+            return {"queue": "events", "routing_key": "events"}
         elif task_name in PERIODIC_TASKS:
             return {"queue": "periodic", "routing_key": "periodic"}
         elif task_name in DEPLOY_TASKS:
@@ -7,6 +7,7 @@ from datetime import timedelta
 from uuid import UUID
 import logging
 import sys
+import tempfile
 
 from dateutil.relativedelta import relativedelta
 from celery.schedules import crontab
@@ -112,6 +113,21 @@ USE_TZ = True
 
 # Atmosphere Time Allocation settings
 FIXED_WINDOW = relativedelta(day=1, months=1)
+# Engine used by service.allocation_logic.create_report: 'bulk' or 'legacy'
+ALLOCATION_REPORT_ENGINE = 'bulk'
+# Only report on usage since the last UserAllocationCheckpoint when updating snapshots
+INCREMENTAL_ALLOCATION_SNAPSHOTS = False
+# Usage more recent than this is re-calculated on every snapshot update
+ALLOCATION_CHECKPOINT_DELAY = timedelta(hours=1)
+# Allocation sources updated by each `update_snapshot_cyverse_for` subtask
+ALLOCATION_SNAPSHOT_BATCH_SIZE = 10
+
+# Run asynchronous EventTable hooks on the 'events' queue (False: while saving the event)
+ASYNC_EVENT_HANDLERS = True
+# Seconds to wait for more events before delivering them to asynchronous hooks
+EVENT_COALESCE_DELAY = 10
+# Events handed to an asynchronous hook at once
+EVENT_DELIVERY_BATCH_SIZE = 100
 
 # To load images for 404 page
 MEDIA_ROOT = os.path.join(PROJECT_ROOT, 'resources/')
@@ -427,6 +443,57 @@ LOCAL_STORAGE = "/storage"
 ELASTICSEARCH_HOST = SERVER_URL
 ELASTICSEARCH_PORT = 9200
 
+# Seconds before service.cache listings are fetched from the cloud again
+DRIVER_CACHE_TTL = {
+    "instances": 30,
+    "volumes": 30,
+    "machines": 30,
+}
+# Seconds an expired listing is still served while one worker refreshes it
+DRIVER_CACHE_STALE_TTL = 5 * 60
+# Seconds before the lock of a worker refreshing a listing expires
+DRIVER_CACHE_REFRESH_LEASE = 60
+# Drivers kept by service.cache.driver_pool (per process)
+DRIVER_POOL_SIZE = 100
+# Pooled drivers are rebuilt this long before their token expires
+DRIVER_POOL_EXPIRY_MARGIN = timedelta(minutes=5)
+# ... or after this long, when the token expiry is unknown
+DRIVER_POOL_MAX_AGE = timedelta(hours=1)
+# Seconds the cloud usage listed for a quota check is re-used (per process)
+QUOTA_USAGE_CACHE_TTL = 10
+# Serve quota checks from the QuotaUsageLedger (False: always ask the cloud)
+QUOTA_USAGE_LEDGER = True
+# ... when its usage was reconciled by the monitor tasks less than this long ago
+QUOTA_LEDGER_MAX_AGE = timedelta(hours=1)
+# Reports exported by the 'export_instance_report' task, one directory per user
+# (a temporary directory by default, set a persistent data directory in local.py)
+REPORT_EXPORT_ROOT = os.path.join(tempfile.gettempdir(), 'atmosphere', 'reports/')
+# Instances (and users) rolled up together by the 'build_usage_rollups' task
+USAGE_ROLLUP_BATCH_SIZE = 500
+# Seconds a user's validation/expiration plugin decision is re-used (per process, cleared when their allocation sources change)
+PLUGIN_DECISION_CACHE_TTL = 60
+# ... for at most this many decisions
+PLUGIN_DECISION_CACHE_SIZE = 10000
+# Seconds TAS API responses are cached in Redis (shared by every process)
+TAS_API_CACHE_TTL = 300
+# Kept-alive connections to the TAS API, and concurrent requests of a sweep
+TAS_API_POOL_SIZE = 10
+TAS_API_MAX_WORKERS = 8
+# Failed TAS API GETs are retried, after 0.5s, 1s, 2s, ...
+TAS_API_RETRIES = 3
+TAS_API_BACKOFF_FACTOR = 0.5
+TAS_API_TIMEOUT = 30
+# Saved XSEDE to TACC usernames are used for this long (See 'refresh_tacc_usernames')
+TACC_USERNAME_MAX_AGE = timedelta(days=2)
+# ... and "No TACC user found" for this long
+TACC_USERNAME_NEGATIVE_MAX_AGE = timedelta(hours=12)
+# (user, project) usages computed (and reports inserted) per pass of 'report_allocations_to_tas'
+TAS_REPORT_BATCH_SIZE = 200
+# A report still unconfirmed this long after it was claimed for sending is sent again
+TAS_REPORT_CLAIM_TIMEOUT = timedelta(hours=1)
+# Seconds the active maintenance records are re-used (per process, cleared when a record changes)
+MAINTENANCE_CACHE_TTL = 30
+
 # Django-Celery secrets
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
@@ -467,10 +534,16 @@ CELERYBEAT_SCHEDULE = {
     },
     "generate_metrics": {
         "task": "generate_metrics",
-        # Every day of the week @ 12am (Midnight)
-        "schedule": crontab(hour="0", minute="0", day_of_week="*"),
+        "schedule": timedelta(hours=1),
         "options": {"expires": 10 * 60, "time_limit": 10 * 60}
     },
+    "generate_metrics_full": {
+        "task": "generate_metrics",
+        # Every day of the week @ 2am, recounts instances recorded late
+        "schedule": crontab(hour="2", minute="0", day_of_week="*"),
+        "kwargs": {"full": True},
+        "options": {"expires": 60 * 60, "time_limit": 30 * 60}
+    },
     "prune_machines": {
         "task": "prune_machines",
         # Every day of the week @ 12am (Midnight)
@@ -504,6 +577,22 @@ CELERYBEAT_SCHEDULE = {
         "schedule": timedelta(minutes=15),
         "options": {"expires": 25 * 60, "time_limit": 25 * 60}
     },
+    "check_allocation_checkpoints": {
+        "task": "check_allocation_checkpoints",
+        # Every day of the week @ 3am
+        "schedule": crontab(hour="3", minute="0", day_of_week="*"),
+        "options": {"expires": 60 * 60, "time_limit": 60 * 60}
+    },
+    "deliver_pending_events": {
+        "task": "deliver_pending_events",
+        "schedule": timedelta(minutes=5),
+        "options": {"expires": 5 * 60, "time_limit": 5 * 60}
+    },
+    "build_usage_rollups": {
+        "task": "build_usage_rollups",
+        "schedule": timedelta(hours=1),
+        "options": {"expires": 60 * 60, "time_limit": 60 * 60}
+    },
     "clear_empty_ips": {
         "task": "clear_empty_ips",
         "schedule": timedelta(minutes=120),
@@ -4,6 +4,8 @@ Base classes.
 
 from abc import ABCMeta, abstractmethod
 
+default_app_config = 'core.apps.CoreConfig'
+
 # Base Classes
 
 
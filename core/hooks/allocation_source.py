@@ -85,9 +85,9 @@ def listen_before_allocation_snapshot_changes(sender, instance, raw, **kwargs):
     return
 
 
-def listen_for_allocation_threshold_met(sender, instance, created, **kwargs):
+def listen_for_allocation_thresholds_met(events):
     """
-    This listener expects:
+    This (asynchronous) listener expects:
     EventType - 'allocation_source_threshold_met'
     EventEntityID - '<allocation_source.name>'
     EventPayload - {
@@ -96,26 +96,29 @@ def listen_for_allocation_threshold_met(sender, instance, created, **kwargs):
         "usage_percentage":22 # The actual perecntage used
     }
     The method should fire off emails to the users who should be informed of the new threshold value.
+
+    Events are coalesced per allocation source: when a burst of events
+    crosses several thresholds, the users are only emailed about the
+    highest one.
     """
-    # FIXME+TODO: next version: Fire and respond to the `clear_allocation_threshold_met` for a given allocation_source_name (This event should be generated any time you `.save()` and update the `compute_allowed` for an AllocationSource
-    event = instance
-    if event.name != 'allocation_source_threshold_met':
-        return None
-    payload = event.payload
-    allocation_source_name = payload['allocation_source_name']
-    threshold = payload['threshold']
-    usage_percentage = payload['usage_percentage']
     if not settings.ENFORCING:
         return None
-    source = AllocationSource.objects.filter(name=allocation_source_name).last()
-    ##CHANGED
-    # source = AllocationSource.objects.filter(name=allocation_source_name).last()
-    if not source:
-        return None
-    users = AtmosphereUser.for_allocation_source(source.name)
-
-    for user in users:
-        send_usage_email_to(user, source, threshold, usage_percentage=usage_percentage)
+    payloads = {}
+    for event in events:
+        payload = event.payload
+        allocation_source_name = payload['allocation_source_name']
+        latest = payloads.get(allocation_source_name)
+        if not latest or payload['threshold'] >= latest['threshold']:
+            payloads[allocation_source_name] = payload
+    for allocation_source_name, payload in payloads.items():
+        source = AllocationSource.objects.filter(name=allocation_source_name).last()
+        if not source:
+            continue
+        # Events created by `listen_before_allocation_snapshot_changes` use 'actual_value'
+        usage_percentage = payload.get('usage_percentage', payload.get('actual_value'))
+        users = AtmosphereUser.for_allocation_source(source.name)
+        for user in users:
+            send_usage_email_to(user, source, payload['threshold'], usage_percentage=usage_percentage)
 
 
 def send_usage_email_to(user, source, threshold, usage_percentage=None):
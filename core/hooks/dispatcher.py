@@ -0,0 +1,155 @@
+"""
+Dispatch EventTable saves to the hooks registered for the event name
+
+Instead of connecting every hook to the EventTable save signals (and
+letting each one discard the events it does not handle), hooks register
+for the event names they handle and a single receiver per signal
+calls only those.
+
+Asynchronous hooks receive a *list* of events: saving an event records
+an EventDelivery per hook, and once the transaction is committed the
+`deliver_events` task hands all the pending events of that name to the
+hook (See `EventDelivery.deliver_pending`).
+"""
+import threading
+import time
+from collections import defaultdict
+
+import redis
+from django.conf import settings
+from django.db import transaction
+
+from threepio import logger
+
+PRE_SAVE = 'pre_save'
+POST_SAVE = 'post_save'
+SCHEDULED_KEY = "event_delivery.{0}.scheduled"
+
+
+def handler_key(handler):
+    return "%s.%s" % (handler.__module__, handler.__name__)
+
+
+def schedule_delivery(name):
+    """
+    Deliver the pending `name` events in EVENT_COALESCE_DELAY seconds.
+    Events saved in the meantime are delivered by the same task.
+    """
+    from core.tasks import deliver_events
+    from service.cache import redis_connection
+    delay = getattr(settings, 'EVENT_COALESCE_DELAY', 10)
+    try:
+        if not redis_connection().set(SCHEDULED_KEY.format(name), 1, ex=delay, nx=True):
+            return
+    except redis.RedisError:
+        logger.exception("Could not coalesce the delivery of %s events", name)
+    deliver_events.apply_async(args=[name], countdown=delay)
+
+
+class EventDispatcher(object):
+    """
+    Registry of EventTable hooks, keyed by (signal, event name)
+    """
+    def __init__(self):
+        self.handlers = defaultdict(list)
+        self.async_handlers = defaultdict(list)
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, name, handler, signal=POST_SAVE, asynchronous=False):
+        """
+        Call `handler` whenever an event `name` is saved.
+        pre_save handlers receive (sender, instance, raw, **kwargs),
+        post_save handlers receive (sender, instance, created, **kwargs)
+        and asynchronous handlers receive (events), once committed.
+        """
+        if signal not in (PRE_SAVE, POST_SAVE):
+            raise ValueError("Unknown signal %s" % signal)
+        if asynchronous and signal != POST_SAVE:
+            raise ValueError("Asynchronous handlers are called after saving")
+        if asynchronous:
+            handlers = self.async_handlers[name]
+        else:
+            handlers = self.handlers[(signal, name)]
+        if handler not in handlers:
+            handlers.append(handler)
+
+    def unregister(self, name, handler, signal=POST_SAVE):
+        for handlers in (self.handlers.get((signal, name), []),
+                         self.async_handlers.get(name, [])):
+            if handler in handlers:
+                handlers.remove(handler)
+
+    def handlers_for(self, name, signal=POST_SAVE):
+        return list(self.handlers.get((signal, name), []))
+
+    def async_handlers_for(self, name):
+        return list(self.async_handlers.get(name, []))
+
+    def dispatch(self, signal, sender, event, **kwargs):
+        """
+        Call the `signal` handlers registered for `event.name`
+        """
+        for handler in self.handlers_for(event.name, signal):
+            started = time.time()
+            try:
+                handler(sender=sender, instance=event, **kwargs)
+            finally:
+                self._record(handler, time.time() - started)
+        if signal == POST_SAVE and kwargs.get('created'):
+            self._defer(event)
+
+    def _defer(self, event):
+        handlers = self.async_handlers_for(event.name)
+        if not handlers:
+            return
+        if not getattr(settings, 'ASYNC_EVENT_HANDLERS', True):
+            for handler in handlers:
+                self.run_batch(handler, [event])
+            return
+        # Circular dep...
+        from core.models.event_table import EventDelivery
+        EventDelivery.objects.bulk_create([
+            EventDelivery(event=event, handler=handler_key(handler))
+            for handler in handlers])
+        transaction.on_commit(lambda: schedule_delivery(event.name))
+
+    def run_batch(self, handler, events):
+        started = time.time()
+        try:
+            handler(events)
+        finally:
+            self._record(handler, time.time() - started)
+
+    def _record(self, handler, seconds):
+        key = handler_key(handler)
+        with self.lock:
+            metrics = self.metrics.setdefault(
+                key, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            metrics['calls'] += 1
+            metrics['seconds'] += seconds
+            metrics['max_seconds'] = max(metrics['max_seconds'], seconds)
+        logger.debug("Event handler %s took %.3fs", key, seconds)
+
+    def stats(self):
+        """
+        Returns the calls and total/max seconds spent by each handler
+        """
+        with self.lock:
+            return dict((key, dict(metrics))
+                        for key, metrics in self.metrics.items())
+
+    def reset_stats(self):
+        with self.lock:
+            self.metrics = {}
+
+
+event_dispatcher = EventDispatcher()
+
+
+def dispatch_pre_save(sender, instance, raw, **kwargs):
+    event_dispatcher.dispatch(PRE_SAVE, sender, instance, raw=raw, **kwargs)
+
+
+def dispatch_post_save(sender, instance, created, **kwargs):
+    event_dispatcher.dispatch(POST_SAVE, sender, instance, created=created, **kwargs)
@@ -1,90 +1,167 @@
-import pickle
 import collections
 import numpy
-import redis
+import pytz
 
 from threepio import logger
+from django.db import transaction
 from django.db.models import (
-        Avg, ExpressionWrapper,
-        F, Q, fields)
+        Avg, Count, ExpressionWrapper,
+        F, Max, Q, fields)
+from django.db.models.functions import TruncDay
 from django.utils import timezone
 from dateutil import rrule
+from dateutil.relativedelta import relativedelta
 from core.models import (
-    Instance, InstanceStatusHistory
+    ApplicationMetric, Instance, InstanceStatusHistory
 )
 
 
-METRICS_CACHE_DURATION = 4*24*60*60  # 4 days (persist over the weekend)
+METRICS_DAY_LIMIT = 120
+METRICS_INTERVALS = (rrule.DAILY, rrule.WEEKLY, rrule.MONTHLY)
 
 
-def get_application_metrics(application, now_time=None, read_only=False):
+def get_application_metrics(application, now_time=None):
     """
     Skip image metrics on end-dated applications
-    Otherwise look through the cache to find application metrics
+    Otherwise return the monthly application metrics
     """
     metrics = {}
     if application.end_date:
         return metrics
-    metrics = _get_application_metrics(application, interval=rrule.DAILY, now_time=now_time, read_only=read_only)
-    metrics = _get_application_metrics(application, interval=rrule.WEEKLY, now_time=now_time, read_only=read_only)
-    metrics = _get_application_metrics(application, interval=rrule.MONTHLY, now_time=now_time, read_only=read_only)
-    return metrics
+    return _get_application_metrics(application, interval=rrule.MONTHLY, now_time=now_time)
 
 
-def _get_application_metrics(application, interval=rrule.MONTHLY, day_limit=120,
-                             now_time=None, force=False, read_only=False):
+def _get_application_metrics(application, interval=rrule.MONTHLY, day_limit=METRICS_DAY_LIMIT,
+                             now_time=None, force=False):
+    """
+    Read the metrics of the last `day_limit` days from the ApplicationMetric
+    buckets (refreshed by the 'generate_metrics' task).
+    Each bucket holds the instances launched since the first bucket.
+    """
     metrics = collections.OrderedDict()
     if not interval:
         interval = rrule.MONTHLY
-    redis_cache = redis.StrictRedis()
-    key = "metrics-application-%s-interval-%s-limited-to-%s" % (application.id, rrule.FREQNAMES[interval], day_limit)
-    try:
-        if redis_cache.exists(key) and not force:
-            pickled_object = redis_cache.get(key)
-            metrics = pickle.loads(pickled_object)
-        elif not read_only:
-            metrics = calculate_application_metrics(application, interval, day_limit, now_time=now_time)
-            pickled_object = pickle.dumps(metrics)
-            redis_cache.set(key, pickled_object)
-            redis_cache.expire(key, METRICS_CACHE_DURATION)
-    except:
-        logger.exception("Unexpected errror in application metrics")
+    if force:
+        refresh_application_metrics(now_time)
+    end_date = application.end_date or now_time or timezone.now()
+    start_date = end_date - timezone.timedelta(days=day_limit)
+    buckets = dict(
+        (metric.bucket, metric) for metric in ApplicationMetric.objects.filter(
+            application=application, interval=rrule.FREQNAMES[interval],
+            bucket__gte=bucket_start(start_date, interval), bucket__lte=end_date))
+    total = active = 0
+    for bucket in _generate_buckets(start_date, end_date, interval):
+        metric = buckets.get(bucket)
+        if metric:
+            total += metric.total
+            active += metric.active
+        metrics[bucket.strftime("%x %X")] = {"active": active, "total": total}
     return metrics
 
 
-def calculate_application_metrics(application, interval=rrule.MONTHLY,
-                                  day_limit=None, sum_datapoints=True, now_time=None):
+def bucket_start(date, interval):
     """
-    From start_date of Application to now/End-date of application
-      - Create a timeseries by splitting by 'interval'
-      - Query for metrics datapoints
-      - Return the timeseries + datapoints
+    Start of the (UTC) day, week or month of `date`
+    """
+    start = date.astimezone(pytz.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == rrule.WEEKLY:
+        start -= timezone.timedelta(days=start.weekday())
+    elif interval == rrule.MONTHLY:
+        start = start.replace(day=1)
+    return start
+
+
+def _next_bucket(bucket, interval):
+    if interval == rrule.WEEKLY:
+        return bucket + timezone.timedelta(days=7)
+    elif interval == rrule.MONTHLY:
+        return bucket + relativedelta(months=1)
+    return bucket + timezone.timedelta(days=1)
+
+
+def _generate_buckets(start_date, end_date, interval):
+    bucket = bucket_start(start_date, interval)
+    while bucket <= end_date:
+        yield bucket
+        bucket = _next_bucket(bucket, interval)
+
+
+def refresh_application_metrics(now_time=None, full=False, day_limit=METRICS_DAY_LIMIT):
+    """
+    Replace the newest bucket of every interval, for all applications.
+    Buckets since the previous refresh are replaced as well, and the
+    last `day_limit` days when `full` (or when nothing was computed yet).
+    Returns the number of ApplicationMetric rows written.
     """
     if not now_time:
         now_time = timezone.now()
-    end_date = application.end_date or now_time
-    start_date = end_date - timezone.timedelta(days=day_limit)
-    timeseries = _generate_time_series(start_date, end_date, interval)
-    all_instance_ids = application.versions.values_list('machines__instance_source__instances', flat=True)
-    application_metrics = collections.OrderedDict()
-    for idx, ts in enumerate(timeseries):
-        interval_start = ts
-        interval_key = interval_start.strftime("%x %X")
-        if sum_datapoints:
-            interval_start = start_date
-        if idx == len(timeseries)-1:
-            interval_end = end_date
-        else:
-            interval_end = timeseries[idx+1]
-        all_instances = Instance.objects\
-            .filter(id__in=all_instance_ids)\
-            .filter(start_date__gt=interval_start, start_date__lt=interval_end)
-        all_histories = InstanceStatusHistory.objects.filter(
-            instance__in=all_instances)
-        per_interval_metrics = calculate_instance_metrics_for_interval(
-            all_instances, all_histories, interval_start, interval_end)
-        application_metrics[interval_key] = per_interval_metrics
-    return application_metrics
+    since = min(bucket_start(now_time, interval) for interval in METRICS_INTERVALS)
+    last_refresh = ApplicationMetric.objects.filter(
+        interval=rrule.FREQNAMES[rrule.DAILY]).aggregate(last=Max('bucket'))['last']
+    if full or not last_refresh:
+        since = bucket_start(now_time - timezone.timedelta(days=day_limit), rrule.MONTHLY)
+    else:
+        since = min([since] + [bucket_start(last_refresh, interval)
+                               for interval in METRICS_INTERVALS])
+    daily_counts = _daily_counts(since)
+    metrics = []
+    for interval in METRICS_INTERVALS:
+        interval_name = rrule.FREQNAMES[interval]
+        buckets = {}
+        for (application_id, day), counts in daily_counts.items():
+            bucket = bucket_start(day, interval)
+            # Buckets starting earlier are only partially counted
+            if bucket < since:
+                continue
+            metric = buckets.get((application_id, bucket))
+            if not metric:
+                metric = buckets[(application_id, bucket)] = ApplicationMetric(
+                    application_id=application_id, interval=interval_name,
+                    bucket=bucket, versions={})
+            _add_counts(metric, counts)
+        metrics.extend(buckets.values())
+    with transaction.atomic():
+        stale_metrics = ApplicationMetric.objects.filter(bucket__gte=since)
+        if full:
+            stale_metrics = ApplicationMetric.objects.all()
+        stale_metrics.delete()
+        ApplicationMetric.objects.bulk_create(metrics, batch_size=1000)
+    logger.info("Refreshed %s application metrics since %s", len(metrics), since)
+    return len(metrics)
+
+
+def _daily_counts(since):
+    """
+    Count the instances launched each day since `since`, per application,
+    version and provider -- in two grouped queries.
+    Returns {(application id, day): {version name: {location: counts}}}
+    """
+    group_by = ('source__providermachine__application_version__application',
+                'source__providermachine__application_version__name',
+                'source__provider__location', 'day')
+    instances = Instance.objects.filter(
+        start_date__gte=since, source__providermachine__isnull=False)
+    active_instances = instances.filter(instancestatushistory__status__name='active')
+    daily_counts = collections.defaultdict(dict)
+    for key, queryset in (('total', instances), ('active', active_instances)):
+        rows = queryset.annotate(day=TruncDay('start_date', tzinfo=pytz.utc))\
+            .values_list(*group_by).annotate(count=Count('id', distinct=True))
+        for application_id, version_name, location, day, count in rows:
+            provider_counts = daily_counts[(application_id, day)]\
+                .setdefault(version_name, {})\
+                .setdefault(location, {"active": 0, "total": 0})
+            provider_counts[key] = count
+    return daily_counts
+
+
+def _add_counts(metric, version_counts):
+    for version_name, provider_counts in version_counts.items():
+        for location, counts in provider_counts.items():
+            metric_counts = metric.versions.setdefault(version_name, {})\
+                .setdefault(location, {"active": 0, "total": 0})
+            for key in ("active", "total"):
+                metric_counts[key] += counts[key]
+                setattr(metric, key, getattr(metric, key) + counts[key])
 
 
 # Alternative calculation method, drilling down per-version rather than per-application.
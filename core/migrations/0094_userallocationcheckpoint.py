@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0093_non_null_size_in_instance_status_history_entries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAllocationCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateTimeField()),
+                ('last_processed', models.DateTimeField()),
+                ('compute_used_seconds', models.DecimalField(decimal_places=3, max_digits=19)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('allocation_source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_allocation_checkpoints', to='core.AllocationSource')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_allocation_checkpoints', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'user_allocation_checkpoint',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='userallocationcheckpoint',
+            unique_together=set([('user', 'allocation_source')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0094_userallocationcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('handler', models.CharField(max_length=255)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('delivered', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('event', models.ForeignKey(db_column='event_uuid', on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='core.EventTable', to_field='uuid')),
+            ],
+            options={
+                'db_table': 'event_delivery',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='eventdelivery',
+            unique_together=set([('event', 'handler')]),
+        ),
+    ]
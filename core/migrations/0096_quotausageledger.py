@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0095_eventdelivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuotaUsageLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cpu', models.IntegerField(default=0)),
+                ('memory', models.FloatField(default=0)),
+                ('instance_count', models.IntegerField(default=0)),
+                ('storage', models.IntegerField(default=0)),
+                ('storage_count', models.IntegerField(default=0)),
+                ('instances_reconciled', models.DateTimeField(blank=True, null=True)),
+                ('volumes_reconciled', models.DateTimeField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('identity', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='quota_usage', to='core.Identity')),
+            ],
+            options={
+                'db_table': 'quota_usage_ledger',
+            },
+        ),
+    ]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0096_quotausageledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstanceUsageRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_index=True)),
+                ('cpu_seconds', models.FloatField(default=0)),
+                ('active_seconds', models.FloatField(default=0)),
+                ('status_counts', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('complete', models.BooleanField(db_index=True, default=False)),
+                ('allocation_source', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.AllocationSource')),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to='core.Instance')),
+            ],
+            options={
+                'db_table': 'instance_usage_rollup',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserUsageRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_index=True)),
+                ('cpu_seconds', models.FloatField(default=0)),
+                ('active_seconds', models.FloatField(default=0)),
+                ('status_counts', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('instance_count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'user_usage_rollup',
+            },
+        ),
+        migrations.CreateModel(
+            name='UsageRollupBuild',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_history_id', models.IntegerField()),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField(auto_now_add=True)),
+                ('instance_count', models.IntegerField(default=0)),
+                ('user_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'usage_rollup_build',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='instanceusagerollup',
+            index_together=set([('instance', 'day')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='userusagerollup',
+            unique_together=set([('user', 'day')]),
+        ),
+    ]
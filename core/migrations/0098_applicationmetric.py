@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0097_usagerollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApplicationMetric',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interval', models.CharField(max_length=16)),
+                ('bucket', models.DateTimeField()),
+                ('total', models.IntegerField(default=0)),
+                ('active', models.IntegerField(default=0)),
+                ('versions', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('application', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='metric_buckets', to='core.Application')),
+            ],
+            options={
+                'db_table': 'application_metric',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='applicationmetric',
+            unique_together=set([('application', 'interval', 'bucket')]),
+        ),
+    ]
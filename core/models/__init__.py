@@ -7,9 +7,11 @@ from django.db.models import ObjectDoesNotExist
 from core.models.allocation_strategy import Allocation, AllocationStrategy
 from core.models.allocation_source import (
         AllocationSource, UserAllocationSource, UserAllocationSnapshot,
-        InstanceAllocationSourceSnapshot, AllocationSourceSnapshot)
+        UserAllocationCheckpoint, InstanceAllocationSourceSnapshot,
+        AllocationSourceSnapshot)
 from core.models.application import Application, ApplicationMembership,\
     ApplicationScore, ApplicationBookmark, ApplicationThreshold
+from core.models.application_metric import ApplicationMetric
 from core.models.application_tag import ApplicationTag
 from core.models.application_version import ApplicationVersion, ApplicationVersionMembership
 from core.models.cloud_admin import CloudAdministrator
@@ -40,16 +42,17 @@ from core.models.instance_history import InstanceStatus, InstanceStatusHistory
 from core.models.instance_source import InstanceSource
 from core.models.node import NodeController
 from core.models.boot_script import ScriptType, BootScript, ApplicationVersionBootScript
-from core.models.quota import Quota
+from core.models.quota import Quota, QuotaUsageLedger
 #from core.models.renewal_strategy import RenewalStrategy
 from core.models.resource_request import ResourceRequest
 from core.models.size import Size
 from core.models.status_type import StatusType
 from core.models.t import T
 from core.models.tag import Tag
+from core.models.usage_rollup import InstanceUsageRollup, UserUsageRollup, UsageRollupBuild
 from core.models.template import (EmailTemplate, HelpLink)
 from core.models.user import AtmosphereUser
 from core.models.volume import Volume
 from core.models.ssh_key import SSHKey
 
-from core.models.event_table import EventTable
+from core.models.event_table import EventTable, EventDelivery
@@ -1,10 +1,14 @@
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
 from django.utils import timezone
+from django.utils.timezone import timedelta
 from threepio import logger
 from pprint import pprint
 from uuid import uuid4
 
+from core.plugins import plugin_decisions, publish_invalidation
+
 class AllocationSource(models.Model):
     uuid = models.UUIDField(default=uuid4, unique=True, editable=False)
     name = models.CharField(max_length=255, unique=True)
@@ -171,6 +175,115 @@ class AllocationSourceSnapshot(models.Model):
         db_table = 'allocation_source_snapshot'
         app_label = 'core'
 
+class UserAllocationCheckpoint(models.Model):
+    """
+    Compute used (in seconds) by a User on an AllocationSource
+    from `start_date` (the start of the allocation period) up to `last_processed`.
+
+    Incremental snapshots only report on usage after `last_processed`
+    and add it to the checkpoint (See `UserAllocationCheckpoint.usage`).
+    """
+    user = models.ForeignKey("AtmosphereUser", related_name="user_allocation_checkpoints")
+    allocation_source = models.ForeignKey(AllocationSource, related_name="user_allocation_checkpoints")
+    start_date = models.DateTimeField()
+    last_processed = models.DateTimeField()
+    compute_used_seconds = models.DecimalField(max_digits=19, decimal_places=3)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def usage(cls, user, allocation_source, start_date, end_date, rebuild=False):
+        """
+        Returns [compute_used, burn_rate] from start_date to end_date,
+        like `total_usage(..., burn_rate=True)`.
+
+        Only usage after the checkpoint is calculated. Usage from the last
+        `settings.ALLOCATION_CHECKPOINT_DELAY` is recalculated on every call,
+        so that late status histories and events are still counted.
+        The checkpoint is rebuilt from `start_date` when `rebuild` is True,
+        or the allocation period has changed.
+        """
+        checkpoint = cls.objects.filter(user=user, allocation_source=allocation_source).first()
+        if rebuild or not checkpoint or checkpoint.start_date != start_date \
+                or checkpoint.last_processed > end_date:
+            last_processed = start_date
+            compute_used_seconds = 0.0
+        else:
+            last_processed = checkpoint.last_processed
+            compute_used_seconds = float(checkpoint.compute_used_seconds)
+
+        settled_date = end_date - getattr(settings, 'ALLOCATION_CHECKPOINT_DELAY', timedelta(hours=1))
+        if settled_date > last_processed:
+            settled_seconds, _ = usage_seconds(user.username, last_processed, settled_date,
+                                               allocation_source_name=allocation_source.name)
+            compute_used_seconds += settled_seconds
+            last_processed = settled_date
+            cls.objects.update_or_create(
+                user=user, allocation_source=allocation_source,
+                defaults={'start_date': start_date,
+                          'last_processed': last_processed,
+                          'compute_used_seconds': compute_used_seconds})
+        recent_seconds, burn_rate = usage_seconds(user.username, last_processed, end_date,
+                                                  allocation_source_name=allocation_source.name)
+        compute_used_total = round((compute_used_seconds + recent_seconds)/3600.0, 2)
+        return [compute_used_total, burn_rate]
+
+    def is_consistent(self, tolerance=1.0):
+        """
+        Recalculate the usage from `start_date` to `last_processed`
+        and compare it to the checkpoint (Both in seconds)
+        """
+        expected_seconds, _ = usage_seconds(self.user.username, self.start_date, self.last_processed,
+                                            allocation_source_name=self.allocation_source.name)
+        difference = abs(expected_seconds - float(self.compute_used_seconds))
+        if difference > tolerance:
+            logger.warn("Checkpoint %s is off by %s seconds (Expected %s)"
+                        % (self, difference, expected_seconds))
+            return False
+        return True
+
+    def __unicode__(self):
+        return "User %s + AllocationSource %s: %s seconds from %s to %s" %\
+            (self.user, self.allocation_source, self.compute_used_seconds,
+             self.start_date, self.last_processed)
+
+    class Meta:
+        db_table = 'user_allocation_checkpoint'
+        app_label = 'core'
+        unique_together = ('user', 'allocation_source')
+
+
+def snapshot_usage(user, allocation_source, start_date, end_date, rebuild=False):
+    """
+    Returns [compute_used, burn_rate] for a UserAllocationSnapshot.
+    Incremental (See UserAllocationCheckpoint) if `settings.INCREMENTAL_ALLOCATION_SNAPSHOTS`
+    """
+    if getattr(settings, 'INCREMENTAL_ALLOCATION_SNAPSHOTS', False):
+        return UserAllocationCheckpoint.usage(user, allocation_source, start_date, end_date, rebuild=rebuild)
+    return total_usage(user.username, start_date, allocation_source_name=allocation_source.name,
+                       end_date=end_date, burn_rate=True)
+
+
+def usage_seconds(username, start_date, end_date, allocation_source_name=None):
+    """
+    Returns [compute_used, burn_rate] from start_date to end_date,
+    with compute_used in seconds (and not rounded).
+    """
+    from service.allocation_logic import create_report
+    user_allocation = create_report(start_date, end_date, user_id=username,
+                                    allocation_source_name=allocation_source_name)
+    burn_rate_total = 0 if len(user_allocation) < 1 else user_allocation[-1]['burn_rate']
+    return [_total_allocation_seconds(user_allocation), burn_rate_total]
+
+
+def _total_allocation_seconds(user_allocation):
+    total_allocation = 0.0
+    for data in user_allocation:
+        #print data['instance_id'], data['allocation_source'], data['instance_status_start_date'], data['instance_status_end_date'], data['applicable_duration']
+        if not data['allocation_source']=='N/A':
+            total_allocation += data['applicable_duration']
+    return total_allocation
+
+
 def total_usage(username, start_date, allocation_source_name=None,end_date=None, burn_rate=False, email=None):
     """ 
         This function outputs the total allocation usage in hours
@@ -181,11 +294,7 @@ def total_usage(username, start_date, allocation_source_name=None,end_date=None,
     user_allocation = create_report(start_date,end_date,user_id=username,allocation_source_name=allocation_source_name)
     if email:
         return user_allocation
-    total_allocation = 0.0
-    for data in user_allocation:
-        #print data['instance_id'], data['allocation_source'], data['instance_status_start_date'], data['instance_status_end_date'], data['applicable_duration']
-        if not data['allocation_source']=='N/A':
-            total_allocation += data['applicable_duration']
+    total_allocation = _total_allocation_seconds(user_allocation)
     compute_used_total = round(total_allocation/3600.0,2)
     if compute_used_total > 0:
         logger.info("Total usage for User %s with AllocationSource %s from %s-%s = %s"
@@ -204,3 +313,16 @@ def get_allocation_source_object(source_id):
         raise Exception('No source_id provided in _get_allocation_source_object method')
 
     return AllocationSource.objects.filter(uuid=source_id).last()
+
+
+def invalidate_plugin_decisions(sender, instance, **kwargs):
+    """
+    Validation/expiration plugins decide based on allocation sources,
+    re-evaluate the user once they change
+    """
+    plugin_decisions.invalidate(instance.user_id)
+    transaction.on_commit(lambda: publish_invalidation(instance.user_id))
+
+
+post_save.connect(invalidate_plugin_decisions, sender=UserAllocationSource)
+post_delete.connect(invalidate_plugin_decisions, sender=UserAllocationSource)
@@ -0,0 +1,33 @@
+"""
+Precomputed launch metrics of an Application
+"""
+from django.contrib.postgres.fields import JSONField
+from django.db import models
+
+
+class ApplicationMetric(models.Model):
+    """
+    Instances of an application launched during one bucket of an interval
+    (i.e. the 'MONTHLY' bucket starting on 2017-03-01 00:00 UTC).
+    Filled by `core.metrics.application.refresh_application_metrics`.
+    """
+    application = models.ForeignKey("Application", related_name="metric_buckets",
+                                    on_delete=models.CASCADE)
+    interval = models.CharField(max_length=16)  # rrule.FREQNAMES
+    bucket = models.DateTimeField()
+    total = models.IntegerField(default=0)
+    # Instances that went 'active' at least once
+    active = models.IntegerField(default=0)
+    # {version name: {provider location: {'total': #, 'active': #}}}
+    versions = JSONField(default=dict)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "%s %s %s: %s/%s active" % (
+            self.application_id, self.interval, self.bucket,
+            self.active, self.total)
+
+    class Meta:
+        db_table = "application_metric"
+        app_label = "core"
+        unique_together = (("application", "interval", "bucket"),)
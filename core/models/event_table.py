@@ -1,6 +1,7 @@
 from uuid import uuid4
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.db.models.signals import post_save, pre_save
 from django.utils import timezone
 from django.contrib.postgres.fields import JSONField
@@ -11,7 +12,7 @@ from core.hooks.allocation_source import (
     listen_before_allocation_snapshot_changes,
     listen_for_allocation_snapshot_changes,
     listen_for_user_snapshot_changes,
-    listen_for_allocation_threshold_met,
+    listen_for_allocation_thresholds_met,
     listen_for_instance_allocation_changes,
     listen_for_allocation_source_created_or_renewed,
     listen_for_user_allocation_source_deleted,
@@ -22,6 +23,10 @@ from core.hooks.allocation_source import (
     listen_for_allocation_source_removed,
     listen_for_instance_allocation_removed
 )
+from core.hooks.dispatcher import (
+    event_dispatcher, dispatch_pre_save, dispatch_post_save, handler_key,
+    PRE_SAVE, POST_SAVE
+)
 from threepio import logger
 
 
@@ -46,6 +51,26 @@ class EventTable(models.Model):
             payload=payload
         )
 
+    @classmethod
+    def create_events(cls, events):
+        """
+        Insert many events with a single statement, then call the hooks
+        of each event (in order) as if it had been saved on its own.
+
+        events - A list of (name, payload, entity_id)
+        """
+        new_events = [cls(name=name, entity_id=entity_id, payload=payload)
+                      for name, payload, entity_id in events]
+        if not new_events:
+            return []
+        logger.info("Creating %s new events" % len(new_events))
+        for event in new_events:
+            event_dispatcher.dispatch(PRE_SAVE, cls, event, raw=False)
+        new_events = cls.objects.bulk_create(new_events)
+        for event in new_events:
+            event_dispatcher.dispatch(POST_SAVE, cls, event, created=True)
+        return new_events
+
     def __str__(self):
         return "%s" % self.name
 
@@ -57,6 +82,56 @@ class EventTable(models.Model):
         app_label = "core"
 
 
+class EventDelivery(models.Model):
+
+    """
+    Delivery of an event to an asynchronous hook (See core.hooks.dispatcher)
+    Created with the event, and marked `delivered` once the hook returns.
+    """
+
+    event = models.ForeignKey(EventTable, to_field='uuid', db_column='event_uuid',
+                              related_name='deliveries', on_delete=models.CASCADE)
+    handler = models.CharField(max_length=255)
+    created = models.DateTimeField(default=timezone.now)
+    delivered = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    @classmethod
+    def deliver_pending(cls, handler, batch_size=None):
+        """
+        Hand the pending events of `handler` to it, in batches.
+        Each batch is locked (so concurrent workers skip it) and marked
+        delivered in the transaction that runs the handler: if the handler
+        raises, the batch is delivered again by the next attempt.
+        Returns the number of events delivered.
+        """
+        if not batch_size:
+            batch_size = getattr(settings, 'EVENT_DELIVERY_BATCH_SIZE', 100)
+        key = handler_key(handler)
+        delivered = 0
+        while True:
+            with transaction.atomic():
+                deliveries = list(
+                    cls.objects.select_for_update(skip_locked=True)
+                    .filter(handler=key, delivered__isnull=True)
+                    .select_related('event')
+                    .order_by('event__timestamp', 'event__id')[:batch_size])
+                if not deliveries:
+                    return delivered
+                event_dispatcher.run_batch(
+                    handler, [delivery.event for delivery in deliveries])
+                cls.objects.filter(id__in=[delivery.id for delivery in deliveries])\
+                    .update(delivered=timezone.now())
+            delivered += len(deliveries)
+
+    def __unicode__(self):
+        return "%s -> %s" % (self.event_id, self.handler)
+
+    class Meta:
+        db_table = "event_delivery"
+        app_label = "core"
+        unique_together = ("event", "handler")
+
+
 # Save hooks
 def listen_for_changes(sender, instance, created, **kwargs):
     """
@@ -67,18 +142,29 @@ def listen_for_changes(sender, instance, created, **kwargs):
     return None
 
 
-# Instantiate the hooks:
-post_save.connect(listen_for_allocation_threshold_met, sender=EventTable)
-post_save.connect(listen_for_instance_allocation_changes, sender=EventTable)
-post_save.connect(listen_for_allocation_source_created_or_renewed, sender=EventTable)
-post_save.connect(listen_for_allocation_source_compute_allowed_changed, sender=EventTable)
-post_save.connect(listen_for_user_allocation_source_created, sender=EventTable)
-post_save.connect(listen_for_user_allocation_source_deleted, sender=EventTable)
-pre_save.connect(listen_before_allocation_snapshot_changes, sender=EventTable)
-post_save.connect(listen_for_instance_allocation_removed, sender=EventTable)
-post_save.connect(listen_for_allocation_snapshot_changes, sender=EventTable)
-post_save.connect(listen_for_user_snapshot_changes, sender=EventTable)
-post_save.connect(listen_for_allocation_source_renewal_strategy_changed, sender=EventTable)
-post_save.connect(listen_for_allocation_source_name_changed, sender=EventTable)
-post_save.connect(listen_for_allocation_source_removed, sender=EventTable)
-post_save.connect(listen_for_quota_assigned, sender=EventTable)
+# Register the hooks for the events they handle:
+EVENT_HOOKS = [
+    ('instance_allocation_source_changed', listen_for_instance_allocation_changes),
+    ('allocation_source_created_or_renewed', listen_for_allocation_source_created_or_renewed),
+    ('allocation_source_compute_allowed_changed', listen_for_allocation_source_compute_allowed_changed),
+    ('user_allocation_source_created', listen_for_user_allocation_source_created),
+    ('user_allocation_source_deleted', listen_for_user_allocation_source_deleted),
+    ('instance_allocation_source_removed', listen_for_instance_allocation_removed),
+    ('allocation_source_snapshot', listen_for_allocation_snapshot_changes),
+    ('user_allocation_snapshot_changed', listen_for_user_snapshot_changes),
+    ('allocation_source_renewal_strategy_changed', listen_for_allocation_source_renewal_strategy_changed),
+    ('allocation_source_name_changed', listen_for_allocation_source_name_changed),
+    ('allocation_source_removed', listen_for_allocation_source_removed),
+    ('quota_assigned', listen_for_quota_assigned),
+]
+event_dispatcher.register('allocation_source_snapshot',
+                          listen_before_allocation_snapshot_changes,
+                          signal=PRE_SAVE)
+for event_name, hook in EVENT_HOOKS:
+    event_dispatcher.register(event_name, hook)
+# Emails are sent (and coalesced) outside of the request/task saving the event
+event_dispatcher.register('allocation_source_threshold_met',
+                          listen_for_allocation_thresholds_met,
+                          asynchronous=True)
+pre_save.connect(dispatch_pre_save, sender=EventTable)
+post_save.connect(dispatch_post_save, sender=EventTable)
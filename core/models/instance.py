@@ -8,7 +8,7 @@ from django.db import (
     models, transaction, DatabaseError
 )
 from django.db.models import (
-    Q, ObjectDoesNotExist
+    Q, ObjectDoesNotExist, Prefetch
 )
 from django.utils import timezone
 
@@ -101,6 +101,21 @@ class Instance(models.Model):
         membership_query = Q(created_by__memberships__group__user=user)
         return Instance.objects.filter(membership_query | project_query | ownership_query).distinct()
 
+    @staticmethod
+    def last_history_prefetch():
+        """
+        Prefetch the newest InstanceStatusHistory (and its status/size) of
+        each instance in a single query. Used by `get_last_history`.
+        """
+        from core.models import InstanceStatusHistory
+        newest_histories = InstanceStatusHistory.objects\
+            .select_related('status', 'size')\
+            .order_by('instance_id', '-start_date')\
+            .distinct('instance_id')
+        return Prefetch('instancestatushistory_set',
+                        queryset=newest_histories,
+                        to_attr='last_history_list')
+
     def get_total_hours(self):
         from service.monitoring import _get_allocation_result
         identity = self.created_by_identity
@@ -165,8 +180,12 @@ class Instance(models.Model):
         # except InstanceStatusHistory.DoesNotExist:
         # TODO: Profile current choice
         # FIXME: Move this call so that it happens inside InstanceStatusHistory to avoid circ.dep.
-        last_history = self.instancestatushistory_set.order_by(
-            '-start_date').first()
+        if hasattr(self, 'last_history_list'):
+            # Prefetched by `Instance.last_history_prefetch`
+            last_history = self.last_history_list[0] if self.last_history_list else None
+        else:
+            last_history = self.instancestatushistory_set.order_by(
+                '-start_date').first()
         if last_history:
             return last_history
         else:
@@ -175,6 +194,8 @@ class Instance(models.Model):
                 cpu=-1, mem=-1, root=-1, disk=-1)
             last_history = self._build_first_history(
                 'Unknown', unknown_size, self.start_date, self.end_date, True)
+            if hasattr(self, 'last_history_list'):
+                self.last_history_list = [last_history]
             logger.warn("No history existed for %s until now. "
                         "An 'Unknown' history was created" % self)
             return last_history
@@ -213,6 +234,8 @@ class Instance(models.Model):
         # FIXME: Move this call so that it happens inside InstanceStatusHistory to avoid circ.dep.
         from core.models import InstanceStatusHistory
         import traceback
+        # A new history is about to be created, drop the prefetched one
+        self.__dict__.pop('last_history_list', None)
         # 1. Get status name
         status_name = _get_status_name_for_provider(
             self.source.provider,
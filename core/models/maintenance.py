@@ -1,11 +1,19 @@
 import collections
+import threading
+import time
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
 from django.utils import timezone
 
 from core.models.user import AtmosphereUser as User
 from core.models.provider import Provider
+from service import pubsub
+
+MAINTENANCE_CHANNEL = "maintenance_records.changed"
+DEFAULT_MAINTENANCE_CACHE_TTL = 30
 
 
 class MaintenanceRecord(models.Model):
@@ -37,22 +45,26 @@ class MaintenanceRecord(models.Model):
             records = records.filter(Q(provider__isnull=True))
         return records
 
+    @classmethod
+    def active_global(cls):
+        """
+        Like `active()`, from the per-process `maintenance_windows` cache
+        """
+        return maintenance_windows.active()
+
     @classmethod
     def disable_login_access(cls, request):
-        disable_login = False
         if request and 'username' in request.session:
             username = request.session['username']
         else:
             #Username not in session - disable
             return True
+        if not any(record.disable_login for record in cls.active_global()):
+            return False
         user = User.objects.get(username=username)
         if user.is_staff or user.is_superuser:
             return False
-        records = MaintenanceRecord.active()
-        for record in records:
-            if record.disable_login:
-                disable_login = True
-        return disable_login
+        return True
 
     def json(self):
         json = {
@@ -77,3 +89,68 @@ class MaintenanceRecord(models.Model):
     class Meta:
         db_table = "maintenance_record"
         app_label = "core"
+
+
+class MaintenanceWindowCache(object):
+    """
+    The global maintenance records that have not ended yet, kept per process
+    for MAINTENANCE_CACHE_TTL seconds. Saving or deleting a record clears
+    the cache of every process, through a Redis publish.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = None
+        self.loaded = 0
+        # Records loaded while the cache was invalidated are dropped
+        self.generation = 0
+        self.listener = pubsub.ChannelListener(MAINTENANCE_CHANNEL)
+
+    def active(self, now=None):
+        ttl = getattr(settings, 'MAINTENANCE_CACHE_TTL', DEFAULT_MAINTENANCE_CACHE_TTL)
+        now = now or timezone.now()
+        if not ttl:
+            return list(MaintenanceRecord.active())
+        with self.lock:
+            if self._changed() or time.time() - self.loaded >= ttl:
+                self.records = None
+                self.generation += 1
+            records = self.records
+            generation = self.generation
+        if records is None:
+            records = list(MaintenanceRecord.objects.filter(
+                Q(provider__isnull=True),
+                Q(end_date__gt=now) | Q(end_date__isnull=True)))
+            with self.lock:
+                if generation == self.generation:
+                    self.records = records
+                    self.loaded = time.time()
+        return [record for record in records
+                if record.start_date <= now and (not record.end_date or record.end_date > now)]
+
+    def invalidate(self):
+        with self.lock:
+            self.records = None
+            self.generation += 1
+
+    def _changed(self):
+        """
+        True when a record changed since the last call (or Redis is unavailable)
+        """
+        messages = self.listener.messages()
+        return messages is None or bool(messages)
+
+
+maintenance_windows = MaintenanceWindowCache()
+
+
+def _publish_maintenance_change():
+    pubsub.publish(MAINTENANCE_CHANNEL, "changed")
+
+
+def invalidate_maintenance_windows(sender, instance, **kwargs):
+    maintenance_windows.invalidate()
+    transaction.on_commit(_publish_maintenance_change)
+
+
+post_save.connect(invalidate_maintenance_windows, sender=MaintenanceRecord)
+post_delete.connect(invalidate_maintenance_windows, sender=MaintenanceRecord)
@@ -4,10 +4,9 @@ Service Quota model for atmosphere.
 import uuid
 
 from django.conf import settings
-from django.db import models
-from django.core.exceptions import ValidationError
-
-from threepio import logger
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 
 # Default functions to be allow for dynamic-defaults
 # Values to the right will be used IF the configuration
@@ -161,212 +160,120 @@ class Quota(models.Model):
         app_label = 'core'
 
 
-def has_cpu_quota(driver, quota, new_size=0, raise_exc=True):
-    """
-    True if the total number of CPU cores found on
-    driver is less than or equal to Quota.cpu,
-    otherwise False.
-    """
-    # Always False if quota doesnt exist, new size is negative
-    if not quota or new_size < 0:
-        return False
-    # Always True if cpu is null
-    if not quota.cpu or quota.cpu < 0:
-        return True
-    total_size = new_size
-    _pre_cache_sizes(driver)
-    instances = driver.list_instances()
-    for inst in instances:
-        try:
-            total_size += inst.size._size.extra['cpu']
-        except AttributeError, KeyError:
-            # Instance running on an unknown size..
-            total_size += 1
-    if total_size <= quota.cpu:
-        return True
-    if raise_exc:
-        _raise_quota_error('CPU', total_size - new_size, new_size, quota.cpu)
-    return False
-
-
-def has_mem_quota(driver, quota, new_size=0, raise_exc=True):
-    """
-    True if the total amount of RAM found on driver is
-    less than or equal to Quota.mem, otherwise False.
-    """
-    # Always False if quota doesnt exist, new size is negative
-    if not quota or new_size < 0:
-        return False
-    # Always True if ram is null
-    if not quota.memory or quota.memory < 0:
-        return True
-    total_size = new_size/1024.0
-    _pre_cache_sizes(driver)
-    instances = driver.list_instances()
-    for inst in instances:
-        try:
-            total_size += inst.size._size.ram / 1024.0
-        except AttributeError, KeyError:
-            # Instance running on an unknown size..
-            total_size += 1
-    total_size = int(total_size)
-    if total_size <= quota.memory:
-        return True
-    if raise_exc:
-        _raise_quota_error('Memory', (total_size - new_size)/1024.0, new_size/1024.0, quota.memory)
-    return False
-
-
-def has_instance_count_quota(driver, quota, new_size=0, raise_exc=True):
-    """
-    True if the total number of instances found on driver are
-    greater than or equal to Quota.instance otherwise False.
-    """
-    # Always False if quota doesnt exist, new size is negative
-    if not quota or new_size < 0:
-        return False
-    # Always True if instance count is null
-    if not quota.instance_count or quota.instance_count < 0:
-        return True
-    total_size = new_size
-    total_size += len(driver.list_instances())
-    if total_size <= quota.instance_count:
-        return True
-    if raise_exc:
-        _raise_quota_error('Instance', total_size - new_size, new_size, quota.instance_count)
-    return False
-
-
-def has_port_count_quota(identity, driver, quota, new_size=0, raise_exc=True):
-    """
-    True if the total number of ports found on driver are
-    less than or equal to Quota.port_count, otherwise False.
-    """
-    # Always False if quota doesnt exist, new size is negative
-    if not quota or new_size < 0:
-        return False
-    # Always True if port_count is null
-    if not quota.port_count or quota.port_count < 0:
-        return True
-    # Consider it true if we fail to connect here
-    try:
-        from service.instance import _to_network_driver
-        network_driver = _to_network_driver(identity)
-        port_list = network_driver.list_ports()
-    except Exception as exc:
-        logger.warn("Could not verify quota due to failed call to network_driver.list_ports() - %s" % exc)
-        return True
-    project_id = network_driver.get_tenant_id()
-    fixed_ips = [port for port in port_list if
-                 'compute:' in port['device_owner'] and port.get('project_id', project_id) == project_id]
-    total_size = new_size
-    total_size += len(fixed_ips)
-    if total_size <= quota.port_count:
-        return True
-    if raise_exc:
-        _raise_quota_error('Fixed IP', total_size - new_size, new_size, quota.port_count)
-    return False
-
-
-def has_floating_ip_count_quota(driver, quota, new_size=0, raise_exc=True):
+class QuotaUsageLedger(models.Model):
     """
-    True if the total number of floating ips found on driver are
-    less than or equal to Quota.floating_ip_count, otherwise False.
+    Usage of an Identity, kept up to date by the launch/destroy paths
+    and reconciled against the cloud by the monitor tasks.
+    Lets quota checks skip the cloud (See `service.quota.check_quota_usage`)
     """
-   # Always False if quota doesnt exist, new size is negative
-    if not quota or new_size < 0:
-        return False
-    # Always True if floating_ip_count is null
-    if not quota.floating_ip_count or quota.floating_ip_count < 0:
-        return True
-    floating_ips = driver._connection.ex_list_floating_ips()
-    total_size = new_size
-    total_size += len(floating_ips)
-    if total_size <= quota.floating_ip_count:
-        return True
-    if raise_exc:
-        _raise_quota_error('Floating IP', total_size - new_size, new_size, quota.floating_ip_count)
-    return False
-
-
-def has_storage_quota(driver, quota, new_size=0, raise_exc=True):
-    """
-    True if the total volume size found on driver is
-    less than or equal to Quota.storage, otherwise False.
-    """
-    # Always False if quota doesnt exist, new size is negative
-    if not quota or new_size < 0:
-        return False
-    # Always True if storage is null
-    if not quota.storage:
-        return True
-    vols = driver.list_volumes()
-    total_size = new_size
-    for vol in vols:
-        total_size += vol.size
-    if total_size <= quota.storage:
-        return True
-    if raise_exc:
-        _raise_quota_error('Storage Size', total_size - new_size, new_size, quota.storage)
-    return False
-
-
-
-def has_snapshot_count_quota(driver, quota, new_size=0, raise_exc=True):
-    """
-    True if the total number of volumes found on driver are
-    greater than or equal to Quota.snapshot otherwise False.
-    """
-    # Always False if quota doesnt exist, new size is negative
-    if not quota or new_size < 0:
-        return False
-    # Always True if snapshot count is null
-    if not quota.snapshot_count or quota.snapshot_count < 0:
-        return True
-    total_size = new_size
-    total_size += len(driver._connection.ex_list_snapshots())
-    if total_size <= quota.snapshot_count:
-        return True
-    if raise_exc:
-        _raise_quota_error('Snapshot', total_size - new_size, new_size, quota.snapshot_count)
-    return False
-
-
-def has_storage_count_quota(driver, quota, new_size=0, raise_exc=True):
-    """
-    True if the total number of volumes found on driver are
-    greater than or equal to Quota.storage otherwise False.
-    """
-    # Always False if quota doesnt exist, new size is negative
-    if not quota or new_size < 0:
-        return False
-    # Always True if storage count is null
-    if not quota.storage_count:
-        return True
-    total_size = new_size
-    total_size += len(driver.list_volumes())
-    if total_size <= quota.storage_count:
-        return True
-    if raise_exc:
-        _raise_quota_error('Volume', total_size - new_size, new_size, quota.storage_count)
-    return False
-
-
-def _raise_quota_error(resource_name, current_count, new_count, limit_count):
-    raise ValidationError(
-        "%s Quota Exceeded: Using %s + Requested %s but limited to %s"
-        % (resource_name, current_count, new_count, limit_count))
-
-
-def _pre_cache_sizes(driver):
-    """
-    Pre-caching sizes is required to get 'extra' data from size,
-    rather than MockSize (default)
-    """
-    cached_sizes = driver.provider.sizeCls.sizes.get(driver.provider.identifier)
-    if not cached_sizes:
-        driver.list_sizes()
-    return
+    # Quota fields tracked by the ledger, and the monitor task reconciling them
+    RECONCILED_BY = {
+        'cpu': 'instances',
+        'memory': 'instances',
+        'instance_count': 'instances',
+        'storage': 'volumes',
+        'storage_count': 'volumes',
+    }
+    identity = models.OneToOneField("Identity", related_name="quota_usage",
+                                    on_delete=models.CASCADE)
+    cpu = models.IntegerField(default=0)
+    memory = models.FloatField(default=0)  # In GB
+    instance_count = models.IntegerField(default=0)
+    storage = models.IntegerField(default=0)  # In GB
+    storage_count = models.IntegerField(default=0)
+    instances_reconciled = models.DateTimeField(null=True, blank=True)
+    volumes_reconciled = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "%s - CPU:%s, Memory:%s GB, Instances #:%s Volume:%s GB Volume #:%s" % (
+            self.identity, self.cpu, self.memory, self.instance_count,
+            self.storage, self.storage_count)
+
+    @classmethod
+    def adjust(cls, identity, **deltas):
+        """
+        Add `deltas` (i.e. cpu=2, instance_count=1) to the ledger of identity,
+        and of the identities sharing its project.
+        Identities without a ledger are left alone until reconciled.
+        """
+        changes = dict((field, F(field) + amount)
+                       for field, amount in deltas.items() if amount)
+        if changes:
+            cls.objects.filter(identity__in=cls._project_identities(identity)).update(**changes)
+
+    @classmethod
+    def _project_identities(cls, identity):
+        """
+        The identities sharing the cloud project (and so the usage) of identity
+        """
+        project_name = identity.get_credential('ex_project_name')
+        if not project_name:
+            return [identity]
+        return identity.__class__.objects.filter(
+            provider_id=identity.provider_id,
+            credential__key='ex_project_name', credential__value=project_name)
+
+    @classmethod
+    def usage_for(cls, identity, fields, max_age):
+        """
+        Returns the usage of `fields` recorded for identity, for the fields
+        reconciled less than `max_age` ago.
+        """
+        ledger = cls.objects.filter(identity=identity).first()
+        if not ledger:
+            return {}
+        oldest = timezone.now() - max_age
+        usage = {}
+        for field in fields:
+            resource = cls.RECONCILED_BY.get(field)
+            if not resource:
+                continue
+            reconciled = getattr(ledger, '%s_reconciled' % resource)
+            if reconciled and reconciled >= oldest:
+                usage[field] = getattr(ledger, field)
+        return usage
+
+    @classmethod
+    def reconcile(cls, resource, cloud_usage, identities):
+        """
+        Replace the `resource` fields of every identity's ledger with the
+        usage found on the cloud.
+        param - cloud_usage - {identity_id: {field: value}}, identities without usage use 0
+        Returns the drift found: {identity_id: {field: (ledger, cloud)}}
+        """
+        fields = [field for field, reconciled_by in cls.RECONCILED_BY.items()
+                  if reconciled_by == resource]
+        reconciled = {'%s_reconciled' % resource: timezone.now()}
+        drift = {}
+        new_ledgers = []
+        with transaction.atomic():
+            ledgers = dict(
+                (ledger.identity_id, ledger) for ledger in
+                cls.objects.select_for_update().filter(identity__in=identities))
+            for identity in identities:
+                usage = dict((field, cloud_usage.get(identity.id, {}).get(field, 0))
+                             for field in fields)
+                ledger = ledgers.get(identity.id)
+                if not ledger:
+                    usage.update(reconciled)
+                    new_ledgers.append(cls(identity=identity, **usage))
+                    continue
+                differences = dict(
+                    (field, (getattr(ledger, field), value))
+                    for field, value in usage.items()
+                    if round(getattr(ledger, field), 3) != round(value, 3))
+                if differences:
+                    drift[identity.id] = differences
+                    cls.objects.filter(id=ledger.id).update(**usage)
+            cls.objects.filter(identity__in=ledgers.keys()).update(**reconciled)
+            cls.objects.bulk_create(new_ledgers)
+        return drift
+
+    class Meta:
+        db_table = 'quota_usage_ledger'
+        app_label = 'core'
+
 
 def get_quota(identity_uuid):
     try:
@@ -0,0 +1,326 @@
+"""
+Daily usage rollups of InstanceStatusHistory
+
+Reports that need CPU-hours for a month or a year can sum a few rollup rows
+(See `UsageRollup.usage`) instead of walking every status history.
+The rollups are maintained by `InstanceUsageRollup.build`, which only rolls
+up the days touched by new histories or by histories that were still open.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+import pytz
+from django.conf import settings
+from django.contrib.postgres.fields import JSONField
+from django.db import models, transaction
+from django.db.models import Max, Min, Q, Sum
+from django.utils import timezone
+from threepio import logger
+
+ALLOCATION_CHANGED_EVENT = "instance_allocation_source_changed"
+
+
+def day_start(day):
+    return datetime.combine(day, time.min).replace(tzinfo=pytz.utc)
+
+
+def utc_day(date):
+    return date.astimezone(pytz.utc).date()
+
+
+def _split_by_allocation_source(events, start, end):
+    """
+    Split [start, end) at the allocation source changes in `events`
+    (timestamp ordered (timestamp, allocation source name) pairs).
+    Yields (allocation source name, start, end)
+    """
+    source = None
+    for timestamp, name in events:
+        if timestamp > start:
+            break
+        source = name
+    for timestamp, name in events:
+        if timestamp <= start:
+            continue
+        if timestamp >= end:
+            break
+        yield source, start, timestamp
+        source, start = name, timestamp
+    yield source, start, end
+
+
+def rollup_instance(histories, events, first_day, now):
+    """
+    Roll up the histories of an instance, from `first_day` on.
+    param - histories - (start_date, end_date, status name, cpu)
+    param - events - timestamp ordered (timestamp, allocation source name)
+    Returns {(day, allocation source name): usage}
+    """
+    rollups = {}
+    first_start = day_start(first_day)
+    for start_date, end_date, status_name, cpu in histories:
+        closed = end_date is not None
+        start_date = max(start_date, first_start)
+        end_date = min(end_date or now, now)
+        if end_date <= start_date:
+            continue
+        day = utc_day(start_date)
+        while day_start(day) < end_date:
+            next_day = day + timedelta(days=1)
+            parts = _split_by_allocation_source(
+                events, max(start_date, day_start(day)),
+                min(end_date, day_start(next_day)))
+            for source, part_start, part_end in parts:
+                usage = rollups.setdefault((day, source), {
+                    'cpu_seconds': 0.0, 'active_seconds': 0.0,
+                    'status_counts': {}, 'complete': True})
+                usage['status_counts'][status_name] = \
+                    usage['status_counts'].get(status_name, 0) + 1
+                if status_name == 'active':
+                    seconds = (part_end - part_start).total_seconds()
+                    usage['active_seconds'] += seconds
+                    usage['cpu_seconds'] += seconds * max(cpu or 0, 0)
+                # Past days can not change while the history stays open
+                if not closed and day_start(next_day) > now:
+                    usage['complete'] = False
+            day = next_day
+    return rollups
+
+
+class UsageRollup(models.Model):
+    day = models.DateField(db_index=True)  # UTC
+    # Seconds spent 'active', times the CPUs of the size for cpu_seconds
+    cpu_seconds = models.FloatField(default=0)
+    active_seconds = models.FloatField(default=0)
+    # Number of histories of each status during the day
+    status_counts = JSONField(default=dict)
+
+    @classmethod
+    def usage(cls, start_day, end_day, **filters):
+        """
+        Total usage of the days in [start_day, end_day), i.e.
+        `UserUsageRollup.usage(date(2017, 1, 1), date(2018, 1, 1), user=user)`
+        """
+        totals = cls.objects.filter(
+            day__gte=start_day, day__lt=end_day, **filters
+        ).aggregate(cpu_seconds=Sum('cpu_seconds'),
+                    active_seconds=Sum('active_seconds'))
+        return dict((key, value or 0.0) for key, value in totals.items())
+
+    class Meta:
+        abstract = True
+
+
+class InstanceUsageRollup(UsageRollup):
+    """
+    Usage of an instance during a day, charged to an allocation source
+    (according to the 'instance_allocation_source_changed' events)
+    """
+    instance = models.ForeignKey("Instance", related_name="usage_rollups",
+                                 on_delete=models.CASCADE)
+    allocation_source = models.ForeignKey(
+        "AllocationSource", null=True, blank=True, on_delete=models.SET_NULL)
+    # False while the day is not over and one of its histories is open
+    complete = models.BooleanField(default=False, db_index=True)
+
+    def __unicode__(self):
+        return "%s on %s - %s CPU seconds" % (
+            self.instance, self.day, self.cpu_seconds)
+
+    @classmethod
+    def build(cls, now=None, batch_size=None):
+        """
+        Roll up the days of every instance with a new history since the
+        last build, from the day of its first new history. Instances with an
+        open history are rolled up again from the day of the last build.
+        Returns the UsageRollupBuild recording this build.
+        """
+        from core.models.instance_history import InstanceStatusHistory
+        now = now or timezone.now()
+        batch_size = batch_size or getattr(settings, 'USAGE_ROLLUP_BATCH_SIZE', 500)
+        last_build = UsageRollupBuild.objects.order_by('-id').first()
+        last_history_id = last_build.last_history_id if last_build else 0
+        max_history_id = InstanceStatusHistory.objects.aggregate(
+            max_id=Max('id'))['max_id'] or 0
+
+        # The first day to roll up again, for each instance
+        first_days = {}
+        new_histories = InstanceStatusHistory.objects.filter(
+            id__gt=last_history_id, id__lte=max_history_id
+        ).values('instance_id').annotate(first_start=Min('start_date'))
+        for row in new_histories:
+            first_days[row['instance_id']] = utc_day(row['first_start'])
+        incomplete = cls.objects.filter(complete=False).values(
+            'instance_id').annotate(first_day=Min('day'))
+        for row in incomplete:
+            instance_id = row['instance_id']
+            first_days[instance_id] = min(
+                row['first_day'], first_days.get(instance_id, row['first_day']))
+        # Open histories keep adding to the days since the last build
+        if last_build:
+            last_day = utc_day(last_build.started)
+            open_instances = InstanceStatusHistory.objects.filter(
+                end_date__isnull=True, id__lte=max_history_id
+            ).values_list('instance_id', flat=True).distinct()
+            for instance_id in open_instances:
+                first_days[instance_id] = min(last_day, first_days.get(instance_id, last_day))
+
+        # Instances with close first days share a batch
+        instance_ids = sorted(first_days, key=lambda key: (first_days[key], key))
+        user_first_days = {}
+        for index in xrange(0, len(instance_ids), batch_size):
+            batch = dict((instance_id, first_days[instance_id])
+                         for instance_id in instance_ids[index:index + batch_size])
+            for user_id, first_day in cls._build_batch(batch, now).items():
+                user_first_days[user_id] = min(
+                    first_day, user_first_days.get(user_id, first_day))
+        UserUsageRollup.build(user_first_days, batch_size)
+        build = UsageRollupBuild.objects.create(
+            last_history_id=max_history_id, started=now,
+            instance_count=len(first_days), user_count=len(user_first_days))
+        logger.info("Rolled up the usage of %s instances and %s users in %s",
+                    build.instance_count, build.user_count, build.finished - now)
+        return build
+
+    @classmethod
+    def _build_batch(cls, first_days, now):
+        """
+        Replace the rollups of each instance from its first day on.
+        Returns the first day rolled up for each owner {user_id: day}
+        """
+        from core.models.allocation_source import AllocationSource
+        from core.models.event_table import EventTable
+        from core.models.instance import Instance
+        from core.models.instance_history import InstanceStatusHistory
+        batch_start = day_start(min(first_days.values()))
+        instances = dict(
+            (instance_id, (provider_alias, user_id, username))
+            for instance_id, provider_alias, user_id, username in
+            Instance.objects.filter(id__in=first_days).values_list(
+                'id', 'provider_alias', 'created_by_id', 'created_by__username'))
+        histories = defaultdict(list)
+        history_rows = InstanceStatusHistory.objects.filter(
+            Q(end_date__isnull=True) | Q(end_date__gt=batch_start),
+            instance_id__in=first_days,
+        ).order_by('start_date', 'id').values_list(
+            'instance_id', 'start_date', 'end_date', 'status__name', 'size__cpu')
+        for instance_id, start_date, end_date, status_name, cpu in history_rows:
+            histories[instance_id].append((start_date, end_date, status_name, cpu))
+        aliases = dict((provider_alias, instance_id) for instance_id, (provider_alias, _, _)
+                       in instances.items())
+        events = defaultdict(list)
+        event_rows = EventTable.objects.filter(
+            name=ALLOCATION_CHANGED_EVENT, payload__instance_id__in=list(aliases)
+        ).order_by('timestamp').values_list('timestamp', 'entity_id', 'payload')
+        for timestamp, entity_id, payload in event_rows:
+            instance_id = aliases[payload['instance_id']]
+            username = instances[instance_id][2]
+            # Like `service.allocation_logic`, only the owner's events count
+            if payload.get('username') == username or entity_id == username:
+                events[instance_id].append(
+                    (timestamp, payload.get('allocation_source_name')))
+        allocation_sources = dict(AllocationSource.objects.values_list('name', 'id'))
+
+        rollups = []
+        user_first_days = {}
+        for instance_id, first_day in first_days.items():
+            if instance_id not in instances:
+                continue
+            user_id = instances[instance_id][1]
+            user_first_days[user_id] = min(first_day, user_first_days.get(user_id, first_day))
+            instance_rollups = rollup_instance(
+                histories[instance_id], events[instance_id], first_day, now)
+            for (day, source_name), usage in instance_rollups.items():
+                rollups.append(cls(
+                    instance_id=instance_id, day=day,
+                    allocation_source_id=allocation_sources.get(source_name),
+                    **usage))
+        with transaction.atomic():
+            stale = Q()
+            for instance_id, first_day in first_days.items():
+                stale |= Q(instance_id=instance_id, day__gte=first_day)
+            cls.objects.filter(stale).delete()
+            cls.objects.bulk_create(rollups)
+        return user_first_days
+
+    class Meta:
+        db_table = "instance_usage_rollup"
+        app_label = "core"
+        index_together = (("instance", "day"),)
+
+
+class UserUsageRollup(UsageRollup):
+    """
+    Usage of all the instances of a user during a day
+    """
+    user = models.ForeignKey("AtmosphereUser", related_name="usage_rollups",
+                             on_delete=models.CASCADE)
+    instance_count = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s on %s - %s CPU seconds" % (
+            self.user, self.day, self.cpu_seconds)
+
+    @classmethod
+    def build(cls, first_days, batch_size=500):
+        """
+        Replace the rollups of each user from its first day on
+        (summing the InstanceUsageRollups of the user's instances)
+        param - first_days - {user_id: day}
+        """
+        user_ids = sorted(first_days, key=lambda key: (first_days[key], key))
+        for index in xrange(0, len(user_ids), batch_size):
+            batch = user_ids[index:index + batch_size]
+            batch_start = min(first_days[user_id] for user_id in batch)
+            rollups = {}
+            instance_rows = InstanceUsageRollup.objects.filter(
+                instance__created_by_id__in=batch, day__gte=batch_start
+            ).values_list('instance__created_by_id', 'day', 'instance_id',
+                          'cpu_seconds', 'active_seconds', 'status_counts')
+            for user_id, day, instance_id, cpu_seconds, active_seconds, status_counts in instance_rows:
+                if day < first_days[user_id]:
+                    continue
+                rollup = rollups.get((user_id, day))
+                if not rollup:
+                    rollup = rollups[(user_id, day)] = cls(
+                        user_id=user_id, day=day, status_counts={})
+                    rollup.instances = set()
+                rollup.cpu_seconds += cpu_seconds
+                rollup.active_seconds += active_seconds
+                rollup.instances.add(instance_id)
+                for status_name, count in status_counts.items():
+                    rollup.status_counts[status_name] = \
+                        rollup.status_counts.get(status_name, 0) + count
+            for rollup in rollups.values():
+                rollup.instance_count = len(rollup.instances)
+            with transaction.atomic():
+                stale = Q()
+                for user_id in batch:
+                    stale |= Q(user_id=user_id, day__gte=first_days[user_id])
+                cls.objects.filter(stale).delete()
+                cls.objects.bulk_create(rollups.values())
+
+    class Meta:
+        db_table = "user_usage_rollup"
+        app_label = "core"
+        unique_together = (("user", "day"),)
+
+
+class UsageRollupBuild(models.Model):
+    """
+    A run of `InstanceUsageRollup.build`. Histories up to `last_history_id`
+    are rolled up, the next build starts after it.
+    """
+    last_history_id = models.IntegerField()
+    started = models.DateTimeField()
+    finished = models.DateTimeField(auto_now_add=True)
+    instance_count = models.IntegerField(default=0)
+    user_count = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "Usage rollup up to history %s (%s)" % (
+            self.last_history_id, self.finished)
+
+    class Meta:
+        db_table = "usage_rollup_build"
+        app_label = "core"
@@ -136,6 +136,9 @@ class Volume(BaseSource):
         return self.get_status()
 
     def _get_last_history(self):
+        if hasattr(self, 'last_history_list'):
+            # Prefetched by `convert_known_esh_volumes`
+            return self.last_history_list[0] if self.last_history_list else None
         last_history = self.volumestatushistory_set.all()\
                                                    .order_by('-start_date')
         if not last_history:
@@ -208,6 +211,60 @@ def convert_esh_volume(esh_volume, provider_uuid, identity_uuid=None, user=None)
     return volume
 
 
+def convert_known_esh_volumes(esh_volumes, provider):
+    """
+    `convert_esh_volume` for each of esh_volumes already known on provider,
+    in bulk: the volumes and their last histories are read with two
+    queries, and the volumes whose status changed are updated together.
+    Returns (the core volumes, the esh_volumes not known on provider)
+    """
+    volumes = dict(
+        (volume.instance_source.identifier, volume) for volume in
+        Volume.objects.filter(instance_source__provider=provider).select_related('instance_source'))
+    last_histories = dict(
+        (history.volume_id, history) for history in
+        VolumeStatusHistory.objects.filter(volume__instance_source__provider=provider)
+        .order_by('volume_id', '-start_date').distinct('volume_id').select_related('status'))
+    now = timezone.now()
+    statuses = {}
+    known_volumes, unknown_esh_volumes = [], []
+    living_source_ids, ended_history_ids, new_histories = [], [], []
+    for esh_volume in esh_volumes:
+        volume = volumes.get(esh_volume.id)
+        if not volume:
+            unknown_esh_volumes.append(esh_volume)
+            continue
+        known_volumes.append(volume)
+        volume.esh = esh_volume
+        last_history = last_histories.get(volume.id)
+        if last_history:
+            last_history.volume = volume
+        volume.last_history_list = [last_history] if last_history else []
+        status = volume.get_status()
+        if status == VolumeStatus.UNKNOWN:
+            continue
+        # This is a living volume!
+        if volume.end_date:
+            volume.end_date = None
+            living_source_ids.append(volume.instance_source_id)
+        if not volume._should_update(last_history):
+            continue
+        if status not in statuses:
+            statuses[status], _ = VolumeStatus.objects.get_or_create(name=status)
+        new_history = VolumeStatusHistory(
+            volume=volume, status=statuses[status], device=volume.get_device(),
+            instance_alias=volume.get_instance_alias(), start_date=now)
+        new_histories.append(new_history)
+        if last_history:
+            ended_history_ids.append(last_history.id)
+        volume.last_history_list = [new_history]
+    with transaction.atomic():
+        InstanceSource.objects.filter(id__in=living_source_ids).update(end_date=None)
+        VolumeStatusHistory.objects.filter(id__in=ended_history_ids).update(end_date=now)
+        VolumeStatusHistory.objects.bulk_create(new_histories)
+    return known_volumes, unknown_esh_volumes
+
+
 def create_volume(name, identifier, size, provider_uuid, identity_uuid,
                   creator, description=None, created_on=None):
     provider = Provider.objects.get(uuid=provider_uuid)
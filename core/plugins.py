@@ -1,18 +1,208 @@
 import inspect
+import threading
+import time
+from collections import OrderedDict, defaultdict
 
 from django.utils.module_loading import import_string
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 from threepio import logger
 
+from service import pubsub
+
+DEFAULT_PLUGIN_DECISION_CACHE_TTL = 60
+DEFAULT_PLUGIN_DECISION_CACHE_SIZE = 10000
+PLUGIN_DECISIONS_CHANNEL = "plugin_decisions.invalidated"
+
+plugin_metrics_lock = threading.Lock()
+plugin_metrics = defaultdict(lambda: {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+
 
 def load_plugin_class(plugin_path):
     return import_string(plugin_path)
 
 
+def check_plugin_method(PluginClass, method_name, kwarg_names):
+    """
+    Log plugins missing `method_name`, or whose method does not accept
+    the keyword arguments `kwarg_names`
+    """
+    method = getattr(PluginClass, method_name, None)
+    if not method:
+        logger.info("Plugin %s missing method '%s'", PluginClass, method_name)
+        return False
+    try:
+        inspect.getcallargs(method, None,
+                            **dict.fromkeys(kwarg_names))
+    except TypeError:
+        logger.info("Plugin %s method '%s' does not accept kwargs %s",
+                    PluginClass, method_name, ", ".join(kwarg_names))
+        return False
+    return True
+
+
+class PluginRegistry(object):
+    """
+    Plugin classes, imported and checked once per list of dotted paths
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.resolved = {}
+
+    def resolve(self, list_of_classes, method_name=None, kwarg_names=()):
+        key = (tuple(list_of_classes), method_name)
+        plugin_class_list = self.resolved.get(key)
+        if plugin_class_list is None:
+            plugin_class_list = [load_plugin_class(plugin_path)
+                                 for plugin_path in list_of_classes]
+            if method_name:
+                for PluginClass in plugin_class_list:
+                    check_plugin_method(PluginClass, method_name, kwarg_names)
+            with self.lock:
+                self.resolved[key] = plugin_class_list
+        return plugin_class_list
+
+    def clear(self):
+        with self.lock:
+            self.resolved.clear()
+
+
+class PluginDecisionCache(object):
+    """
+    Per-user plugin decisions (i.e. whether a user is valid), kept for
+    PLUGIN_DECISION_CACHE_TTL seconds. Once PLUGIN_DECISION_CACHE_SIZE
+    decisions are cached, the least recently used are dropped.
+    Decisions are cached per list of plugins, so reassigning a manager's
+    `list_of_classes` takes effect at once. Invalidations are shared with
+    every process through a Redis publish.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.decisions = OrderedDict()
+        self.decision_kinds = set()
+        # A decision is only stored if its user (or every user, for the
+        # epoch) was not invalidated while it was being made
+        self.epoch = 0
+        self.generations = defaultdict(int)
+        self.listener = pubsub.ChannelListener(PLUGIN_DECISIONS_CHANNEL)
+
+    def get_or_decide(self, decision_name, user, decide, list_of_classes=(), force=False):
+        ttl = getattr(settings, 'PLUGIN_DECISION_CACHE_TTL', DEFAULT_PLUGIN_DECISION_CACHE_TTL)
+        user_id = getattr(user, 'pk', None)
+        if not ttl or user_id is None:
+            return decide()
+        kind = (decision_name, tuple(list_of_classes))
+        key = kind + (user_id,)
+        with self.lock:
+            invalidated = self._invalidated()
+            if invalidated is None:
+                self._forget()
+            for invalidated_id in invalidated or []:
+                self._forget(invalidated_id)
+            cached = self.decisions.pop(key, None)
+            if cached and not force and time.time() - cached[1] < ttl:
+                self.decisions[key] = cached
+                _record_metric('%s.cache_hits' % decision_name)
+                return cached[0]
+            generation = (self.epoch, self.generations[user_id])
+        _record_metric('%s.cache_misses' % decision_name)
+        decision = decide()
+        size = getattr(settings, 'PLUGIN_DECISION_CACHE_SIZE', DEFAULT_PLUGIN_DECISION_CACHE_SIZE)
+        with self.lock:
+            if generation == (self.epoch, self.generations[user_id]):
+                self.decisions[key] = (decision, time.time())
+                self.decision_kinds.add(kind)
+                while len(self.decisions) > size:
+                    self.decisions.popitem(last=False)
+        return decision
+
+    def invalidate(self, user_id=None):
+        """
+        Forget the decisions about `user_id` (or about every user)
+        """
+        with self.lock:
+            self._forget(user_id)
+
+    def _forget(self, user_id=None):
+        if user_id is None:
+            self.epoch += 1
+            self.decisions.clear()
+            return
+        self.generations[user_id] += 1
+        for kind in self.decision_kinds:
+            self.decisions.pop(kind + (user_id,), None)
+
+    def _invalidated(self):
+        """
+        The ids of users invalidated by other processes since the last call,
+        or None when every user is (or Redis is unavailable)
+        """
+        user_ids = self.listener.messages()
+        if user_ids is None or '*' in user_ids:
+            return None
+        return [int(user_id) for user_id in user_ids]
+
+
+def publish_invalidation(user_id=None):
+    """
+    Make every process forget its decisions about `user_id` (or about every user)
+    """
+    pubsub.publish(PLUGIN_DECISIONS_CHANNEL, '*' if user_id is None else user_id)
+
+
+plugin_registry = PluginRegistry()
+plugin_decisions = PluginDecisionCache()
+
+
+def _record_metric(name, seconds=None):
+    with plugin_metrics_lock:
+        metric = plugin_metrics[name]
+        metric['calls'] += 1
+        if seconds is not None:
+            metric['seconds'] += seconds
+            metric['max_seconds'] = max(metric['max_seconds'], seconds)
+
+
+def call_plugin(plugin, method_name, **kwargs):
+    """
+    Call `plugin.method_name(**kwargs)`, recording its latency
+    """
+    started = time.time()
+    try:
+        return getattr(plugin, method_name)(**kwargs)
+    finally:
+        PluginClass = plugin.__class__
+        _record_metric("%s.%s.%s" % (PluginClass.__module__, PluginClass.__name__, method_name),
+                       time.time() - started)
+
+
+def get_plugin_metrics():
+    """
+    Returns the calls and latency of each plugin method, and the
+    hits/misses of the decision cache
+    """
+    with plugin_metrics_lock:
+        return dict((name, dict(metric)) for name, metric in plugin_metrics.items())
+
+
+def resolve_plugins():
+    """
+    Import and check the plugins of every manager (at startup),
+    so configuration errors are logged before the first request
+    """
+    for manager in PluginListManager.__subclasses__():
+        try:
+            manager.load_plugins(manager.list_of_classes)
+        except (ImportError, ImproperlyConfigured):
+            logger.exception("Could not load the plugins of %s", manager.__name__)
+
+
 class PluginListManager(object):
     plugin_required = False
     plugin_required_message = "At least one plugin is required."
+    # The plugin method (and its keyword arguments) called by the manager
+    plugin_method = None
+    plugin_kwargs = ()
 
     @classmethod
     def load_plugins(cls, list_of_classes):
@@ -21,10 +211,8 @@ class PluginListManager(object):
         usually based on a list of strings in
         the local.py settings file.
         """
-        plugin_class_list = []
-        for plugin_path in list_of_classes:
-            fn = load_plugin_class(plugin_path)
-            plugin_class_list.append(fn)
+        plugin_class_list = plugin_registry.resolve(
+            list_of_classes, cls.plugin_method, cls.plugin_kwargs)
         if cls.plugin_required and not plugin_class_list:
             raise ImproperlyConfigured(
                     cls.plugin_required_message)
@@ -37,6 +225,8 @@ class DefaultQuotaPluginManager(PluginListManager):
     """
     list_of_classes = getattr(settings, 'DEFAULT_QUOTA_PLUGINS', [])
     plugin_required = False
+    plugin_method = 'get_default_quota'
+    plugin_kwargs = ('user', 'provider')
 
     @classmethod
     def default_quota(cls, user, provider):
@@ -46,19 +236,7 @@ class DefaultQuotaPluginManager(PluginListManager):
         _default_quota = None
         for DefaultQuotaPlugin in cls.load_plugins(cls.list_of_classes):
             plugin = DefaultQuotaPlugin()
-            try:
-                inspect.getcallargs(
-                    getattr(plugin, 'get_default_quota'),
-                    user=user, provider=provider)
-            except AttributeError:
-                logger.info(
-                    "Validation plugin %s missing method 'get_default_quota'"
-                    % DefaultQuotaPlugin)
-            except TypeError:
-                logger.info(
-                    "Validation plugin %s does not accept kwargs `user` & `provider`"
-                    % DefaultQuotaPlugin)
-            _default_quota = plugin.get_default_quota(user=user, provider=provider)
+            _default_quota = call_plugin(plugin, 'get_default_quota', user=user, provider=provider)
             if _default_quota:
                 return _default_quota
         return _default_quota
@@ -70,6 +248,8 @@ class AllocationSourcePluginManager(PluginListManager):
     """
     list_of_classes = getattr(settings, 'ALLOCATION_SOURCE_PLUGINS', [])
     plugin_required = True  # For now...
+    plugin_method = 'ensure_user_allocation_source'
+    plugin_kwargs = ('user', 'provider')
 
     @classmethod
     def ensure_user_allocation_sources(cls, user, provider=None):
@@ -86,19 +266,8 @@ class AllocationSourcePluginManager(PluginListManager):
         _has_valid_allocation_sources = False
         for AllocationSourcePlugin in cls.load_plugins(cls.list_of_classes):
             plugin = AllocationSourcePlugin()
-            try:
-                inspect.getcallargs(
-                    getattr(plugin, 'ensure_user_allocation_source'),
-                    user=user, provider=provider)
-            except AttributeError:
-                logger.info(
-                    "Allocation Source plugin %s missing method 'ensure_user_allocation_source'",
-                    AllocationSourcePlugin)
-            except TypeError:
-                logger.info(
-                    "Allocation Source plugin %s does not accept kwargs `user` & `provider`",
-                    AllocationSourcePlugin)
-            _has_valid_allocation_sources = plugin.ensure_user_allocation_source(user=user, provider=provider)
+            _has_valid_allocation_sources = call_plugin(
+                plugin, 'ensure_user_allocation_source', user=user, provider=provider)
             if _has_valid_allocation_sources:
                 return _has_valid_allocation_sources
         return _has_valid_allocation_sources
@@ -158,28 +327,26 @@ class ValidationPluginManager(PluginListManager):
 If all users are considered valid,
 please set settings.VALIDATION_PLUGINS to:
 ('atmosphere.plugins.auth.validation.AlwaysAllow',)"""
+    plugin_method = 'validate_user'
+    plugin_kwargs = ('user',)
 
     @classmethod
-    def is_valid(cls, user):
+    def is_valid(cls, user, force=False):
         """
         Load each ValidationPlugin and call `plugin.validate_user(user)`
+        (the decision is cached, unless `force`)
         """
+        list_of_classes = cls.list_of_classes
+        return plugin_decisions.get_or_decide(
+            'is_valid', user, lambda: cls._is_valid(user, list_of_classes),
+            list_of_classes=list_of_classes, force=force)
+
+    @classmethod
+    def _is_valid(cls, user, list_of_classes):
         _is_valid = False
-        for ValidationPlugin in cls.load_plugins(cls.list_of_classes):
+        for ValidationPlugin in cls.load_plugins(list_of_classes):
             plugin = ValidationPlugin()
-            try:
-                inspect.getcallargs(
-                    getattr(plugin, 'validate_user'),
-                    user=user)
-            except AttributeError:
-                logger.info(
-                    "Validation plugin %s missing method 'validate_user'"
-                    % ValidationPlugin)
-            except TypeError:
-                logger.info(
-                    "Validation plugin %s does not accept kwarg `user`"
-                    % ValidationPlugin)
-            _is_valid = plugin.validate_user(user=user)
+            _is_valid = call_plugin(plugin, 'validate_user', user=user)
             if _is_valid:
                 return True
         return _is_valid
@@ -194,29 +361,28 @@ class ExpirationPluginManager(PluginListManager):
     For that, see ValidationPlugin
     """
     list_of_classes = getattr(settings, 'EXPIRATION_PLUGINS', [])
+    plugin_method = 'is_expired'
+    plugin_kwargs = ('user',)
 
     @classmethod
-    def is_expired(cls, user):
+    def is_expired(cls, user, force=False):
         """
         Load each ExpirationPlugin and call `plugin.is_expired(user)`
+        (the decision is cached, unless `force`)
         """
+        list_of_classes = cls.list_of_classes
+        return plugin_decisions.get_or_decide(
+            'is_expired', user, lambda: cls._is_expired(user, list_of_classes),
+            list_of_classes=list_of_classes, force=force)
+
+    @classmethod
+    def _is_expired(cls, user, list_of_classes):
         _is_expired = False
-        for ExpirationPlugin in cls.load_plugins(cls.list_of_classes):
+        for ExpirationPlugin in cls.load_plugins(list_of_classes):
             plugin = ExpirationPlugin()
-            try:
-                inspect.getcallargs(
-                    getattr(plugin, 'is_expired'),
-                    user=user)
-            except AttributeError:
-                logger.info(
-                    "Expiration plugin %s does not have a 'is_expired' method"
-                    % ExpirationPlugin)
-            except TypeError:
-                logger.info("Expiration plugin %s does not accept kwarg `user`"
-                            % ExpirationPlugin)
             try:
                 # TODO: Set a reasonable timeout but don't let it hold this indefinitely
-                _is_expired = plugin.is_expired(user=user)
+                _is_expired = call_plugin(plugin, 'is_expired', user=user)
             except Exception as exc:
                 logger.info("Expiration plugin %s encountered an error: %s" % (ExpirationPlugin, exc))
                 _is_expired = True
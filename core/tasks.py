@@ -12,9 +12,7 @@ from atmosphere import settings
 from threepio import celery_logger, email_logger
 
 from core.models.status_type import get_status_type
-from core.models.application import Application
-from core.query import only_current_apps
-from core.metrics.application import get_application_metrics
+from core.metrics.application import refresh_application_metrics
 
 
 @task(name="send_email")
@@ -66,16 +64,68 @@ def set_request_as_failed(request):
 
 
 @task(name='generate_metrics')
-def generate_metrics():
-    nowtime = timezone.now()
-    all_apps = Application.objects.filter(only_current_apps()).distinct().order_by('id')
-    for app in all_apps:
-        generate_metrics_for.apply_async(args=[app.id, app.name, nowtime])
-    return True
-
-
-@task(name='generate_metrics_for')
-def generate_metrics_for(application_id, application_name, nowtime):
-    app = Application.objects.get(id=application_id)
-    app_metrics = get_application_metrics(app, nowtime)
-    return app_metrics
+def generate_metrics(full=False):
+    """
+    Refresh the newest ApplicationMetric buckets of every application
+    """
+    return refresh_application_metrics(timezone.now(), full=full)
+
+
+@task(name='check_allocation_checkpoints')
+def check_allocation_checkpoints(tolerance=1.0):
+    """
+    Recalculate every UserAllocationCheckpoint from scratch.
+    Inconsistent checkpoints are removed, so the next snapshot update
+    rebuilds them from the start of the allocation period.
+    """
+    from core.models import UserAllocationCheckpoint
+    inconsistent = [checkpoint.id for checkpoint in
+                    UserAllocationCheckpoint.objects.select_related('user', 'allocation_source')
+                    if not checkpoint.is_consistent(tolerance=tolerance)]
+    if inconsistent:
+        celery_logger.warn("Removing %s inconsistent allocation checkpoints" % len(inconsistent))
+        UserAllocationCheckpoint.objects.filter(id__in=inconsistent).delete()
+    return len(inconsistent)
+
+
+@task(name='deliver_events', default_retry_delay=60, max_retries=10)
+def deliver_events(event_name):
+    """
+    Hand the pending `event_name` events to their asynchronous hooks
+    """
+    from core.hooks.dispatcher import event_dispatcher
+    from core.models import EventDelivery
+    delivered = {}
+    try:
+        for handler in event_dispatcher.async_handlers_for(event_name):
+            delivered[handler.__name__] = EventDelivery.deliver_pending(handler)
+    except Exception as exc:
+        celery_logger.exception("Could not deliver %s events" % event_name)
+        deliver_events.retry(exc=exc)
+    celery_logger.info("Delivered %s events: %s" % (event_name, delivered))
+    return delivered
+
+
+@task(name='deliver_pending_events')
+def deliver_pending_events():
+    """
+    Schedule the delivery of events whose `deliver_events` task was lost
+    (i.e. the broker was unavailable when the event was saved)
+    """
+    from core.models import EventDelivery
+    event_names = EventDelivery.objects.filter(delivered__isnull=True)\
+        .values_list('event__name', flat=True).distinct()
+    for event_name in event_names:
+        deliver_events.apply_async(args=[event_name])
+    return list(event_names)
+
+
+@task(name='build_usage_rollups')
+def build_usage_rollups():
+    """
+    Roll up the daily usage of instances with new or still open histories
+    """
+    from core.models import InstanceUsageRollup
+    build = InstanceUsageRollup.build()
+    return {'instances': build.instance_count, 'users': build.user_count,
+            'last_history_id': build.last_history_id}
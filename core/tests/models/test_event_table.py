@@ -1,10 +1,15 @@
 from unittest import skip
 
+import mock
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from api.tests.factories import UserFactory
 from core.models import EventTable, AllocationSource
-from core.models import UserAllocationSource
+from core.models import UserAllocationSource, EventDelivery
+from core.hooks import allocation_source
+from core.hooks.dispatcher import event_dispatcher, PRE_SAVE
 
 
 class EventTableTest(TestCase):
@@ -36,3 +41,92 @@ class EventTableTest(TestCase):
         self.assertEqual(events[0].payload, {'actual_value': 10,
                                              'allocation_source_name': alloc_src.name,
                                              'threshold': 10})
+
+
+class EventDispatcherTest(TestCase):
+    def setUp(self):
+        self.handled = []
+        event_dispatcher.register('test_event', self.listen_for_test_event)
+        event_dispatcher.register('test_event', self.listen_before_test_event, signal=PRE_SAVE)
+        self.addCleanup(event_dispatcher.unregister, 'test_event', self.listen_for_test_event)
+        self.addCleanup(event_dispatcher.unregister, 'test_event', self.listen_before_test_event,
+                        signal=PRE_SAVE)
+        event_dispatcher.reset_stats()
+
+    def listen_before_test_event(self, sender, instance, raw, **kwargs):
+        self.handled.append(('pre_save', instance.entity_id, instance.pk))
+
+    def listen_for_test_event(self, sender, instance, created, **kwargs):
+        self.handled.append(('post_save', instance.entity_id, created))
+
+    def test_only_handlers_for_the_event_name_are_called(self):
+        EventTable.create_event('test_event', {}, 'first')
+        EventTable.create_event('other_test_event', {}, 'second')
+        self.assertEqual(self.handled, [('pre_save', 'first', None),
+                                        ('post_save', 'first', True)])
+        stats = event_dispatcher.stats()
+        self.assertEqual(len(stats), 2)
+        self.assertTrue(all(metrics['calls'] == 1 for metrics in stats.values()))
+
+    def test_create_events(self):
+        with CaptureQueriesContext(connection) as queries:
+            events = EventTable.create_events([
+                ('test_event', {}, 'first'),
+                ('other_test_event', {}, 'second'),
+                ('test_event', {}, 'third')])
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertEqual([event.entity_id for event in events], ['first', 'second', 'third'])
+        self.assertEqual(EventTable.objects.count(), 3)
+        self.assertEqual(self.handled, [('pre_save', 'first', None),
+                                        ('pre_save', 'third', None),
+                                        ('post_save', 'first', True),
+                                        ('post_save', 'third', True)])
+
+
+class AsyncEventDeliveryTest(TestCase):
+    def setUp(self):
+        self.batches = []
+        event_dispatcher.register('test_event', self.listen_for_test_events, asynchronous=True)
+        self.addCleanup(event_dispatcher.unregister, 'test_event', self.listen_for_test_events)
+
+    def listen_for_test_events(self, events):
+        self.batches.append([event.entity_id for event in events])
+
+    def test_events_are_delivered_in_batches(self):
+        for entity_id in ['first', 'second', 'third']:
+            EventTable.create_event('test_event', {}, entity_id)
+        self.assertEqual(self.batches, [])
+        self.assertEqual(EventDelivery.objects.filter(delivered__isnull=True).count(), 3)
+
+        self.assertEqual(EventDelivery.deliver_pending(self.listen_for_test_events, batch_size=2), 3)
+        self.assertEqual(self.batches, [['first', 'second'], ['third']])
+        # Delivered events are not delivered again
+        self.assertEqual(EventDelivery.deliver_pending(self.listen_for_test_events), 0)
+
+    def test_failed_deliveries_are_retried(self):
+        EventTable.create_event('test_event', {}, 'first')
+        with mock.patch.object(event_dispatcher, 'run_batch', side_effect=Exception("Boom")):
+            with self.assertRaises(Exception):
+                EventDelivery.deliver_pending(self.listen_for_test_events)
+        self.assertEqual(EventDelivery.deliver_pending(self.listen_for_test_events), 1)
+        self.assertEqual(self.batches, [['first']])
+
+    @override_settings(ASYNC_EVENT_HANDLERS=False)
+    def test_synchronous_delivery(self):
+        EventTable.create_event('test_event', {}, 'first')
+        self.assertEqual(self.batches, [['first']])
+        self.assertFalse(EventDelivery.objects.exists())
+
+    @override_settings(ENFORCING=True)
+    def test_threshold_emails_are_coalesced(self):
+        user = UserFactory.create()
+        alloc_src = AllocationSource.objects.create(name='DefaultAllocation',
+                                                    compute_allowed=1000)
+        UserAllocationSource.objects.create(user=user, allocation_source=alloc_src)
+        events = [EventTable(name='allocation_source_threshold_met', entity_id=alloc_src.name,
+                             payload={'allocation_source_name': alloc_src.name,
+                                      'threshold': threshold, 'usage_percentage': threshold + 1})
+                  for threshold in [50, 90, 75]]
+        with mock.patch.object(allocation_source, 'send_usage_email_to') as send_usage_email_to:
+            allocation_source.listen_for_allocation_thresholds_met(events)
+        send_usage_email_to.assert_called_once_with(user, alloc_src, 90, usage_percentage=91)
@@ -0,0 +1,39 @@
+import mock
+from django.test import TestCase
+from django.utils import timezone
+
+from core.models import MaintenanceRecord
+from core.models.maintenance import maintenance_windows
+
+
+class MaintenanceWindowCacheTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(maintenance_windows, '_changed', return_value=False)
+        self.changed = patcher.start()
+        self.addCleanup(patcher.stop)
+        maintenance_windows.invalidate()
+        self.addCleanup(maintenance_windows.invalidate)
+        now = timezone.now()
+        self.record = MaintenanceRecord.objects.create(
+            start_date=now - timezone.timedelta(hours=1), title="Upgrade", message="Be right back")
+        # Starts later, so it is cached but not active yet
+        MaintenanceRecord.objects.create(
+            start_date=now + timezone.timedelta(hours=1), title="Next upgrade", message="")
+
+    def test_active_records_are_cached_until_a_record_changes(self):
+        self.assertEqual(MaintenanceRecord.active_global(), [self.record])
+        with self.assertNumQueries(0):
+            self.assertEqual(MaintenanceRecord.active_global(), [self.record])
+            self.assertEqual(len(maintenance_windows.active(
+                now=timezone.now() + timezone.timedelta(hours=2))), 2)
+
+        self.record.end_date = timezone.now()
+        self.record.save()
+        self.assertEqual(MaintenanceRecord.active_global(), [])
+
+    def test_published_change_reloads_records(self):
+        MaintenanceRecord.active_global()
+        # Changed by another process: no signal here
+        MaintenanceRecord.objects.filter(id=self.record.id).update(end_date=timezone.now())
+        self.changed.return_value = True
+        self.assertEqual(MaintenanceRecord.active_global(), [])
@@ -0,0 +1,115 @@
+import uuid
+from datetime import date, datetime
+
+import pytz
+from django.test import TestCase
+
+from api.tests.factories import (
+    UserFactory, IdentityFactory, ProviderFactory, ProviderMachineFactory,
+    InstanceStatusFactory, SizeFactory, AllocationSourceFactory)
+from core.models import (
+    EventTable, Instance, InstanceStatusHistory, InstanceUsageRollup,
+    UserUsageRollup)
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=pytz.utc)
+
+
+class UsageRollupTest(TestCase):
+    def setUp(self):
+        self.user = UserFactory.create()
+        provider = ProviderFactory.create()
+        identity = IdentityFactory.create_identity(created_by=self.user, provider=provider)
+        machine = ProviderMachineFactory.create_provider_machine(self.user, identity)
+        self.size = SizeFactory.create(provider=provider, cpu=2)
+        self.active = InstanceStatusFactory.create(name='active')
+        self.suspended = InstanceStatusFactory.create(name='suspended')
+        self.allocation_source = AllocationSourceFactory.create(name='TG-ROLLUP')
+        self.instance = Instance.objects.create(
+            name='rollup', provider_alias=str(uuid.uuid4()), source=machine.instance_source,
+            created_by=self.user, created_by_identity=identity,
+            start_date=utc(2017, 1, 1, 12))
+        # Avoid the allocation hooks, only the recorded events matter here
+        EventTable.objects.bulk_create([EventTable(
+            name='instance_allocation_source_changed', entity_id=self.user.username,
+            timestamp=utc(2017, 1, 2, 6),
+            payload={'instance_id': self.instance.provider_alias,
+                     'username': self.user.username,
+                     'allocation_source_name': self.allocation_source.name})])
+
+    def _history(self, status, start_date, end_date=None):
+        return InstanceStatusHistory.objects.create(
+            instance=self.instance, size=self.size, status=status,
+            start_date=start_date, end_date=end_date)
+
+    def _rollups(self):
+        return dict(((rollup.day, rollup.allocation_source_id), rollup)
+                    for rollup in InstanceUsageRollup.objects.filter(instance=self.instance))
+
+    def test_histories_are_split_by_day_and_allocation_source(self):
+        self._history(self.active, utc(2017, 1, 1, 12), utc(2017, 1, 2, 12))
+        self._history(self.suspended, utc(2017, 1, 2, 12))
+        build = InstanceUsageRollup.build(now=utc(2017, 1, 3))
+
+        self.assertEqual(build.instance_count, 1)
+        rollups = self._rollups()
+        self.assertEqual(set(rollups), {(date(2017, 1, 1), None),
+                                        (date(2017, 1, 2), None),
+                                        (date(2017, 1, 2), self.allocation_source.id)})
+        first_day = rollups[(date(2017, 1, 1), None)]
+        self.assertEqual(first_day.active_seconds, 12 * 3600)
+        self.assertEqual(first_day.cpu_seconds, 2 * 12 * 3600)
+        self.assertTrue(first_day.complete)
+        charged = rollups[(date(2017, 1, 2), self.allocation_source.id)]
+        self.assertEqual(charged.active_seconds, 6 * 3600)
+        self.assertEqual(charged.status_counts, {'active': 1, 'suspended': 1})
+        # The suspended history is still open, but the day is over
+        self.assertTrue(charged.complete)
+
+        user_usage = UserUsageRollup.usage(date(2017, 1, 1), date(2017, 2, 1), user=self.user)
+        self.assertEqual(user_usage, {'cpu_seconds': 2 * 24 * 3600.0,
+                                      'active_seconds': 24 * 3600.0})
+        self.assertEqual(UserUsageRollup.objects.get(day=date(2017, 1, 2)).instance_count, 1)
+
+    def test_only_changed_instances_are_rebuilt(self):
+        history = self._history(self.active, utc(2017, 1, 1, 12))
+        InstanceUsageRollup.build(now=utc(2017, 1, 1, 18))
+        first_day = self._rollups()[(date(2017, 1, 1), None)]
+        self.assertEqual(first_day.active_seconds, 6 * 3600)
+
+        history.end_date = utc(2017, 1, 3)
+        history.save()
+        self._history(self.suspended, utc(2017, 1, 3))
+        build = InstanceUsageRollup.build(now=utc(2017, 1, 4))
+        self.assertEqual(build.instance_count, 1)
+        self.assertEqual(
+            InstanceUsageRollup.usage(date(2017, 1, 1), date(2017, 1, 4), instance=self.instance),
+            {'cpu_seconds': 2 * 36 * 3600.0, 'active_seconds': 36 * 3600.0})
+
+        # The suspended history is open, so its day is rolled up again
+        self.assertEqual(InstanceUsageRollup.build(now=utc(2017, 1, 4)).instance_count, 1)
+        self.assertEqual(len(self._rollups()), 4)
+
+    def test_finished_days_of_open_histories_are_not_rebuilt(self):
+        self._history(self.active, utc(2017, 1, 1, 12))
+        InstanceUsageRollup.build(now=utc(2017, 1, 5, 12))
+        rollups = self._rollups()
+        self.assertEqual(sorted(day for day, source in rollups if not rollups[(day, source)].complete),
+                         [date(2017, 1, 5)])
+        finished = dict((key, rollup.id) for key, rollup in rollups.items()
+                        if key[0] < date(2017, 1, 5))
+
+        InstanceUsageRollup.build(now=utc(2017, 1, 5, 18))
+        rollups = self._rollups()
+        self.assertEqual(dict((key, rollups[key].id) for key in finished), finished)
+        today = rollups[(date(2017, 1, 5), self.allocation_source.id)]
+        self.assertEqual(today.active_seconds, 18 * 3600)
+        self.assertFalse(today.complete)
+
+        # Today is over: it is completed by the next build
+        InstanceUsageRollup.build(now=utc(2017, 1, 6, 1))
+        rollups = self._rollups()
+        self.assertTrue(rollups[(date(2017, 1, 5), self.allocation_source.id)].complete)
+        self.assertEqual(rollups[(date(2017, 1, 5), self.allocation_source.id)].active_seconds, 24 * 3600)
+        self.assertEqual(UserUsageRollup.objects.get(day=date(2017, 1, 5)).active_seconds, 24 * 3600)
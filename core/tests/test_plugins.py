@@ -0,0 +1,92 @@
+import mock
+from django.test import TestCase, override_settings
+
+from api.tests.factories import UserFactory, AllocationSourceFactory, UserAllocationSourceFactory
+from core import plugins
+from core.plugins import ValidationPluginManager
+
+PLUGIN_PATH = 'core.tests.test_plugins.CountingValidationPlugin'
+ALLOW_PLUGIN_PATH = 'core.tests.test_plugins.AllowValidationPlugin'
+
+
+class CountingValidationPlugin(object):
+    calls = 0
+
+    def validate_user(self, user):
+        CountingValidationPlugin.calls += 1
+        return user.user_allocation_sources.exists()
+
+
+class AllowValidationPlugin(object):
+    def validate_user(self, user):
+        return True
+
+
+@override_settings(PLUGIN_DECISION_CACHE_TTL=60)
+class PluginDecisionCacheTest(TestCase):
+    def setUp(self):
+        self.user = UserFactory.create()
+        CountingValidationPlugin.calls = 0
+        patcher = mock.patch.object(ValidationPluginManager, 'list_of_classes', [PLUGIN_PATH])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(plugins.plugin_decisions, '_invalidated', return_value=[])
+        self.invalidated = patcher.start()
+        self.addCleanup(patcher.stop)
+        plugins.plugin_decisions.invalidate()
+        plugins.plugin_metrics.clear()
+
+    def test_plugins_are_resolved_once(self):
+        with mock.patch.object(plugins, 'load_plugin_class',
+                               wraps=plugins.load_plugin_class) as load_plugin_class:
+            plugins.plugin_registry.clear()
+            ValidationPluginManager.load_plugins([PLUGIN_PATH])
+            ValidationPluginManager.load_plugins([PLUGIN_PATH])
+        self.assertEqual(load_plugin_class.call_count, 1)
+
+    def test_decisions_are_cached_until_allocation_sources_change(self):
+        self.assertFalse(self.user.is_valid())
+        self.assertFalse(self.user.is_valid())
+        self.assertEqual(CountingValidationPlugin.calls, 1)
+
+        UserAllocationSourceFactory.create(
+            user=self.user, allocation_source=AllocationSourceFactory.create(name='TG-PLUGIN'))
+        self.assertTrue(self.user.is_valid())
+        self.assertEqual(CountingValidationPlugin.calls, 2)
+        self.assertTrue(ValidationPluginManager.is_valid(self.user, force=True))
+        self.assertEqual(CountingValidationPlugin.calls, 3)
+
+        metrics = plugins.get_plugin_metrics()
+        self.assertEqual(metrics['is_valid.cache_hits']['calls'], 1)
+        self.assertEqual(metrics['%s.validate_user' % PLUGIN_PATH]['calls'], 3)
+
+    @override_settings(PLUGIN_DECISION_CACHE_SIZE=1)
+    def test_least_recently_used_decisions_are_dropped(self):
+        other_user = UserFactory.create()
+        self.user.is_valid()
+        other_user.is_valid()
+        self.user.is_valid()
+        self.assertEqual(CountingValidationPlugin.calls, 3)
+
+    def test_reassigned_plugins_take_effect(self):
+        self.assertFalse(self.user.is_valid())
+        with mock.patch.object(ValidationPluginManager, 'list_of_classes', [ALLOW_PLUGIN_PATH]):
+            self.assertTrue(self.user.is_valid())
+        self.assertFalse(self.user.is_valid())
+        self.assertEqual(CountingValidationPlugin.calls, 1)
+
+    def test_published_invalidation_re_evaluates_the_user(self):
+        other_user = UserFactory.create()
+        self.user.is_valid()
+        other_user.is_valid()
+        # Invalidated by another process: no signal here
+        self.invalidated.side_effect = [[self.user.id], [], []]
+        self.user.is_valid()
+        other_user.is_valid()
+        self.assertEqual(CountingValidationPlugin.calls, 3)
+
+    def test_redis_unavailable_re_evaluates_every_user(self):
+        self.user.is_valid()
+        self.invalidated.return_value = None
+        self.user.is_valid()
+        self.assertEqual(CountingValidationPlugin.calls, 2)
@@ -1,4 +1,7 @@
+import time
+
 from business_rules import run_all
+from celery import chord
 from celery.decorators import task
 from django.conf import settings
 from django.utils import timezone
@@ -10,7 +13,7 @@ from core.models.allocation_source import (
     AllocationSourceSnapshot,
     AllocationSource, UserAllocationSnapshot
 )
-from core.models.allocation_source import total_usage
+from core.models.allocation_source import snapshot_usage
 from cyverse_allocation.cyverse_rules_engine_setup import CyverseTestRenewalVariables, CyverseTestRenewalActions, \
     cyverse_rules, renewal_strategies
 
@@ -19,45 +22,88 @@ from cyverse_allocation.cyverse_rules_engine_setup import CyverseTestRenewalVari
 
 
 @task(name="update_snapshot_cyverse")
-def update_snapshot_cyverse(start_date=None, end_date=None):
+def update_snapshot_cyverse(start_date=None, end_date=None, rebuild=False):
+    """
+    Fan-out one `update_snapshot_cyverse_for` per batch of allocation sources
+    (See `settings.ALLOCATION_SNAPSHOT_BATCH_SIZE`), then run the
+    allocation threshold check once every snapshot has been saved.
+    """
     logger.debug("update_snapshot_cyverse task started at %s." % datetime.now())
     end_date = timezone.now().replace(microsecond=0) if not end_date else end_date
 
-    for allocation_source in AllocationSource.objects.order_by('name'):
-        # calculate and save snapshots here
-        allocation_source_name = allocation_source.name
-        last_renewal_event = EventTable.objects.filter(
-            name='allocation_source_created_or_renewed',
-            payload__allocation_source_name__exact=str(allocation_source_name)).order_by('timestamp')
-
-        if not last_renewal_event:
-            logger.info('Allocation Source %s Create/Renewal event missing', allocation_source_name)
-            continue
-
-        start_date = last_renewal_event.last().timestamp.replace(microsecond=0) if not start_date else start_date
-
-        total_compute_used = 0
-        total_burn_rate = 0
-        for user in allocation_source.all_users:
-            compute_used, burn_rate = total_usage(user.username, start_date=start_date,
-                                                  end_date=end_date, allocation_source_name=allocation_source_name,
-                                                  burn_rate=True)
-
-            UserAllocationSnapshot.objects.update_or_create(allocation_source=allocation_source, user=user,
-                                                            defaults={'compute_used': compute_used,
-                                                                      'burn_rate': burn_rate})
-            total_compute_used += compute_used
-            total_burn_rate += burn_rate
-        AllocationSourceSnapshot.objects.update_or_create(allocation_source=allocation_source,
-                                                          defaults={'compute_used': total_compute_used,
-                                                                    'global_burn_rate': total_burn_rate})
-
-        run_all(rule_list=cyverse_rules,
-                defined_variables=CyverseTestRenewalVariables(allocation_source, end_date, start_date),
-                defined_actions=CyverseTestRenewalActions(allocation_source, end_date), )
-    # At the end of the task, fire-off an allocation threshold check
-    logger.debug("update_snapshot_cyverse task finished at %s." % datetime.now())
-    allocation_threshold_check.apply_async()
+    allocation_source_ids = list(AllocationSource.objects.order_by('name').values_list('id', flat=True))
+    batch_size = getattr(settings, 'ALLOCATION_SNAPSHOT_BATCH_SIZE', 10)
+    batches = [allocation_source_ids[index:index + batch_size]
+               for index in range(0, len(allocation_source_ids), batch_size)]
+    # At the end of the snapshots, fire-off an allocation threshold check
+    if not batches:
+        allocation_threshold_check.apply_async()
+        return
+    chord([
+        update_snapshot_cyverse_for.si(batch, start_date=start_date, end_date=end_date, rebuild=rebuild)
+        for batch in batches
+    ])(allocation_threshold_check.si())
+    logger.debug("update_snapshot_cyverse task queued %s batches of allocation sources at %s."
+                 % (len(batches), datetime.now()))
+
+
+@task(name="update_snapshot_cyverse_for")
+def update_snapshot_cyverse_for(allocation_source_ids, start_date=None, end_date=None, rebuild=False):
+    """
+    Update the snapshots of each allocation source in `allocation_source_ids`.
+    Returns the time (in seconds) spent on each allocation source.
+    """
+    end_date = timezone.now().replace(microsecond=0) if not end_date else end_date
+    timings = {}
+    allocation_sources = AllocationSource.objects.filter(id__in=allocation_source_ids).order_by('name')
+    for count, allocation_source in enumerate(allocation_sources, 1):
+        started = time.time()
+        user_count = update_snapshot_cyverse_source(allocation_source, start_date, end_date, rebuild=rebuild)
+        timings[allocation_source.name] = round(time.time() - started, 3)
+        logger.info("Allocation Source %s (%s/%s): %s user snapshots updated in %ss",
+                    allocation_source.name, count, len(allocation_source_ids),
+                    user_count, timings[allocation_source.name])
+    return timings
+
+
+def update_snapshot_cyverse_source(allocation_source, start_date, end_date, rebuild=False):
+    """
+    Update the user and allocation source snapshots of one allocation source,
+    then apply the renewal rules. Returns the number of user snapshots updated.
+    """
+    # calculate and save snapshots here
+    allocation_source_name = allocation_source.name
+    last_renewal_event = EventTable.objects.filter(
+        name='allocation_source_created_or_renewed',
+        payload__allocation_source_name__exact=str(allocation_source_name)).order_by('timestamp')
+
+    if not last_renewal_event:
+        logger.info('Allocation Source %s Create/Renewal event missing', allocation_source_name)
+        return 0
+
+    start_date = last_renewal_event.last().timestamp.replace(microsecond=0) if not start_date else start_date
+
+    total_compute_used = 0
+    total_burn_rate = 0
+    user_count = 0
+    for user in allocation_source.all_users:
+        compute_used, burn_rate = snapshot_usage(user, allocation_source, start_date, end_date,
+                                                 rebuild=rebuild)
+
+        UserAllocationSnapshot.objects.update_or_create(allocation_source=allocation_source, user=user,
+                                                        defaults={'compute_used': compute_used,
+                                                                  'burn_rate': burn_rate})
+        total_compute_used += compute_used
+        total_burn_rate += burn_rate
+        user_count += 1
+    AllocationSourceSnapshot.objects.update_or_create(allocation_source=allocation_source,
+                                                      defaults={'compute_used': total_compute_used,
+                                                                'global_burn_rate': total_burn_rate})
+
+    run_all(rule_list=cyverse_rules,
+            defined_variables=CyverseTestRenewalVariables(allocation_source, end_date, start_date),
+            defined_actions=CyverseTestRenewalActions(allocation_source, end_date), )
+    return user_count
 
 
 @task(name="allocation_threshold_check")
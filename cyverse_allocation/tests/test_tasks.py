@@ -0,0 +1,122 @@
+import uuid
+
+import mock
+from dateutil.parser import parse
+from django.apps import apps
+from django.test import TestCase, override_settings
+
+from api.tests.factories import (
+    UserFactory, IdentityFactory, ProviderFactory, ProviderMachineFactory,
+    InstanceFactory, InstanceHistoryFactory, InstanceStatusFactory, SizeFactory,
+    AllocationSourceFactory, UserAllocationSourceFactory)
+from atmosphere.celery_init import app
+from core.models import EventTable
+from core.models.allocation_source import (
+    AllocationSourceSnapshot, UserAllocationSnapshot, snapshot_usage)
+
+
+@override_settings(ALLOCATION_SNAPSHOT_BATCH_SIZE=2, CHECK_THRESHOLD=True)
+class UpdateSnapshotCyverseTest(TestCase):
+    def setUp(self):
+        if not apps.is_installed('cyverse_allocation'):
+            self.skipTest('CyVerse Allocation plugin is not enabled')
+        eager = mock.patch.object(app.conf, 'task_always_eager', True)
+        eager.start()
+        self.addCleanup(eager.stop)
+        # The renewal rules are not under test
+        rules = mock.patch('cyverse_allocation.tasks.run_all')
+        rules.start()
+        self.addCleanup(rules.stop)
+
+        self.renewal_date = parse('2017-01-01T00:00:00+00:00')
+        self.end_date = parse('2017-01-10T00:00:00+00:00')
+        self.user = UserFactory.create(username='test-username')
+        self.other_user = UserFactory.create(username='other-username')
+        provider = ProviderFactory.create()
+        identity = IdentityFactory.create_identity(created_by=self.user, provider=provider)
+        other_identity = IdentityFactory.create_identity(created_by=self.other_user, provider=provider)
+        self.machine = ProviderMachineFactory.create_provider_machine(self.user, identity)
+        self.active = InstanceStatusFactory.create(name='active')
+        self.size = SizeFactory.create(provider=provider, cpu=2, mem=2, disk=10)
+
+        # TG-A is used up, the others are not
+        self.sources = [
+            self._create_source('TG-A', 1),
+            self._create_source('TG-B', 100000),
+            self._create_source('TG-C', 100000),
+        ]
+        UserAllocationSourceFactory.create(user=self.user, allocation_source=self.sources[0])
+        UserAllocationSourceFactory.create(user=self.user, allocation_source=self.sources[1])
+        UserAllocationSourceFactory.create(user=self.other_user, allocation_source=self.sources[2])
+
+        instance = self._create_instance(self.user, identity, '2017-01-02T00:00:00+00:00')
+        self._create_event(self.user, instance, self.sources[0], '2017-01-02T00:00:00+00:00')
+        self._create_event(self.user, instance, self.sources[1], '2017-01-05T00:00:00+00:00')
+        other_instance = self._create_instance(self.other_user, other_identity, '2017-01-03T00:00:00+00:00')
+        self._create_event(self.other_user, other_instance, self.sources[2], '2017-01-03T00:00:00+00:00')
+
+    def _create_source(self, name, compute_allowed):
+        allocation_source = AllocationSourceFactory.create(name=name, compute_allowed=compute_allowed)
+        EventTable.objects.create(
+            name='allocation_source_created_or_renewed',
+            entity_id=name,
+            payload={'uuid': str(allocation_source.uuid),
+                     'allocation_source_name': name,
+                     'compute_allowed': compute_allowed,
+                     'renewal_strategy': allocation_source.renewal_strategy},
+            timestamp=self.renewal_date)
+        return allocation_source
+
+    def _create_instance(self, user, identity, start_date):
+        instance = InstanceFactory.create(
+            provider_alias=str(uuid.uuid4()),
+            source=self.machine.instance_source,
+            created_by=user,
+            created_by_identity=identity,
+            start_date=parse(start_date))
+        InstanceHistoryFactory.create(
+            instance=instance, status=self.active, size=self.size,
+            start_date=parse(start_date), end_date=None)
+        return instance
+
+    def _create_event(self, user, instance, allocation_source, timestamp):
+        EventTable.objects.create(
+            name='instance_allocation_source_changed',
+            entity_id=user.username,
+            payload={'instance_id': instance.provider_alias,
+                     'allocation_source_name': allocation_source.name},
+            timestamp=parse(timestamp))
+
+    def _serial_snapshots(self):
+        """
+        The snapshots of the former serial loop over every allocation source
+        """
+        snapshots = {}
+        for allocation_source in self.sources:
+            total_compute_used = 0
+            for user in allocation_source.all_users:
+                compute_used, _ = snapshot_usage(user, allocation_source, self.renewal_date, self.end_date)
+                snapshots[(allocation_source.name, user.username)] = compute_used
+                total_compute_used += compute_used
+            snapshots[allocation_source.name] = total_compute_used
+        return snapshots
+
+    def test_batched_snapshots_match_serial_snapshots(self):
+        from cyverse_allocation.tasks import update_snapshot_cyverse
+        expected = self._serial_snapshots()
+        update_snapshot_cyverse(end_date=self.end_date)
+
+        snapshots = {}
+        for snapshot in UserAllocationSnapshot.objects.select_related('allocation_source', 'user'):
+            snapshots[(snapshot.allocation_source.name, snapshot.user.username)] = float(snapshot.compute_used)
+        for snapshot in AllocationSourceSnapshot.objects.select_related('allocation_source'):
+            snapshots[snapshot.allocation_source.name] = float(snapshot.compute_used)
+        self.assertEqual(snapshots, expected)
+        self.assertTrue(expected[('TG-A', 'test-username')] > 0)
+        self.assertTrue(expected[('TG-B', 'test-username')] > 0)
+
+        # The chord callback checked the thresholds after every snapshot was saved
+        self.assertEqual(
+            list(EventTable.objects.filter(name='allocation_source_threshold_met')
+                 .values_list('entity_id', flat=True)),
+            ['TG-A'])
@@ -6,3 +6,9 @@ class TASReportAdmin(admin.ModelAdmin):
     search_fields = ["project_name", "username",]
     list_display = ["id", "username", "project_name", "compute_used", "start_date", "end_date", "success"]
     list_filter = ["success", "project_name"]
+
+
+@admin.register(models.TASReportRun)
+class TASReportRunAdmin(admin.ModelAdmin):
+    list_display = ["id", "end_date", "stage", "report_count", "sent_count", "failed_count", "started", "finished"]
+    list_filter = ["stage"]
@@ -6,7 +6,7 @@ from dateutil.parser import parse
 
 from .exceptions import TASAPIException, NoTaccUserForXsedeException, NoAccountForUsernameException
 #FIXME: Next iteration, move this into the driver.
-from .tas_api import tacc_api_post, tacc_api_get
+from .tas_api import tacc_api_post, tacc_api_get, get_tas_client
 from core.models import EventTable
 from core.models.allocation_source import AllocationSource, UserAllocationSource
 
@@ -34,12 +34,14 @@ class TASAPIDriver(object):
         self.tacc_username = tacc_username
         self.tacc_password = tacc_password
         self.resource_name = resource_name
+        self.user_allocation_map = {}
 
     def clear_cache(self):
         self.user_project_list = []
         self.project_list = []
         self.allocation_list = []
         self.username_map = {}
+        self.user_allocation_map = {}
 
     def get_all_allocations(self):
         if not self.allocation_list:
@@ -52,14 +54,24 @@ class TASAPIDriver(object):
         return self.project_list
 
     def get_tacc_username(self, user, raise_exception=False):
+        from .models import TACCUsernameMapping
         if self.username_map.get(user.username):
             return self.username_map[user.username]
+        mapping = TACCUsernameMapping.lookup(user.username)
+        if mapping and mapping.tacc_username:
+            self.username_map[user.username] = mapping.tacc_username
+            return mapping.tacc_username
+        elif mapping:
+            if raise_exception:
+                raise NoTaccUserForXsedeException('No valid username found for %s' % user.username)
+            return None
         tacc_user = None
         try:
             tacc_user = self._xsede_to_tacc_username(
                 user.username)
         except NoTaccUserForXsedeException:
             logger.exception('User: %s has no TACC username', user.username)
+            TACCUsernameMapping.record({user.username: None})
             if raise_exception:
                 raise
         except TASAPIException:
@@ -68,6 +80,7 @@ class TASAPIDriver(object):
                 raise
         else:
             self.username_map[user.username] = tacc_user
+            TACCUsernameMapping.record({user.username: tacc_user})
         return tacc_user
 
     def find_projects_for(self, tacc_username):
@@ -92,12 +105,63 @@ class TASAPIDriver(object):
     def get_all_project_users(self):
         if not self.user_project_list:
             self.project_list = self._get_all_projects()
-            for project in sorted(self.project_list, key=lambda p: p['id']):
-                project_users = self.get_project_users(project['id'])
+            projects = sorted(self.project_list, key=lambda p: p['id'])
+            all_project_users = get_tas_client().map(
+                lambda project: self.get_project_users(project['id']), projects)
+            for project, project_users in zip(projects, all_project_users):
                 project['users'] = project_users
             self.user_project_list = self.project_list
         return self.user_project_list
 
+    def prefetch_user_allocations(self, users):
+        """
+        Fetch the TACC username and allocations of each user concurrently
+        (See `TASClient.map`), for `get_user_allocations` to re-use.
+        Users whose allocations could not be fetched are left out, and
+        fetched again by `get_user_allocations`.
+        TACCUsernameMappings are read and saved here, only the TAS requests
+        are made by the `TASClient.map` threads.
+        """
+        from .models import TACCUsernameMapping
+        usernames = [user.username for user in users]
+        tacc_usernames = TACCUsernameMapping.lookup_all(
+            [username for username in usernames if not self.username_map.get(username)])
+        tacc_usernames.update(
+            (username, self.username_map[username]) for username in usernames
+            if self.username_map.get(username))
+
+        def fetch_user_allocations(username):
+            """
+            Returns (tacc_username, whether TAS was asked for it, user allocations)
+            """
+            tacc_username = tacc_usernames.get(username)
+            resolved = username not in tacc_usernames
+            try:
+                if resolved:
+                    try:
+                        tacc_username = self._xsede_to_tacc_username(username)
+                    except NoTaccUserForXsedeException:
+                        logger.info('User: %s has no TACC username', username)
+                        return None, True, None
+                if not tacc_username:
+                    return tacc_username, resolved, None
+                return tacc_username, resolved, self.get_user_allocations(
+                    tacc_username, raise_exception=False)
+            except Exception:
+                logger.exception("Error prefetching the allocations of %s", username)
+                return tacc_username, resolved and tacc_username is not None, None
+
+        resolved_usernames = {}
+        results = get_tas_client().map(fetch_user_allocations, usernames)
+        for username, (tacc_username, resolved, user_allocations) in zip(usernames, results):
+            if resolved:
+                resolved_usernames[username] = tacc_username
+            if tacc_username:
+                self.username_map[username] = tacc_username
+            if tacc_username and user_allocations is not None:
+                self.user_allocation_map[tacc_username] = user_allocations
+        TACCUsernameMapping.record(resolved_usernames)
+
     def _xsede_to_tacc_username(self, xsede_username):
         path = '/v1/users/xsede/%s' % xsede_username
         url_match = self.tacc_api + path
@@ -239,6 +303,8 @@ class TASAPIDriver(object):
     
 
     def get_user_allocations(self, username, include_expired=False, raise_exception=True):
+        if not include_expired and self.user_allocation_map.get(username) is not None:
+            return self.user_allocation_map[username]
         path = '/v1/projects/username/%s' % username
         url_match = self.tacc_api + path
         resp, data = tacc_api_get(url_match, self.tacc_username, self.tacc_password)
@@ -344,11 +410,43 @@ def collect_users_without_allocation(driver):
     return missing
 
 
+def refresh_tacc_usernames(driver=None, usernames=None):
+    """
+    Ask TAS for the TACC username of every user (or of `usernames`)
+    concurrently, and save them as TACCUsernameMappings.
+    Users TAS could not be asked about keep their previous mapping.
+    Returns the number of mappings saved.
+    """
+    from core.models import AtmosphereUser
+    from .models import TACCUsernameMapping
+    driver = driver or TASAPIDriver()
+    if usernames is None:
+        usernames = AtmosphereUser.objects.order_by('username').values_list('username', flat=True)
+
+    def resolve(username):
+        try:
+            return username, driver._xsede_to_tacc_username(username)
+        except NoTaccUserForXsedeException:
+            return username, None
+        except TASAPIException:
+            logger.exception('Some exception happened while getting TACC username for user: %s', username)
+            return None
+
+    tacc_usernames = dict(result for result in get_tas_client().map(resolve, usernames) if result)
+    TACCUsernameMapping.record(tacc_usernames)
+    driver.username_map.update(
+        (xsede_username, tacc_username) for xsede_username, tacc_username in tacc_usernames.items()
+        if tacc_username)
+    return len(tacc_usernames)
+
+
 def fill_user_allocation_sources():
     from core.models import AtmosphereUser
     driver = TASAPIDriver()
     allocation_resources = {}
-    for user in AtmosphereUser.objects.order_by('username'):
+    users = list(AtmosphereUser.objects.order_by('username'))
+    driver.prefetch_user_allocations(users)
+    for user in users:
         try:
             resources = fill_user_allocation_source_for(driver, user)
         except Exception as exc:
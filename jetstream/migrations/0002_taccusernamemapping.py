@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jetstream', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TACCUsernameMapping',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('xsede_username', models.CharField(max_length=128, unique=True)),
+                ('tacc_username', models.CharField(blank=True, max_length=128, null=True)),
+                ('refreshed', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'db_table': 'tacc_username_mapping',
+            },
+        ),
+    ]
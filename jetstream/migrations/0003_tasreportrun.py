@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jetstream', '0002_taccusernamemapping'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tasallocationreport',
+            name='claimed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='TASReportRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('since', models.DateTimeField(blank=True, null=True)),
+                ('end_date', models.DateTimeField()),
+                ('stage', models.CharField(choices=[('create', 'Create reports'), ('send', 'Send reports'), ('finished', 'Finished')], default='create', max_length=16)),
+                ('report_count', models.IntegerField(default=0)),
+                ('sent_count', models.IntegerField(default=0)),
+                ('failed_count', models.IntegerField(default=0)),
+                ('timings', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'tas_report_run',
+            },
+        ),
+    ]
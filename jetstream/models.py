@@ -1,6 +1,10 @@
-from django.db import models
+from django.contrib.postgres.fields import JSONField
+from django.apps import apps
+from django.db import IntegrityError, models, transaction
+from django.db.models import Max
 from django.conf import settings
 from django.utils import timezone
+from django.utils.timezone import timedelta
 from core.models import AllocationSource
 from django.db.models.signals import post_save
 
@@ -37,6 +41,8 @@ class TASAllocationReport(models.Model):
     # FIXME:  Save a response confirmation -instead of- success
     report_date = models.DateTimeField(blank=True, null=True)
     success = models.BooleanField(default=False)
+    # Set while a `send_reports` run is POSTing the report, so it is sent once
+    claimed = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         app_label = 'jetstream'
@@ -83,3 +89,153 @@ class TASAllocationReport(models.Model):
              self.compute_used, duration,
              self.end_date, self.start_date,
              self.report_date)
+
+
+class TACCUsernameMapping(models.Model):
+    """
+    The TACC username of an XSEDE (Atmosphere) username, as last returned by
+    the TAS API. `tacc_username` is null when TAS found no TACC user.
+    Refreshed in bulk by the 'refresh_tacc_usernames' task.
+    """
+    xsede_username = models.CharField(max_length=128, unique=True)
+    tacc_username = models.CharField(max_length=128, null=True, blank=True)
+    refreshed = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        app_label = 'jetstream'
+        db_table = 'tacc_username_mapping'
+
+    def __unicode__(self):
+        return "%s -> %s (Refreshed:%s)" % (
+            self.xsede_username, self.tacc_username, self.refreshed)
+
+    def is_fresh(self, now=None):
+        """
+        Mappings are kept for TACC_USERNAME_MAX_AGE, "no TACC user found"
+        for TACC_USERNAME_NEGATIVE_MAX_AGE
+        """
+        if self.tacc_username:
+            max_age = getattr(settings, 'TACC_USERNAME_MAX_AGE', timedelta(days=2))
+        else:
+            max_age = getattr(settings, 'TACC_USERNAME_NEGATIVE_MAX_AGE', timedelta(hours=12))
+        return self.refreshed > (now or timezone.now()) - max_age
+
+    @classmethod
+    def is_available(cls):
+        """
+        False where the jetstream app is not installed (i.e. when the jetstream
+        tests run in another distribution)
+        """
+        return apps.is_installed('jetstream')
+
+    @classmethod
+    def lookup(cls, xsede_username):
+        """
+        Returns the fresh mapping of `xsede_username`, or None
+        """
+        if not cls.is_available():
+            return None
+        mapping = cls.objects.filter(xsede_username=xsede_username).first()
+        if mapping and mapping.is_fresh():
+            return mapping
+        return None
+
+    @classmethod
+    def lookup_all(cls, xsede_usernames):
+        """
+        Returns {xsede_username: tacc_username} of the fresh mappings of `xsede_usernames`
+        """
+        if not cls.is_available():
+            return {}
+        now = timezone.now()
+        mappings = cls.objects.filter(xsede_username__in=list(xsede_usernames))
+        return dict((mapping.xsede_username, mapping.tacc_username)
+                    for mapping in mappings if mapping.is_fresh(now))
+
+    @classmethod
+    def record(cls, tacc_usernames):
+        """
+        Save the TACC username (or None) of each XSEDE username
+        param - tacc_usernames - {xsede_username: tacc_username}
+        """
+        if not cls.is_available():
+            return
+        now = timezone.now()
+        existing = dict(cls.objects.filter(xsede_username__in=list(tacc_usernames))
+                        .values_list('xsede_username', 'tacc_username'))
+        unchanged = [xsede_username for xsede_username, tacc_username in tacc_usernames.items()
+                     if xsede_username in existing and existing[xsede_username] == tacc_username]
+        cls.objects.filter(xsede_username__in=unchanged).update(refreshed=now)
+        for xsede_username, tacc_username in tacc_usernames.items():
+            if xsede_username in existing and existing[xsede_username] != tacc_username:
+                cls.objects.filter(xsede_username=xsede_username).update(
+                    tacc_username=tacc_username, refreshed=now)
+        created = dict((xsede_username, tacc_username)
+                       for xsede_username, tacc_username in tacc_usernames.items()
+                       if xsede_username not in existing)
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create([
+                    cls(xsede_username=xsede_username, tacc_username=tacc_username, refreshed=now)
+                    for xsede_username, tacc_username in created.items()])
+        except IntegrityError:
+            # Some were created meanwhile (i.e. by another worker)
+            for xsede_username, tacc_username in created.items():
+                cls.objects.update_or_create(
+                    xsede_username=xsede_username,
+                    defaults={'tacc_username': tacc_username, 'refreshed': now})
+
+
+class TASReportRun(models.Model):
+    """
+    Checkpoint of a 'report_allocations_to_tas' run.
+    An unfinished run is resumed with the same `end_date`, so the reports
+    created (or sent) before a failure are not created again.
+    """
+    CREATE = 'create'
+    SEND = 'send'
+    FINISHED = 'finished'
+    STAGES = ((CREATE, 'Create reports'), (SEND, 'Send reports'), (FINISHED, 'Finished'))
+
+    since = models.DateTimeField(null=True, blank=True)  # End date of the previous reports
+    end_date = models.DateTimeField()
+    stage = models.CharField(max_length=16, choices=STAGES, default=CREATE)
+    report_count = models.IntegerField(default=0)
+    sent_count = models.IntegerField(default=0)
+    failed_count = models.IntegerField(default=0)
+    # Seconds spent in each completed stage
+    timings = JSONField(default=dict)
+    started = models.DateTimeField(default=timezone.now)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = 'jetstream'
+        db_table = 'tas_report_run'
+
+    def __unicode__(self):
+        return "Report run until %s (Stage:%s Reports:%s Sent:%s Failed:%s)" % (
+            self.end_date, self.stage, self.report_count,
+            self.sent_count, self.failed_count)
+
+    @classmethod
+    def resume_or_start(cls, end_date=None):
+        """
+        Returns the unfinished run, or a new run until `end_date`
+        """
+        run = cls.objects.filter(finished__isnull=True).order_by('started').last()
+        if run:
+            return run
+        since = TASAllocationReport.objects.aggregate(Max('end_date'))['end_date__max']
+        return cls.objects.create(since=since, end_date=end_date or timezone.now())
+
+    def complete_stage(self, stage, seconds, next_stage, **counts):
+        """
+        Record the time spent in `stage` and move the checkpoint to `next_stage`
+        """
+        self.timings[stage] = self.timings.get(stage, 0) + seconds
+        self.stage = next_stage
+        for name, count in counts.items():
+            setattr(self, name, count)
+        if next_stage == self.FINISHED:
+            self.finished = timezone.now()
+        self.save()
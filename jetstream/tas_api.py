@@ -1,48 +1,152 @@
+import hashlib
+import json
+import threading
+from multiprocessing.pool import ThreadPool
+
+import redis
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from django.conf import settings
-from memoize import memoize
+
+from service.cache import redis_connection
 
 from .exceptions import TASAPIException
 
 from threepio import logger
 
+TAS_API_CACHE_KEY = "tas_api.{0}"
+# Defaults, unless overridden in settings.TAS_API_*
+DEFAULT_TAS_API_CACHE_TTL = 300
+DEFAULT_TAS_API_POOL_SIZE = 10
+DEFAULT_TAS_API_MAX_WORKERS = 8
+DEFAULT_TAS_API_RETRIES = 3
+DEFAULT_TAS_API_BACKOFF_FACTOR = 0.5
+DEFAULT_TAS_API_TIMEOUT = 30
+
+client = None
+client_lock = threading.Lock()
+
+
+class TASClient(object):
+    """
+    A keep-alive `requests.Session` shared by every TAS API call, with a
+    connection pool of TAS_API_POOL_SIZE. Failed GETs are retried
+    TAS_API_RETRIES times, with an exponential backoff.
+    """
+
+    def __init__(self, pool_size=None, retries=None, backoff_factor=None, timeout=None):
+        if pool_size is None:
+            pool_size = getattr(settings, 'TAS_API_POOL_SIZE', DEFAULT_TAS_API_POOL_SIZE)
+        if retries is None:
+            retries = getattr(settings, 'TAS_API_RETRIES', DEFAULT_TAS_API_RETRIES)
+        if backoff_factor is None:
+            backoff_factor = getattr(settings, 'TAS_API_BACKOFF_FACTOR', DEFAULT_TAS_API_BACKOFF_FACTOR)
+        if timeout is None:
+            timeout = getattr(settings, 'TAS_API_TIMEOUT', DEFAULT_TAS_API_TIMEOUT)
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504),
+                      method_whitelist=frozenset(['GET']))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = timeout
+
+    def get(self, url, username, password):
+        """
+        GET `url`, re-using the response cached in Redis for TAS_API_CACHE_TTL
+        seconds. Returns (response, data) -- response is None when cached.
+        """
+        key = TAS_API_CACHE_KEY.format(hashlib.sha1("%s:%s" % (username, url)).hexdigest())
+        data = _cache_get(key)
+        if data is not None:
+            return (None, data)
+        logger.debug('url: %s', url)
+        try:
+            resp = self.session.get(url, auth=(username, password), timeout=self.timeout)
+        except requests.RequestException as exc:
+            raise TASAPIException("Request to %s failed -- %s" % (url, exc))
+        logger.debug('resp.status_code: %s', resp.status_code)
+        if resp.status_code != 200:
+            raise TASAPIException(
+                "Invalid Response - "
+                "Expected 200 Response: %s" % resp.__dict__)
+        # Expects *ALL* GET calls to return application/json
+        try:
+            data = resp.json()
+        except ValueError as exc:
+            raise TASAPIException(
+                "JSON Decode error -- %s" % exc)
+        _cache_set(key, data)
+        return (resp, data)
+
+    def post(self, url, post_data, username, password):
+        logger.debug('url: %s', url)
+        resp = self.session.post(url, post_data, auth=(username, password), timeout=self.timeout)
+        logger.debug('resp.status_code: %s', resp.status_code)
+        return resp
+
+    def map(self, method, items, max_workers=None):
+        """
+        Returns [method(item) for item in items], calling at most
+        TAS_API_MAX_WORKERS methods at once. The first exception is raised.
+        """
+        items = list(items)
+        if max_workers is None:
+            max_workers = getattr(settings, 'TAS_API_MAX_WORKERS', DEFAULT_TAS_API_MAX_WORKERS)
+        if len(items) < 2 or max_workers < 2:
+            return [method(item) for item in items]
+        pool = ThreadPool(min(max_workers, len(items)))
+        try:
+            return pool.map(method, items)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def get_tas_client():
+    global client
+    with client_lock:
+        if not client:
+            client = TASClient()
+    return client
+
+
+def _cache_get(key):
+    if not getattr(settings, 'TAS_API_CACHE_TTL', DEFAULT_TAS_API_CACHE_TTL):
+        return None
+    try:
+        cached = redis_connection().get(key)
+    except redis.exceptions.ConnectionError:
+        return None
+    return json.loads(cached) if cached else None
+
+
+def _cache_set(key, data):
+    ttl = getattr(settings, 'TAS_API_CACHE_TTL', DEFAULT_TAS_API_CACHE_TTL)
+    if not ttl:
+        return
+    try:
+        redis_connection().set(key, json.dumps(data), ex=ttl)
+    except redis.exceptions.ConnectionError:
+        pass
+
+
 def tacc_api_post(url, post_data, username=None, password=None):
     if not username:
         username = settings.TACC_API_USER
     if not password:
         password = settings.TACC_API_PASS
-    logger.debug('url: %s', url)
     # logger.debug("REQ BODY: %s" % post_data)
-    resp = requests.post(
-        url, post_data,
-        auth=(username, password))
-    logger.debug('resp.status_code: %s', resp.status_code)
-    # logger.debug('resp.__dict__: %s', resp.__dict__)
-    return resp
+    return get_tas_client().post(url, post_data, username, password)
 
 
-@memoize(timeout=300)
 def tacc_api_get(url, username=None, password=None):
     if not username:
         username = settings.TACC_API_USER
     if not password:
         password = settings.TACC_API_PASS
-    logger.debug('url: %s', url)
-    resp = requests.get(
-        url,
-        auth=(username, password))
-    logger.debug('resp.status_code: %s', resp.status_code)
-    # logger.debug('resp.__dict__: %s', resp.__dict__)
-    if resp.status_code != 200:
-        raise TASAPIException(
-            "Invalid Response - "
-            "Expected 200 Response: %s" % resp.__dict__)
-    # Expects *ALL* GET calls to return application/json
-    try:
-        data = resp.json()
-        # logger.debug(data)
-    except ValueError as exc:
-        raise TASAPIException(
-            "JSON Decode error -- %s" % exc)
-    return (resp, data)
+    return get_tas_client().get(url, username, password)
@@ -1,5 +1,11 @@
+import time
+from datetime import timedelta
+from functools import partial
+
 from celery.decorators import task
+from dateutil.parser import parse
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from django.db.models import Q, Max
 
@@ -8,10 +14,14 @@ from core.models.allocation_source import (
     UserAllocationSource, AllocationSourceSnapshot,
     AllocationSource, UserAllocationSnapshot
 )
-from core.models.allocation_source import total_usage
-from .allocation import (TASAPIDriver, fill_user_allocation_sources, select_valid_allocation)
+from core.models.allocation_source import snapshot_usage, total_usage
+from service.allocation_logic import allocation_usage
+from .allocation import (
+    TASAPIDriver, fill_user_allocation_sources, refresh_tacc_usernames,
+    select_valid_allocation)
 from .exceptions import TASPluginException
-from .models import TASAllocationReport
+from .models import TASAllocationReport, TASReportRun
+from .tas_api import get_tas_client
 
 from threepio import logger
 
@@ -26,32 +36,86 @@ def monitor_jetstream_allocation_sources():
     return resources
 
 
-def create_reports():
+@task(name="refresh_tacc_usernames")
+def refresh_tacc_usernames_task():
+    """
+    Refresh the XSEDE to TACC username mapping of every user,
+    so reports and validation do not ask TAS about each user
+    """
+    return refresh_tacc_usernames()
+
+
+def create_reports(end_date=None, since=None):
     """
     GO through the list of all users or all providers
     For each username, get an XSede API map to the 'TACC username'
     if 'TACC username' includes a jetstream resource, create a report
+
+    The usage of every (user, project) is computed in batches of
+    TAS_REPORT_BATCH_SIZE, one pass over the instance histories per batch,
+    and each batch of reports is saved with a single bulk_create.
+    Projects already reported until `end_date` are skipped, so an
+    interrupted run can be resumed with the same `end_date`.
     """
     logger.debug('create_reports - START')
-    user_allocation_list = UserAllocationSource.objects.all()
-    all_reports = []
-    end_date = timezone.now()
+    end_date = end_date or timezone.now()
     logger.debug('create_reports - end_date: %s', end_date)
-    max_report_end_date = TASAllocationReport.objects.all().aggregate(Max('end_date'))
-
-    if not max_report_end_date:
-        last_report_date = end_date
-    else:
-        last_report_date = max_report_end_date['end_date__max']
+    if since is None:
+        since = TASAllocationReport.objects.all().aggregate(Max('end_date'))['end_date__max']
+    last_report_date = since or end_date
     logger.info('create_reports - last_report_date: %s', last_report_date)
+    driver = TASAPIDriver()
 
-    for item in user_allocation_list:
+    tacc_usernames = {}
+    for item in UserAllocationSource.objects.select_related('user', 'allocation_source'):
         allocation_name = item.allocation_source.name
-        logger.debug('create_reports - allocation_name: %s', allocation_name)
-        logger.debug('create_reports - item.user: %s', item.user)
-        project_report = _create_reports_for(item.user, allocation_name, end_date)
-        if project_report:
-            all_reports.append(project_report)
+        tacc_username = driver.get_tacc_username(item.user)
+        if not tacc_username:
+            logger.error("No TACC username for user: '{}' which came from allocation id: {}".format(item.user,
+                                                                                                    allocation_name))
+            continue
+        project_name = driver.get_allocation_project_name(allocation_name)
+        if not project_name:
+            logger.error("No TACC project for allocation: '%s'", allocation_name)
+            continue
+        tacc_usernames[(item.user, project_name)] = tacc_username
+
+    last_end_dates = dict(
+        ((user_id, project_name), last_end_date) for user_id, project_name, last_end_date in
+        TASAllocationReport.objects.values('user_id', 'project_name')
+        .annotate(last_end_date=Max('end_date'))
+        .values_list('user_id', 'project_name', 'last_end_date'))
+    start_dates = {}
+    for user, project_name in tacc_usernames:
+        start_date = last_end_dates.get((user.id, project_name)) or user.date_joined
+        if start_date < end_date:
+            start_dates[(user, project_name)] = start_date
+
+    all_reports = []
+    pairs = sorted(start_dates, key=lambda pair: (pair[0].username, pair[1]))
+    batch_size = getattr(settings, 'TAS_REPORT_BATCH_SIZE', 200)
+    for index in xrange(0, len(pairs), batch_size):
+        batch = pairs[index:index + batch_size]
+        usage = allocation_usage(
+            dict(((user.username, project_name), start_dates[(user, project_name)])
+                 for user, project_name in batch),
+            end_date)
+        reports = []
+        for user, project_name in batch:
+            compute_used = usage[(user.username, project_name)]
+            if compute_used < 0:
+                logger.error("Compute usage was not accurately calculated for user:%s", user)
+                continue
+            reports.append(TASAllocationReport(
+                user=user,
+                username=tacc_usernames[(user, project_name)],
+                project_name=project_name,
+                compute_used=compute_used,
+                start_date=start_dates[(user, project_name)],
+                end_date=end_date,
+                tacc_api=settings.TACC_API_URL))
+        all_reports.extend(TASAllocationReport.objects.bulk_create(reports))
+        logger.info("Created %s New Reports (%s/%s)", len(reports), index + len(batch), len(pairs))
 
     # Take care of Deleted Users
 
@@ -62,16 +126,15 @@ def create_reports():
 
         user = AtmosphereUser.objects.get(username=event.entity_id)
         allocation_name = event.payload['allocation_source_name']
-        end_date = event.timestamp
-        project_report = _create_reports_for(user, allocation_name, end_date)
+        project_report = _create_reports_for(user, allocation_name, event.timestamp, driver=driver)
         if project_report:
             all_reports.append(project_report)
     return all_reports
 
 
-def _create_reports_for(user, allocation_name, end_date):
+def _create_reports_for(user, allocation_name, end_date, driver=None):
     logger.debug('_create_reports_for - user: %s, allocation_name: %s, end_date: %s', user, allocation_name, end_date)
-    driver = TASAPIDriver()
+    driver = driver or TASAPIDriver()
     tacc_username = driver.get_tacc_username(user)
     if not tacc_username:
         logger.error("No TACC username for user: '{}' which came from allocation id: {}".format(user,
@@ -113,6 +176,9 @@ def _create_tas_report_for(user, tacc_username, tacc_project_name, end_date):
         start_date = user.date_joined
     else:
         start_date = last_report.end_date
+    if start_date >= end_date:
+        # Already reported, by the run that is being resumed
+        return
 
     compute_used = total_usage(
         user.username, start_date,
@@ -138,35 +204,97 @@ def _create_tas_report_for(user, tacc_username, tacc_project_name, end_date):
 
 @task(name="report_allocations_to_tas")
 def report_allocations_to_tas():
-    logger.info("Reporting: Begin creating reports")
-    create_reports()
+    """
+    Create the reports of every user, then send them to TAS.
+    Each stage is checkpointed in a TASReportRun: a run that failed
+    is resumed by the next one, from the stage it failed in.
+    """
+    run = TASReportRun.resume_or_start()
+    if run.stage == TASReportRun.CREATE:
+        logger.info("Reporting: Begin creating reports until %s", run.end_date)
+        started = time.time()
+        reports = create_reports(end_date=run.end_date, since=run.since)
+        run.complete_stage(TASReportRun.CREATE, time.time() - started, TASReportRun.SEND,
+                           report_count=run.report_count + len(reports))
     logger.info("Reporting: Completed, begin sending reports")
-    send_reports()
-    logger.info("Reporting: Reports sent")
+    started = time.time()
+    sent_reports, failed_reports = _send_reports()
+    run.complete_stage(TASReportRun.SEND, time.time() - started, TASReportRun.FINISHED,
+                       sent_count=sent_reports, failed_count=failed_reports)
+    logger.info("Reporting: Reports sent -- %s", run)
+    logger.info("Reporting: Seconds per stage -- %s", run.timings)
+    if failed_reports != 0:
+        raise Exception("%s/%s reports failed to send to TAS" % (failed_reports, sent_reports + failed_reports))
 
 
 def send_reports():
-    failed_reports = 0
-    reports_to_send = TASAllocationReport.objects.filter(Q(compute_used__gt=0, success=False)).order_by(
-        'user__username', 'start_date')
-    count = reports_to_send.count()
-    logger.info('send_reports - count: %d', count)
-    for current_report_index, tas_report in enumerate(reports_to_send):
-        logger.debug('send_reports - current_report_index: %d', current_report_index)
-        try:
-            tas_report.send()
-        except TASPluginException:
-            logger.exception(
-                "Could not send the report because of the error below"
-            )
-            failed_reports += 1
-            continue
+    sent_reports, failed_reports = _send_reports()
     if failed_reports != 0:
-        raise Exception("%s/%s reports failed to send to TAS" % (failed_reports, count))
+        raise Exception("%s/%s reports failed to send to TAS" % (failed_reports, sent_reports + failed_reports))
+    return sent_reports
+
+
+def _send_reports(driver=None):
+    """
+    POST every unsent report to TAS, TAS_API_MAX_WORKERS at a time.
+    Reports are claimed first, so concurrent runs never send a report twice.
+    Returns (sent, failed)
+    """
+    driver = driver or TASAPIDriver()
+    report_ids = _claim_reports()
+    logger.info('send_reports - count: %d', len(report_ids))
+    sent_reports = failed_reports = 0
+    batch_size = getattr(settings, 'TAS_REPORT_BATCH_SIZE', 200)
+    for index in xrange(0, len(report_ids), batch_size):
+        reports = list(TASAllocationReport.objects.filter(id__in=report_ids[index:index + batch_size])
+                       .order_by('user__username', 'start_date'))
+        results = get_tas_client().map(partial(_post_report, driver), reports)
+        succeeded = [report.id for report, success in zip(reports, results) if success]
+        failed = [report.id for report, success in zip(reports, results) if not success]
+        TASAllocationReport.objects.filter(id__in=succeeded).update(
+            success=True, report_date=timezone.now(), claimed=None)
+        # Sent again by the next run
+        TASAllocationReport.objects.filter(id__in=failed).update(claimed=None)
+        sent_reports += len(succeeded)
+        failed_reports += len(failed)
+        logger.debug('send_reports - sent: %d, failed: %d', sent_reports, failed_reports)
+    return sent_reports, failed_reports
+
+
+def _claim_reports():
+    """
+    Mark the unsent reports (or those claimed more than TAS_REPORT_CLAIM_TIMEOUT
+    ago) as claimed, skipping the reports another run is claiming.
+    Returns their ids.
+    """
+    now = timezone.now()
+    claim_timeout = getattr(settings, 'TAS_REPORT_CLAIM_TIMEOUT', timedelta(hours=1))
+    with transaction.atomic():
+        report_ids = list(
+            TASAllocationReport.objects.select_for_update(skip_locked=True)
+            .filter(Q(compute_used__gt=0, success=False) &
+                    Q(Q(claimed__isnull=True) | Q(claimed__lt=now - claim_timeout)))
+            .order_by('id').values_list('id', flat=True))
+        TASAllocationReport.objects.filter(id__in=report_ids).update(claimed=now)
+    return report_ids
+
+
+def _post_report(driver, report):
+    """
+    Send `report` to TAS. Returns True once TAS accepted it.
+    """
+    try:
+        return bool(driver.report_project_allocation(
+            report.id, report.username, report.project_name,
+            float(report.compute_used), report.start_date, report.end_date,
+            report.queue_name, report.scheduler_id))
+    except Exception:
+        logger.exception("Could not send the report %s because of the error below", report.id)
+        return False
 
 
 @task(name="update_snapshot")
-def update_snapshot(start_date=None, end_date=None):
+def update_snapshot(start_date=None, end_date=None, rebuild=False):
     end_date = end_date or timezone.now()
     # TODO: Read this start_date from last 'reset event' for each allocation source
     start_date = start_date or '2016-09-01 00:00:00.0-05'
@@ -192,11 +320,12 @@ def update_snapshot(start_date=None, end_date=None):
                 # if renewed, change ignore old allocation usage
                 start_date = created_or_updated_event.payload['start_date']
 
+            if isinstance(start_date, basestring):
+                start_date = parse(start_date)
+
             for user in allocation_source.all_users:
-                compute_used, burn_rate = total_usage(user.username, start_date,
-                                                      allocation_source_name=allocation_source.name,
-                                                      end_date=end_date,
-                                                      burn_rate=True)
+                compute_used, burn_rate = snapshot_usage(user, allocation_source, start_date, end_date,
+                                                         rebuild=rebuild)
                 total_burn_rate += burn_rate
                 UserAllocationSnapshot.objects.update_or_create(
                     allocation_source_id=allocation_source.id,
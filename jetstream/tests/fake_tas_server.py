@@ -0,0 +1,117 @@
+"""
+A local TAS API over HTTP, serving the same fixtures as the mocked
+`tacc_api_get` of `tas_api_mock_utils` (See features/steps/tas_api_steps.py)
+
+    with FakeTASServer(context, latency=0.05) as server:
+        with override_settings(TACC_API_URL=server.url):
+            fill_user_allocation_sources()
+"""
+import json
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from django.utils import timezone
+
+from jetstream.tests.tas_api_mock_utils import get_tas_api_data, reset_mock_tas_fixtures
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeTASRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like TAS (idle connections are closed after `timeout` seconds)
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+
+    def do_GET(self):
+        self.server.fake_tas.record(self.path)
+        try:
+            data = get_tas_api_data(self.server.fake_tas.context, self.path)
+        except ValueError:
+            return self._respond(404, {'status': 'error', 'message': 'Not found', 'result': None})
+        self._respond(200, data)
+
+    def do_POST(self):
+        self.server.fake_tas.record(self.path)
+        self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self._respond(200, {'status': 'success', 'message': None, 'result': None})
+
+    def _respond(self, status, data):
+        time.sleep(self.server.fake_tas.latency)
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTASServer(object):
+    """
+    Serves the TAS fixtures of `context` on a free local port,
+    waiting `latency` seconds before each response
+    """
+
+    def __init__(self, context, latency=0.0):
+        self.context = context
+        self.latency = latency
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server.server_address
+
+    def record(self, path):
+        with self.lock:
+            self.requests.append(path)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTASRequestHandler)
+        self.server.fake_tas = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def make_tas_fixtures(context, xsede_usernames, users_per_project=5):
+    """
+    Fill `context` like the TAS steps would: a TACC user for each XSEDE
+    username, and a project (with an active allocation) per `users_per_project` users
+    """
+    reset_mock_tas_fixtures(context)
+    now = timezone.now()
+    start = (now - timezone.timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    end = (now + timezone.timedelta(days=365)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    context.tas_project_to_tacc_username_mapping = {}
+    for index, xsede_username in enumerate(xsede_usernames):
+        tacc_username = 'tacc_%s' % xsede_username
+        context.xsede_to_tacc_username_mapping[xsede_username] = tacc_username
+        project_id = str(index // users_per_project + 1)
+        charge_code = 'TG-FAKE%s' % project_id
+        if index % users_per_project == 0:
+            context.tas_projects.append({'id': project_id, 'chargeCode': charge_code, 'allocations': [{
+                'id': project_id, 'projectId': project_id, 'project': charge_code,
+                'computeAllocated': '1000000', 'computeUsed': '0', 'start': start, 'end': end,
+                'status': 'Active', 'resource': 'Jetstream'}]})
+        context.tas_project_to_tacc_username_mapping.setdefault(charge_code, []).append(tacc_username)
+        context.tacc_username_to_tas_project_mapping.setdefault(tacc_username, set()).add(charge_code)
+    return context
@@ -25,6 +25,23 @@ def _get_xsede_to_tacc_username(context, url):
     return data
 
 
+def _get_project_users(context, url):
+    project_id = url.split('/v1/projects/')[-1].split('/users')[0]
+    project_users = getattr(context, 'tas_project_to_tacc_username_mapping', {})
+    users = []
+    for project in context.tas_projects:
+        if str(project['id']) == project_id:
+            users = [{'username': username} for username in project_users.get(project['chargeCode'], [])]
+    data = {'status': 'success', 'message': None, 'result': users}
+    return data
+
+
+def _get_tas_allocations(context):
+    allocations = [allocation for project in context.tas_projects for allocation in project['allocations']]
+    data = {'status': 'success', 'message': None, 'result': allocations}
+    return data
+
+
 def _get_user_projects(context, url):
     tacc_username = url.split('/v1/projects/username/')[-1]
     project_names = list(context.tacc_username_to_tas_project_mapping.get(tacc_username, []))
@@ -33,6 +50,25 @@ def _get_user_projects(context, url):
     return data
 
 
+def get_tas_api_data(context, url):
+    """
+    The data TAS would respond to a GET of `url`, given the fixtures in `context`
+    """
+    if url.endswith('/v1/projects/resource/Jetstream'):
+        data = _get_tas_projects(context)
+    elif url.endswith('/v1/allocations/resource/Jetstream'):
+        data = _get_tas_allocations(context)
+    elif '/v1/users/xsede/' in url:
+        data = _get_xsede_to_tacc_username(context, url)
+    elif '/v1/projects/username/' in url:  # This can return 'Inactive', 'Active', and 'Approved' allocations. Maybe more.
+        data = _get_user_projects(context, url)
+    elif '/v1/projects/' in url and url.endswith('/users'):
+        data = _get_project_users(context, url)
+    else:
+        raise ValueError('Unknown URL: {}'.format(url))
+    return data
+
+
 def _make_mock_tacc_api_get(context, is_tas_up=True):
     def _mock_tacc_api_get_down(*args, **kwargs):
         raise jetstream_exceptions.TASAPIException('503 Service Unavailable')
@@ -43,14 +79,7 @@ def _make_mock_tacc_api_get(context, is_tas_up=True):
     def _mock_tacc_api_get(*args, **kwargs):
         url = args[0]
         assert isinstance(url, basestring)
-        if url.endswith('/v1/projects/resource/Jetstream'):
-            data = _get_tas_projects(context)
-        elif '/v1/users/xsede/' in url:
-            data = _get_xsede_to_tacc_username(context, url)
-        elif '/v1/projects/username/' in url:  # This can return 'Inactive', 'Active', and 'Approved' allocations. Maybe more.
-            data = _get_user_projects(context, url)
-        else:
-            raise ValueError('Unknown URL: {}'.format(url))
+        data = get_tas_api_data(context, url)
         if not data:
             raise jetstream_exceptions.TASAPIException('Invalid Response')
         return None, data
@@ -0,0 +1,84 @@
+import threading
+from unittest import skipUnless
+
+import mock
+from django.apps import apps
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from api.tests.factories import UserFactory
+from jetstream import allocation
+from jetstream.exceptions import TASAPIException
+from jetstream.tests.tas_api_mock_utils import _make_mock_tacc_api_get, reset_mock_tas_fixtures
+
+
+class TASContext(object):
+    pass
+
+
+@skipUnless(apps.is_installed('jetstream'), 'Requires the jetstream app')
+@override_settings(TAS_API_MAX_WORKERS=1)
+class PrefetchUserAllocationsTest(TestCase):
+    def setUp(self):
+        self.context = TASContext()
+        reset_mock_tas_fixtures(self.context)
+        now = timezone.now()
+        self.context.tas_projects = [{
+            'id': 1, 'chargeCode': 'TG-A',
+            'allocations': [{'resource': 'Jetstream', 'status': 'Active',
+                             'start': (now - timezone.timedelta(days=1)).isoformat(),
+                             'end': (now + timezone.timedelta(days=1)).isoformat()}]}]
+        self.context.xsede_to_tacc_username_mapping = {'user1': 'tacc_user1', 'user2': 'tacc_user2'}
+        self.context.tacc_username_to_tas_project_mapping = {'tacc_user1': ['TG-A'], 'tacc_user2': ['TG-A']}
+        self.failing_urls = set()
+        mock_tacc_api_get = _make_mock_tacc_api_get(self.context)
+
+        def _tacc_api_get(url, *args, **kwargs):
+            if url in self.failing_urls:
+                raise TASAPIException('503 Service Unavailable')
+            return mock_tacc_api_get(url, *args, **kwargs)
+        patcher = mock.patch.object(allocation, 'tacc_api_get', side_effect=_tacc_api_get)
+        self.tacc_api_get = patcher.start()
+        self.addCleanup(patcher.stop)
+        allocation.TASAPIDriver.username_map = {}
+        self.users = [UserFactory.create(username='user1'), UserFactory.create(username='user2')]
+
+    def test_failed_user_is_fetched_again(self):
+        driver = allocation.TASAPIDriver()
+        self.failing_urls.add(driver.tacc_api + '/v1/projects/username/tacc_user2')
+        driver.prefetch_user_allocations(self.users)
+        self.assertEqual(list(driver.user_allocation_map), ['tacc_user1'])
+
+        self.failing_urls.clear()
+        self.tacc_api_get.reset_mock()
+        self.assertEqual(len(driver.get_user_allocations('tacc_user1')), 1)
+        self.assertFalse(self.tacc_api_get.called)
+        self.assertEqual(len(driver.get_user_allocations('tacc_user2')), 1)
+        self.assertEqual(self.tacc_api_get.call_count, 1)
+
+    @override_settings(TAS_API_MAX_WORKERS=2)
+    def test_mappings_are_read_and_saved_by_the_caller(self):
+        from jetstream.models import TACCUsernameMapping
+        TACCUsernameMapping.record({'user1': 'tacc_user1'})
+        caller = threading.current_thread()
+        threads = set()
+        lookup_all = TACCUsernameMapping.lookup_all.__func__
+        record = TACCUsernameMapping.record.__func__
+
+        def _lookup_all(cls, *args):
+            threads.add(threading.current_thread())
+            return lookup_all(cls, *args)
+
+        def _record(cls, *args):
+            threads.add(threading.current_thread())
+            return record(cls, *args)
+        with mock.patch.object(TACCUsernameMapping, 'lookup_all', classmethod(_lookup_all)), \
+                mock.patch.object(TACCUsernameMapping, 'record', classmethod(_record)), \
+                mock.patch.object(TACCUsernameMapping, 'lookup') as lookup:
+            driver = allocation.TASAPIDriver()
+            driver.prefetch_user_allocations(self.users)
+        self.assertEqual(threads, set([caller]))
+        self.assertFalse(lookup.called)
+        self.assertEqual(sorted(driver.user_allocation_map), ['tacc_user1', 'tacc_user2'])
+        self.assertEqual(self.tacc_api_get.call_count, 3)
+        self.assertEqual(TACCUsernameMapping.objects.get(xsede_username='user2').tacc_username, 'tacc_user2')
@@ -0,0 +1,66 @@
+from unittest import skipUnless
+
+import mock
+from django.apps import apps
+from django.test import TestCase
+from django.utils import timezone
+
+from api.tests.factories import UserFactory
+from jetstream import allocation
+from jetstream.exceptions import NoTaccUserForXsedeException
+from jetstream.tests.tas_api_mock_utils import _make_mock_tacc_api_get, reset_mock_tas_fixtures
+
+
+class TASContext(object):
+    pass
+
+
+@skipUnless(apps.is_installed('jetstream'), 'Requires the jetstream app')
+class TACCUsernameMappingTest(TestCase):
+    def setUp(self):
+        from jetstream.models import TACCUsernameMapping
+        self.mappings = TACCUsernameMapping.objects
+        self.context = TASContext()
+        reset_mock_tas_fixtures(self.context)
+        self.context.xsede_to_tacc_username_mapping = {'user1': 'tacc_user1'}
+        patcher = mock.patch.object(allocation, 'tacc_api_get',
+                                    side_effect=_make_mock_tacc_api_get(self.context))
+        self.tacc_api_get = patcher.start()
+        self.addCleanup(patcher.stop)
+        allocation.TASAPIDriver.username_map = {}
+        self.user1 = UserFactory.create(username='user1')
+        self.user2 = UserFactory.create(username='user2')
+
+    def test_refresh_saves_mappings_and_missing_users(self):
+        self.assertEqual(allocation.refresh_tacc_usernames(usernames=['user1', 'user2']), 2)
+        self.assertEqual(dict(self.mappings.values_list('xsede_username', 'tacc_username')),
+                         {'user1': 'tacc_user1', 'user2': None})
+
+        allocation.TASAPIDriver.username_map = {}
+        self.tacc_api_get.reset_mock()
+        driver = allocation.TASAPIDriver()
+        self.assertEqual(driver.get_tacc_username(self.user1), 'tacc_user1')
+        self.assertIsNone(driver.get_tacc_username(self.user2))
+        with self.assertRaises(NoTaccUserForXsedeException):
+            driver.get_tacc_username(self.user2, raise_exception=True)
+        self.assertFalse(self.tacc_api_get.called)
+
+    def test_stale_mappings_are_resolved_again(self):
+        allocation.refresh_tacc_usernames(usernames=['user1', 'user2'])
+        self.mappings.update(refreshed=timezone.now() - timezone.timedelta(days=7))
+        self.context.xsede_to_tacc_username_mapping['user2'] = 'tacc_user2'
+        allocation.TASAPIDriver.username_map = {}
+        self.tacc_api_get.reset_mock()
+
+        self.assertEqual(allocation.TASAPIDriver().get_tacc_username(self.user2), 'tacc_user2')
+        self.assertEqual(self.tacc_api_get.call_count, 1)
+        self.assertEqual(self.mappings.get(xsede_username='user2').tacc_username, 'tacc_user2')
+
+    def test_record_tolerates_concurrent_inserts(self):
+        from jetstream.models import TACCUsernameMapping
+        self.mappings.create(xsede_username='user1', tacc_username=None)
+        # Inserted by another worker after `record` read the existing mappings
+        with mock.patch.object(TACCUsernameMapping.objects, 'filter', return_value=self.mappings.none()):
+            TACCUsernameMapping.record({'user1': 'tacc_user1', 'user2': None})
+        self.assertEqual(dict(self.mappings.values_list('xsede_username', 'tacc_username')),
+                         {'user1': 'tacc_user1', 'user2': None})
@@ -0,0 +1,62 @@
+"""
+Benchmark a `fill_user_allocation_sources` sweep against a fake TAS API,
+with TAS_API_MAX_WORKERS concurrent requests. Run with:
+
+    ATMO_BENCHMARK=1 ./manage.py test jetstream.tests.test_tas_benchmark
+
+ATMO_BENCHMARK_SCALE sets the number of users, ATMO_TAS_LATENCY the
+seconds the fake TAS API takes per response.
+"""
+import os
+import time
+from unittest import skipUnless
+
+from django.test import TestCase, override_settings
+
+from core.models import AtmosphereUser, UserAllocationSource
+from jetstream.allocation import TASAPIDriver, fill_user_allocation_sources
+from jetstream.tests.fake_tas_server import FakeTASServer, make_tas_fixtures
+
+BENCHMARK_SCALE = int(os.environ.get('ATMO_BENCHMARK_SCALE', 200))
+TAS_LATENCY = float(os.environ.get('ATMO_TAS_LATENCY', 0.02))
+
+
+class FakeTASContext(object):
+    pass
+
+
+@skipUnless(os.environ.get('ATMO_BENCHMARK'), 'Set ATMO_BENCHMARK=1 to run TAS benchmarks')
+class TASSweepBenchmark(TestCase):
+    scale = BENCHMARK_SCALE
+
+    def setUp(self):
+        usernames = ['tas-benchmark-%d' % index for index in xrange(self.scale)]
+        AtmosphereUser.objects.bulk_create([AtmosphereUser(username=username) for username in usernames])
+        self.context = make_tas_fixtures(FakeTASContext(), usernames)
+        self.server = FakeTASServer(self.context, latency=TAS_LATENCY).start()
+        self.addCleanup(self.server.stop)
+        settings_override = override_settings(
+            TACC_API_URL=self.server.url, TACC_API_USER='benchmark', TACC_API_PASS='benchmark',
+            TAS_API_CACHE_TTL=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        TASAPIDriver.username_map = {}
+
+    def _timed(self, method):
+        started = time.time()
+        result = method()
+        return result, time.time() - started
+
+    def test_fill_user_allocation_sources(self):
+        _, elapsed = self._timed(fill_user_allocation_sources)
+        serial_seconds = len(self.server.requests) * TAS_LATENCY
+        print "\nfill_user_allocation_sources: %s users, %s TAS requests in %.3fs (%.3fs if serial)" % (
+            self.scale, len(self.server.requests), elapsed, serial_seconds)
+        self.assertEqual(UserAllocationSource.objects.filter(
+            user__username__startswith='tas-benchmark-').count(), self.scale)
+
+    def test_get_all_project_users(self):
+        project_users, elapsed = self._timed(TASAPIDriver().get_all_project_users)
+        print "\nget_all_project_users: %s projects in %.3fs" % (len(project_users), elapsed)
+        self.assertEqual(len(project_users), len(self.context.tas_projects))
+        self.assertLess(elapsed, len(project_users) * TAS_LATENCY)
@@ -0,0 +1,71 @@
+from unittest import skipUnless
+
+import mock
+from dateutil.parser import parse
+from django.apps import apps
+from django.test import TestCase
+from django.utils import timezone
+
+from api.tests.factories import UserFactory
+
+
+@skipUnless(apps.is_installed('jetstream'), 'Requires the jetstream app')
+class SendReportsTest(TestCase):
+    def setUp(self):
+        from jetstream.models import TASAllocationReport
+        self.reports = TASAllocationReport.objects
+        self.user = UserFactory.create(username='user1')
+        start_date = parse('2017-01-01T00:00:00+00:00')
+        for project_name in ['TG-A', 'TG-B', 'TG-C']:
+            self.reports.create(
+                user=self.user, username='tacc_user1', project_name=project_name,
+                compute_used=10, start_date=start_date,
+                end_date=start_date + timezone.timedelta(days=1), tacc_api='https://tas.example.org')
+        # Being sent by another run
+        self.reports.filter(project_name='TG-C').update(claimed=timezone.now())
+        patcher = mock.patch('jetstream.tasks.TASAPIDriver')
+        self.driver = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+        def _report_project_allocation(report_id, username, project_name, *args):
+            if project_name == 'TG-B':
+                raise Exception("Invalid Response")
+            return {'status': 'success'}
+        self.driver.report_project_allocation.side_effect = _report_project_allocation
+
+    def test_reports_are_sent_once(self):
+        from jetstream.tasks import _send_reports
+        self.assertEqual(_send_reports(), (1, 1))
+        self.assertEqual(self.driver.report_project_allocation.call_count, 2)
+        sent = self.reports.get(project_name='TG-A')
+        self.assertTrue(sent.success)
+        self.assertIsNotNone(sent.report_date)
+        failed = self.reports.get(project_name='TG-B')
+        self.assertFalse(failed.success)
+        self.assertIsNone(failed.claimed)
+
+        self.driver.report_project_allocation.reset_mock()
+        self.assertEqual(_send_reports(), (0, 1))
+        self.assertEqual(
+            [call[0][2] for call in self.driver.report_project_allocation.call_args_list], ['TG-B'])
+
+    def test_stale_claims_are_sent_again(self):
+        from jetstream.tasks import _send_reports
+        self.reports.filter(project_name='TG-C').update(claimed=timezone.now() - timezone.timedelta(days=1))
+        self.assertEqual(_send_reports(), (2, 1))
+
+
+@skipUnless(apps.is_installed('jetstream'), 'Requires the jetstream app')
+class TASReportRunTest(TestCase):
+    def test_unfinished_run_is_resumed(self):
+        from jetstream.models import TASReportRun
+        run = TASReportRun.resume_or_start()
+        run.complete_stage(TASReportRun.CREATE, 2.5, TASReportRun.SEND, report_count=3)
+
+        resumed = TASReportRun.resume_or_start()
+        self.assertEqual(resumed.id, run.id)
+        self.assertEqual(resumed.stage, TASReportRun.SEND)
+        self.assertEqual(resumed.timings, {TASReportRun.CREATE: 2.5})
+
+        resumed.complete_stage(TASReportRun.SEND, 1, TASReportRun.FINISHED)
+        self.assertNotEqual(TASReportRun.resume_or_start().id, run.id)
@@ -1,16 +1,19 @@
 import datetime
+import uuid
 
 import pytz
 from dateutil.parser import parse
+from django.conf import settings
 from django.db.models.query import Q
 from threepio import logger
 
 from core.models import EventTable
 from core.models.allocation_source import AllocationSource
 from core.models.instance import Instance
+from core.models.instance_history import InstanceStatusHistory
 
 
-def create_report(report_start_date, report_end_date, user_id=None, allocation_source_name=None):
+def create_report(report_start_date, report_end_date, user_id=None, allocation_source_name=None, engine=None):
     if not report_start_date or not report_end_date:
         raise Exception("Start date and end date missing for allocation calculation function")
     try:
@@ -18,7 +21,12 @@ def create_report(report_start_date, report_end_date, user_id=None, allocation_s
         report_end_date = report_end_date if isinstance(report_end_date, datetime.datetime) else parse(report_end_date)
     except:
         raise Exception("Cannot parse start and end dates for allocation calculation function")
-    data = generate_data(report_start_date, report_end_date, username=user_id)
+    engine = engine or getattr(settings, 'ALLOCATION_REPORT_ENGINE', 'bulk')
+    try:
+        generate = REPORT_ENGINES[engine]
+    except KeyError:
+        raise Exception("Unknown allocation report engine '%s'" % engine)
+    data = generate(report_start_date, report_end_date, username=user_id)
     if allocation_source_name:
         output = []
         for row in data:
@@ -44,23 +52,9 @@ def generate_data(report_start_date, report_end_date, username=None):
 
 def filter_events_and_instances(report_start_date, report_end_date, username=None):
     events = EventTable.objects.filter(Q(timestamp__gte=report_start_date) & Q(timestamp__lte=report_end_date) & Q(name__exact="instance_allocation_source_changed")).order_by('timestamp')
-    instances = Instance.objects.filter(
-        Q(
-            Q(start_date__gte=report_start_date) & Q(start_date__lte=report_end_date)
-        ) |
-        Q(
-            Q(end_date__gte=report_start_date) & Q(end_date__lte=report_end_date)
-        ) |
-        Q(
-            Q(start_date__lte=report_start_date) & Q(Q(end_date__isnull=True) | Q(end_date__gte=report_end_date))
-        )
-    )
+    instances = Instance.objects.filter(_instances_in_report_query(report_start_date, report_end_date))
     if username:
-        from core.models.user import AtmosphereUser
-        try:
-            user_id_int = AtmosphereUser.objects.get(username=username)
-        except:
-            raise Exception("User '%s' does not exist"%(username))
+        user_id_int = _get_report_user(username)
         events = events.filter(Q(payload__username__exact=username) | Q(entity_id=username)).order_by('timestamp')
         instances = instances.filter(Q(created_by__exact=user_id_int))
     instance_ids = instances.values_list("id", flat=True)
@@ -68,6 +62,24 @@ def filter_events_and_instances(report_start_date, report_end_date, username=Non
     return {'events': events, 'instances': instances}
 
 
+def _instances_in_report_query(report_start_date, report_end_date):
+    return Q(
+        Q(start_date__gte=report_start_date) & Q(start_date__lte=report_end_date)
+    ) | Q(
+        Q(end_date__gte=report_start_date) & Q(end_date__lte=report_end_date)
+    ) | Q(
+        Q(start_date__lte=report_start_date) & Q(Q(end_date__isnull=True) | Q(end_date__gte=report_end_date))
+    )
+
+
+def _get_report_user(username):
+    from core.models.user import AtmosphereUser
+    try:
+        return AtmosphereUser.objects.get(username=username)
+    except:
+        raise Exception("User '%s' does not exist"%(username))
+
+
 def group_events_by_instances(events):
     out_dic = {}
 
@@ -183,11 +195,15 @@ def create_rows(filtered_instance_histories, events_histories_dict, report_start
 
 
 def calculate_allocation(hist, start_date, end_date, report_start_date, report_end_date):
+    return _applicable_duration(hist.status.name, hist.size.cpu, start_date, end_date,
+                                report_start_date, report_end_date)
 
-    if hist.status.name == 'active':
+
+def _applicable_duration(status_name, cpu, start_date, end_date, report_start_date, report_end_date):
+    if status_name == 'active':
         effective_start_date = max(start_date, report_start_date)
         effective_end_date = report_end_date if end_date is None else min(end_date, report_end_date)
-        applicable_duration = (effective_end_date - effective_start_date).total_seconds()*hist.size.cpu
+        applicable_duration = (effective_end_date - effective_start_date).total_seconds()*cpu
         return applicable_duration
     else:
         return 0
@@ -246,3 +262,193 @@ def get_instance_burn_rate_from_row(row):
         if is_running_at_report_end:
             burn_rate = row['cpu']
     return burn_rate
+
+
+def generate_data_bulk(report_start_date, report_end_date, username=None, usernames=None):
+    """
+    Set-based equivalent of `generate_data`.
+    `usernames` limits the report to the instances of several users.
+
+    Instances, status histories (with their size and status), allocation
+    sources and `instance_allocation_source_changed` events are each
+    loaded in a single query. Each instance is then swept in timestamp
+    order to produce the same rows as `create_rows`, so the number of
+    queries no longer grows with the number of instances or histories.
+
+    NOTE: 'current_time' is computed once per report, not once per row.
+    """
+    instances = Instance.objects.filter(_instances_in_report_query(report_start_date, report_end_date))
+    # Events before the report window decide each instance's starting
+    # allocation source, so one query covers both uses.
+    events = EventTable.objects.filter(
+        Q(timestamp__lte=report_end_date) & Q(name__exact="instance_allocation_source_changed"))
+    if username:
+        user = _get_report_user(username)
+        instances = instances.filter(Q(created_by__exact=user))
+        events = events.filter(Q(payload__username__exact=username) | Q(entity_id=username))
+    elif usernames is not None:
+        instances = instances.filter(created_by__username__in=list(usernames))
+
+    instance_rows = instances.values_list(
+        'id', 'provider_alias', 'created_by__username',
+        'source__providermachine__application_version__application__name')
+    history_rows = InstanceStatusHistory.objects.filter(
+        ~Q(start_date__gte=report_end_date) &
+        ~Q(
+            Q(end_date__isnull=False) & Q(end_date__lte=report_start_date)
+        ) &
+        Q(instance__in=instances.values('id'))
+    ).order_by('instance', 'start_date', 'id').values_list(
+        'id', 'instance_id', 'start_date', 'end_date',
+        'status__name', 'size__cpu', 'size__mem', 'size__disk')
+    event_rows = events.order_by('timestamp').values_list('timestamp', 'entity_id', 'payload')
+
+    source_names = set()
+    source_uuids = {}
+    for name, source_uuid in AllocationSource.objects.values_list('name', 'uuid'):
+        source_names.add(name)
+        source_uuids[source_uuid] = name
+
+    histories_by_instance = {}
+    for history in history_rows:
+        histories_by_instance.setdefault(history[1], []).append(history)
+
+    events_by_instance = {}
+    for timestamp, entity_id, payload in event_rows:
+        provider_alias = payload.get('instance_id')
+        if provider_alias:
+            events_by_instance.setdefault(provider_alias, []).append((timestamp, entity_id, payload))
+
+    # Keyed by provider_alias, like `get_all_histories_for_instance`
+    report_instances = {}
+    for instance_id, provider_alias, creator, image_name in instance_rows:
+        report_instances[provider_alias] = (
+            creator, image_name, histories_by_instance.get(instance_id, []))
+
+    data = []
+    still_running = _get_current_date_utc()
+    total_burn_rate = 0
+    for provider_alias, (creator, image_name, histories) in report_instances.iteritems():
+        if not histories:
+            continue
+        events = events_by_instance.get(provider_alias, [])
+        allocation_source_name = _starting_allocation_source_name(
+            events, creator, max(report_start_date, histories[0][2]),
+            source_names, source_uuids)
+        events_histories_dict = _map_events_to_sorted_histories(
+            histories, events, report_start_date)
+        for history in histories:
+            history_id, _, start_date, end_date, status_name, cpu, mem, disk = history
+            end_date = still_running if not end_date else end_date
+            row = {
+                'username': creator, 'instance_id': history[1], 'allocation_source': allocation_source_name,
+                'image_name': image_name, 'provider_alias': provider_alias,
+                'instance_status_history_id': history_id, 'cpu': cpu, 'memory': mem, 'disk': disk,
+                'instance_status_start_date': start_date, 'instance_status_end_date': end_date,
+                'report_start_date': report_start_date, 'report_end_date': report_end_date,
+                'instance_status': status_name, 'duration': (end_date - start_date).total_seconds(),
+                'applicable_duration': '', 'burn_rate': '', 'current_time': still_running}
+            # Matches `create_rows`: a running total across every row so far
+            if status_name == 'active' and not history[3]:
+                total_burn_rate += 1
+            row['burn_rate'] = total_burn_rate
+            for payload in events_histories_dict.get(history_id, []):
+                event_row = row.copy()
+                event_row['instance_status_start_date'] = start_date
+                event_row['instance_status_end_date'] = payload['timestamp']
+                event_row['allocation_source'] = allocation_source_name
+                event_row['applicable_duration'] = _applicable_duration(
+                    status_name, cpu, start_date, payload['timestamp'], report_start_date, report_end_date)
+                data.append(event_row)
+                allocation_source_name = payload['allocation_source_name']
+                start_date = payload['timestamp']
+            row['instance_status_start_date'] = start_date
+            row['allocation_source'] = allocation_source_name
+            row['applicable_duration'] = _applicable_duration(
+                status_name, cpu, start_date, end_date, report_start_date, report_end_date)
+            data.append(row)
+    return data
+
+
+def _starting_allocation_source_name(events, username, before_date, source_names, source_uuids):
+    """
+    In-memory equivalent of `get_allocation_source_name_from_event`.
+
+    `events` are the timestamp-ordered change events of a single instance.
+    """
+    last_payload = None
+    for timestamp, entity_id, payload in events:
+        if timestamp >= before_date:
+            break
+        if payload.get('username') == username or entity_id == username:
+            last_payload = payload
+    if not last_payload:
+        return 'N/A'
+    try:
+        allocation_source_name = last_payload['allocation_source_name']
+        if allocation_source_name not in source_names:
+            allocation_source_name = None
+    except KeyError:
+        allocation_source_name = source_uuids.get(uuid.UUID(str(last_payload['allocation_source_id'])))
+    if allocation_source_name is None:
+        raise AllocationSource.DoesNotExist(
+            "AllocationSource in event payload %s does not exist" % last_payload)
+    return allocation_source_name or 'N/A'
+
+
+def _map_events_to_sorted_histories(histories, events, report_start_date):
+    """
+    Sweep equivalent of `map_events_to_histories` for a single instance.
+
+    Both `histories` and `events` are ordered by date. Each event inside
+    the report window is assigned to the last history that contains it.
+    The returned payloads carry the event 'timestamp' and the new
+    'allocation_source_name' ('N/A' if it is missing).
+    """
+    out_dic = {}
+    started = 0
+    for timestamp, _, payload in events:
+        if timestamp < report_start_date:
+            continue
+        while started < len(histories) and histories[started][2] <= timestamp:
+            started += 1
+        for index in xrange(started - 1, -1, -1):
+            history_end_date = histories[index][3]
+            if not history_end_date or history_end_date >= timestamp:
+                out_dic.setdefault(histories[index][0], []).append({
+                    'timestamp': timestamp,
+                    'allocation_source_name': payload.get('allocation_source_name', 'N/A')})
+                break
+    return out_dic
+
+
+def allocation_usage(report_start_dates, report_end_date):
+    """
+    `total_usage` of many (username, allocation_source_name) pairs at once.
+
+    `report_start_dates` maps each pair to the start of its report. The rows
+    of every pair come from a single `generate_data_bulk` pass, starting at
+    the earliest start date, and are then clipped to the pair's own range.
+    Returns {(username, allocation_source_name): compute used, in hours}
+    """
+    if not report_start_dates:
+        return {}
+    usernames = set(username for username, _ in report_start_dates)
+    data = generate_data_bulk(min(report_start_dates.values()), report_end_date, usernames=usernames)
+    used_seconds = dict.fromkeys(report_start_dates, 0.0)
+    for row in data:
+        key = (row['username'], row['allocation_source'])
+        report_start_date = report_start_dates.get(key)
+        if not report_start_date or row['instance_status_end_date'] <= report_start_date:
+            continue
+        used_seconds[key] += _applicable_duration(
+            row['instance_status'], row['cpu'],
+            row['instance_status_start_date'], row['instance_status_end_date'],
+            report_start_date, report_end_date)
+    return dict((key, round(seconds/3600.0, 2)) for key, seconds in used_seconds.items())
+
+
+REPORT_ENGINES = {
+    'legacy': generate_data,
+    'bulk': generate_data_bulk,
+}
@@ -1,16 +1,21 @@
-import cPickle as pickle
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
 from django.conf import settings
 from django.utils import timezone
+from django.utils.timezone import datetime, timedelta
 
 import redis
 
 from threepio import logger
 
+from service import cache_schema
 from service.driver import get_esh_driver, get_admin_driver
 
 
-admin_drivers = {}
-drivers = {}
 connection = None
 
 INSTANCES_KEY_PROVIDER = "instances.{0}"
@@ -19,20 +24,113 @@ VOLUMES_KEY_PROVIDER = "volumes.{0}"
 VOLUMES_KEY_IDENTITY = "volumes.{0}.{1}"
 MACHINES_KEY_PROVIDER = "machines.{0}"
 MACHINES_KEY_IDENTITY = "machines.{0}.{1}"
-
-
-def _get_cached_admin_driver(provider, force=True):
-    if not admin_drivers.get(provider) or force:
-        admin_drivers[provider] = get_admin_driver(provider)
-    return admin_drivers[provider]
-
-
-def _get_cached_driver(provider=None, identity=None, force=True):
+CACHE_METRICS_KEY = "cache_metrics.{0}"
+FRESH_KEY = "{0}.fresh"
+LOCK_KEY = "{0}.refresh_lock"
+REFRESH_POLL_INTERVAL = 0.1
+
+# Seconds, unless overridden in settings.DRIVER_CACHE_TTL
+DEFAULT_CACHE_TTL = 30
+
+
+class DriverPool(object):
+    """
+    Process-wide pool of rtwo drivers, keyed by provider, identity
+    and a hash of the identity credentials.
+
+    A driver (and its Keystone token) is reused until shortly before
+    the token expires (See `settings.DRIVER_POOL_EXPIRY_MARGIN`),
+    and the least recently used drivers are evicted once the pool holds
+    `settings.DRIVER_POOL_SIZE` drivers.
+    """
+
+    def __init__(self):
+        self.drivers = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.auth_seconds = 0.0
+
+    def get(self, key, build_method, force=False):
+        now = timezone.now()
+        with self.lock:
+            entry = self.drivers.pop(key, None)
+            if entry and not force and entry[1] > now:
+                self.drivers[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        started = time.time()
+        driver = build_method()
+        elapsed = time.time() - started
+        logger.debug("Built driver %s in %.3fs" % (key, elapsed))
+        with self.lock:
+            self.auth_seconds += elapsed
+            if not driver:
+                return driver
+            self.drivers[key] = (driver, self._expires(driver, now))
+            while len(self.drivers) > getattr(settings, 'DRIVER_POOL_SIZE', 100):
+                self.drivers.popitem(last=False)
+                self.evictions += 1
+        return driver
+
+    def _expires(self, driver, now):
+        """
+        Returns when `driver` should be rebuilt: `DRIVER_POOL_EXPIRY_MARGIN`
+        before its (libcloud) token expires, or after `DRIVER_POOL_MAX_AGE`.
+        """
+        margin = getattr(settings, 'DRIVER_POOL_EXPIRY_MARGIN', timedelta(minutes=5))
+        expires = now + getattr(settings, 'DRIVER_POOL_MAX_AGE', timedelta(hours=1))
+        lc_connection = getattr(getattr(driver, '_connection', None), 'connection', None)
+        token_expires = getattr(lc_connection, 'auth_token_expires', None)
+        if isinstance(token_expires, datetime):
+            if timezone.is_naive(token_expires):
+                token_expires = timezone.make_aware(token_expires, timezone.utc)
+            expires = min(expires, token_expires)
+        return expires - margin
+
+    def clear(self):
+        with self.lock:
+            self.drivers.clear()
+
+    def stats(self):
+        """
+        Returns the hit/miss/eviction counters and the time spent building
+        (authenticating) drivers
+        """
+        with self.lock:
+            return {
+                "size": len(self.drivers),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "auth_seconds": round(self.auth_seconds, 3),
+            }
+
+
+driver_pool = DriverPool()
+
+
+def _credentials_hash(identity):
+    credentials = sorted(identity.get_all_credentials().items())
+    return hashlib.sha256(repr(credentials)).hexdigest()
+
+
+def _get_cached_admin_driver(provider, force=False):
+    account_provider = provider.accountprovider_set.first()
+    if not account_provider:
+        return get_admin_driver(provider)
+    identity = account_provider.identity
+    key = ("admin", provider.uuid, identity.uuid, _credentials_hash(identity))
+    return driver_pool.get(key, lambda: get_admin_driver(provider), force=force)
+
+
+def _get_cached_driver(provider=None, identity=None, force=False):
     if provider:
         return _get_cached_admin_driver(provider, force)
-    if not drivers.get(identity) or force:
-        drivers[identity] = get_esh_driver(identity)
-    return drivers[identity]
+    key = (identity.provider.uuid, identity.uuid, _credentials_hash(identity))
+    return driver_pool.get(key, lambda: get_esh_driver(identity), force=force)
 
 
 def redis_connection():
@@ -45,40 +143,153 @@ def redis_connection():
 def _invalidate(key):
     r = redis_connection()
     if key:
-        r.delete(key)
+        r.delete(key, FRESH_KEY.format(key))
+
 
+def _cache_ttl(resource):
+    return getattr(settings, 'DRIVER_CACHE_TTL', {}).get(
+        resource, DEFAULT_CACHE_TTL)
 
-def _get_cached(key, data_method, scrub_method, force=False):
+
+def _record_metrics(resource, **counts):
+    """
+    Count cache hits, misses and payload sizes per resource type
+    (See `get_cache_metrics`)
+    """
+    try:
+        pipe = redis_connection().pipeline()
+        for field, amount in counts.items():
+            pipe.hincrby(CACHE_METRICS_KEY.format(resource), field, amount)
+        pipe.execute()
+    except redis.exceptions.ConnectionError:
+        pass
+
+
+def get_cache_metrics():
+    """
+    Returns the hits, stale hits, misses, writes and bytes written
+    for each resource type
+    """
+    r = redis_connection()
+    metrics = {}
+    for resource in cache_schema.RESOURCE_TYPES:
+        counts = r.hgetall(CACHE_METRICS_KEY.format(resource))
+        metrics[resource] = dict(
+            (field, int(counts.get(field, 0)))
+            for field in ["hits", "stale_hits", "misses",
+                          "writes", "payload_bytes"])
+    return metrics
+
+
+def _load(r, key, resource, esh_provider):
+    """
+    Returns the `resource` list stored at `key` (or None)
+    """
+    payload = r.get(key)
+    if not payload:
+        return None
+    try:
+        return cache_schema.loads(resource, payload, esh_provider)
+    except cache_schema.SchemaVersionMismatch as exc:
+        logger.debug("Ignoring redis({0}): {1}".format(key, exc))
+        return None
+
+
+def _refresh(r, key, data_method, resource):
+    _record_metrics(resource, misses=1)
+    data = data_method()
+    ttl = _cache_ttl(resource)
+    payload = cache_schema.dumps(resource, data)
+    try:
+        pipe = r.pipeline()
+        # Data outlives its freshness, so it can be served while refreshing.
+        pipe.set(key, payload,
+                 ex=ttl + getattr(settings, 'DRIVER_CACHE_STALE_TTL', 0))
+        pipe.set(FRESH_KEY.format(key), 1, ex=ttl)
+        pipe.execute()
+    except redis.exceptions.ConnectionError:
+        logger.error("EXTERNAL SERVICE redis-server IS NOT RUNNING! "
+                     "Somebody should turn it on!")
+        return data
+    _record_metrics(resource, writes=1, payload_bytes=len(payload))
+    logger.debug("Updated redis({0}) using {1}: {2} bytes".format(
+        key, data_method, len(payload)))
+    return data
+
+
+def _acquire_refresh_lock(r, key):
+    """
+    Returns a token if this worker should refresh `key`, otherwise None.
+    The lock expires after `settings.DRIVER_CACHE_REFRESH_LEASE` seconds,
+    in case its owner never releases it.
+    """
+    token = str(uuid.uuid4())
+    lease = getattr(settings, 'DRIVER_CACHE_REFRESH_LEASE', 60)
+    if r.set(LOCK_KEY.format(key), token, nx=True, ex=lease):
+        return token
+    return None
+
+
+def _release_refresh_lock(r, key, token):
+    lock_key = LOCK_KEY.format(key)
+    if r.get(lock_key) == token:
+        r.delete(lock_key)
+
+
+def _wait_for_refresh(r, key, resource, esh_provider):
+    """
+    Wait (up to the refresh lease) for another worker to refresh `key`
+    """
+    lease = getattr(settings, 'DRIVER_CACHE_REFRESH_LEASE', 60)
+    deadline = time.time() + lease
+    while time.time() < deadline:
+        data = _load(r, key, resource, esh_provider)
+        if data is not None:
+            return data
+        if not r.get(LOCK_KEY.format(key)):
+            break
+        time.sleep(REFRESH_POLL_INTERVAL)
+    return None
+
+
+def _get_cached(key, data_method, resource, esh_provider, force=False):
+    """
+    Returns the `resource` list stored at `key`,
+    or the result of `data_method` on a cache miss.
+
+    Stale-while-revalidate: Once its TTL expires, the data is still served
+    for `settings.DRIVER_CACHE_STALE_TTL` seconds while a single worker
+    (holding a lock in redis) calls `data_method`. On a cold cache, other
+    workers wait for that refresh instead of calling `data_method` too.
+    With `force=True` the data always comes from `data_method`.
+    """
     try:
         r = redis_connection()
         if force:
             _invalidate(key)
-        data = r.get(key)
+            return _refresh(r, key, data_method, resource)
+        data = _load(r, key, resource, esh_provider)
+        if data is not None and r.get(FRESH_KEY.format(key)):
+            _record_metrics(resource, hits=1)
+            return data
+        token = _acquire_refresh_lock(r, key)
+        if not token:
+            if data is not None:
+                _record_metrics(resource, stale_hits=1)
+                return data
+            data = _wait_for_refresh(r, key, resource, esh_provider)
+            if data is not None:
+                _record_metrics(resource, hits=1)
+                return data
+            return _refresh(r, key, data_method, resource)
+        try:
+            return _refresh(r, key, data_method, resource)
+        finally:
+            _release_refresh_lock(r, key, token)
     except redis.exceptions.ConnectionError:
         logger.error("EXTERNAL SERVICE redis-server IS NOT RUNNING! "
                      "Somebody should turn it on!")
-        data = None
-    if not data:
-        data = data_method()
-        scrub_method(data)
-        logger.debug("Updated redis({0}) using {1} and {2}".format(
-            key, data_method, scrub_method))
-        r.set(key, pickle.dumps(data))
-        r.expire(key, 30)
-        return data
-    logger.debug("Actual type {0}".format(type(data)))
-    return pickle.loads(data)
-
-
-def _scrub(objects):
-    for o in objects:
-        o._connection = None
-        for a in ["_node", "_volume", "_image"]:
-            if hasattr(o, a):
-                o.__dict__[a] = None
-        if hasattr(o, "size") and hasattr(o.size, "_size"):
-            if o.size._size:
-                o.size._size = None
+        return data_method()
 
 
 def _validate_parameters(provider, identity):
@@ -86,7 +297,7 @@ def _validate_parameters(provider, identity):
         raise Exception("Use either provider or identity but not both.")
 
 
-def get_cached_driver(provider=None, identity=None, force=True):
+def get_cached_driver(provider=None, identity=None, force=False):
     _validate_parameters(provider, identity)
     return _get_cached_driver(provider=provider,
                               identity=identity,
@@ -95,8 +306,7 @@ def get_cached_driver(provider=None, identity=None, force=True):
 
 def get_cached_instances(provider=None, identity=None, force=False):
     _validate_parameters(provider, identity)
-    cached_driver = _get_cached_driver(provider=provider, identity=identity,
-                                       force=force)
+    cached_driver = _get_cached_driver(provider=provider, identity=identity)
     cached_driver.list_sizes()
     #NOTE: THIS IS A HACK -- The 'admin' user should be able to see "All the things" -- HOWEVER
     # In the current implementation of liberty on jetstream, a call to 'list_all_tenants'
@@ -114,7 +324,8 @@ def get_cached_instances(provider=None, identity=None, force=False):
                                             identity.id)
     return _get_cached(key,
                        instances_method,
-                       _scrub,
+                       "instances",
+                       cached_driver.provider,
                        force=force)
 
 
@@ -129,8 +340,7 @@ def invalidate_cached_instances(provider=None, identity=None):
 
 def get_cached_volumes(provider=None, identity=None, force=False):
     _validate_parameters(provider, identity)
-    cached_driver = _get_cached_driver(provider=provider, identity=identity,
-                                       force=force)
+    cached_driver = _get_cached_driver(provider=provider, identity=identity)
     volumes_method = cached_driver.list_all_volumes
     if provider:
         key = VOLUMES_KEY_PROVIDER.format(provider.id)
@@ -139,7 +349,8 @@ def get_cached_volumes(provider=None, identity=None, force=False):
                                           identity.id)
     return _get_cached(key,
                        volumes_method,
-                       _scrub,
+                       "volumes",
+                       cached_driver.provider,
                        force=force)
 
 
@@ -154,8 +365,7 @@ def invalidate_cached_volumes(provider=None, identity=None):
 
 def get_cached_machines(provider=None, identity=None, force=False):
     _validate_parameters(provider, identity)
-    cached_driver = _get_cached_driver(provider=provider, identity=identity,
-                                       force=force)
+    cached_driver = _get_cached_driver(provider=provider, identity=identity)
     machines_method = cached_driver.list_machines
     if provider:
         key = MACHINES_KEY_PROVIDER.format(provider.id)
@@ -164,7 +374,8 @@ def get_cached_machines(provider=None, identity=None, force=False):
                                            identity.id)
     return _get_cached(key,
                        machines_method,
-                       _scrub,
+                       "machines",
+                       cached_driver.provider,
                        force=force)
 
 
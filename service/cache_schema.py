@@ -0,0 +1,150 @@
+"""
+Compact, versioned representation of the rtwo objects stored by service.cache
+
+Only the attributes read by the API are kept, and encoded as JSON.
+Bump CACHE_SCHEMA_VERSION when a projection changes: entries written
+with any other version are treated as cache misses.
+"""
+import json
+
+from django.utils.timezone import datetime
+
+from rtwo.models.instance import Instance
+from rtwo.models.machine import Machine, MockMachine
+from rtwo.models.size import MockSize, OSSize
+from rtwo.models.volume import BaseVolume, Volume
+
+CACHE_SCHEMA_VERSION = 2
+
+INSTANCE_FIELDS = ["id", "alias", "name", "ip", "owner", "extra"]
+VOLUME_FIELDS = ["id", "alias", "name", "size", "extra", "attachments"]
+MACHINE_FIELDS = ["id", "alias", "name", "extra"]
+SIZE_FIELDS = ["id", "alias", "name", "cpu", "ram", "disk", "ephemeral"]
+
+
+class SchemaVersionMismatch(Exception):
+    pass
+
+
+def _project(obj, fields):
+    return dict((field, getattr(obj, field))
+                for field in fields if hasattr(obj, field))
+
+
+def _restore(obj, fields, provider):
+    obj.__dict__.update(fields)
+    obj.provider = provider
+    obj._connection = None
+    return obj
+
+
+class CachedInstance(Instance):
+    """
+    An Instance restored from the cache (See `service.mock.MockInstance`)
+    """
+    def __init__(self, fields, provider):
+        _restore(self, fields, provider)
+        self._node = None
+        self.source = None
+        self.machine = None
+
+
+class CachedSize(OSSize):
+    """
+    A Size restored from the cache. Unlike a MockSize, converting it
+    (See `core.models.instance._esh_instance_size_to_core`) does not look
+    the size up in the cloud again.
+    """
+    def __init__(self, fields, provider):
+        _restore(self, fields, provider)
+        self._size = None
+
+
+class CachedVolume(Volume):
+    def __init__(self, fields, provider):
+        _restore(self, fields, provider)
+        self._volume = None
+
+
+class CachedMachine(Machine):
+    def __init__(self, fields, provider):
+        _restore(self, fields, provider)
+        self._image = None
+
+
+def _dump_instance(instance):
+    fields = _project(instance, INSTANCE_FIELDS)
+    size = getattr(instance, "size", None)
+    if size is None or isinstance(size, MockSize):
+        # Only the alias is known, like rtwo
+        fields["size"] = {"id": getattr(size, "id", None)}
+    else:
+        fields["size"] = _project(size, SIZE_FIELDS)
+    source = getattr(instance, "source", None)
+    if isinstance(source, BaseVolume):
+        fields["source"] = {"type": "volume",
+                            "fields": _project(source, VOLUME_FIELDS)}
+    elif source is not None:
+        fields["source"] = {"type": "machine", "id": source.id}
+    return fields
+
+
+def _load_instance(fields, provider):
+    source = fields.pop("source", None)
+    size = fields.pop("size", None) or {}
+    instance = CachedInstance(fields, provider)
+    if "cpu" in size:
+        instance.size = CachedSize(size, provider)
+    else:
+        instance.size = MockSize(size.get("id") or "Unknown", provider)
+    if not source:
+        return instance
+    if source["type"] == "volume":
+        instance.source = CachedVolume(source["fields"], provider)
+    else:
+        # Like rtwo, only the machine alias is known here.
+        instance.source = instance.machine = MockMachine(source["id"], provider)
+    return instance
+
+
+RESOURCE_TYPES = {
+    "instances": (_dump_instance, _load_instance),
+    "volumes": (lambda volume: _project(volume, VOLUME_FIELDS), CachedVolume),
+    "machines": (lambda machine: _project(machine, MACHINE_FIELDS), CachedMachine),
+}
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def dumps(resource, objects):
+    """
+    Returns the JSON payload of a list of `resource` objects
+    """
+    dump_method, _ = RESOURCE_TYPES[resource]
+    return json.dumps({"version": CACHE_SCHEMA_VERSION,
+                       "resource": resource,
+                       "items": [dump_method(obj) for obj in objects]},
+                      separators=(",", ":"), default=_json_default)
+
+
+def loads(resource, payload, provider):
+    """
+    Returns the list of `resource` objects of a JSON payload.
+    Raises SchemaVersionMismatch for payloads of another schema version
+    (Including pickled entries written before the schema existed).
+    """
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        raise SchemaVersionMismatch("Payload is not JSON")
+    if not isinstance(data, dict)\
+            or data.get("version") != CACHE_SCHEMA_VERSION\
+            or data.get("resource") != resource:
+        raise SchemaVersionMismatch(
+            "Expected %s version %s" % (resource, CACHE_SCHEMA_VERSION))
+    _, load_method = RESOURCE_TYPES[resource]
+    return [load_method(fields, provider) for fields in data["items"]]
@@ -36,10 +36,11 @@ from core.models.application import Application
 from core.models.identity import Identity as CoreIdentity
 from core.models.instance import convert_esh_instance, find_instance
 from core.models.instance_action import InstanceAction
-from core.models.size import convert_esh_size
+from core.models.size import Size, convert_esh_size
 from core.models.machine import ProviderMachine
 from core.models.volume import convert_esh_volume
 from core.models.provider import AccountProvider, Provider, ProviderInstanceAction
+from core.models.quota import QuotaUsageLedger
 
 from atmosphere import settings
 from atmosphere.settings import secrets
@@ -124,11 +125,17 @@ def resize_instance(esh_driver, esh_instance, size_alias,
                     provider_uuid, identity_uuid, user):
     _permission_to_act(identity_uuid, "Resize")
     size = esh_driver.get_size(size_alias)
+    core_instance = find_instance(esh_instance.id)
+    last_history = core_instance.get_last_history() if core_instance else None
     redeploy_task = resize_and_redeploy(
         esh_driver,
         esh_instance,
         identity_uuid)
     esh_driver.resize_instance(esh_instance, size)
+    if last_history:
+        _adjust_quota_usage_for_resize(
+            core_instance.created_by_identity, last_history.size,
+            convert_esh_size(size, provider_uuid))
     redeploy_task.apply_async()
     # Write build state for new size
     update_status(
@@ -145,6 +152,7 @@ def confirm_resize(
         provider_uuid,
         identity_uuid,
         user):
+    # The QuotaUsageLedger counts the new size since `resize_instance`
     _permission_to_act(identity_uuid, "Resize")
     esh_driver.confirm_resize_instance(esh_instance)
     # Double-Check we are counting on new size
@@ -156,6 +164,24 @@ def confirm_resize(
         user)
 
 
+def revert_resize(esh_driver, esh_instance, provider_uuid):
+    """
+    Revert the resize of esh_instance, counting its original size again
+    """
+    resized_size = Size.objects.filter(
+        alias=esh_instance.size.id, provider__uuid=provider_uuid).first()
+    reverted = esh_driver.revert_resize_instance(esh_instance)
+    reverted_instance = esh_driver.get_instance(esh_instance.id)
+    original_size = Size.objects.filter(
+        alias=reverted_instance.size.id, provider__uuid=provider_uuid
+    ).first() if reverted_instance else None
+    core_instance = find_instance(esh_instance.id)
+    if core_instance and resized_size and original_size:
+        _adjust_quota_usage_for_resize(
+            core_instance.created_by_identity, resized_size, original_size)
+    return reverted
+
+
 def stop_instance(esh_driver, esh_instance, provider_uuid, identity_uuid, user,
                   reclaim_ip=True):
     """
@@ -687,10 +713,34 @@ def destroy_instance(user, core_identity_uuid, instance_alias):
         raise Exception("Instance could not be destroyed")
     os_cleanup_networking(core_identity_uuid)
     core_instance = find_instance(instance_alias)
+    last_history = core_instance.get_last_history()
+    if esh_instance and last_history and not last_history.end_date:
+        _adjust_quota_usage(core_instance.created_by_identity, last_history.size, -1)
     core_instance.end_date_all()
     return core_instance
 
 
+def _adjust_quota_usage(identity, core_size, count):
+    """
+    Add (or remove, count=-1) `count` instances of core_size to the QuotaUsageLedger
+    """
+    QuotaUsageLedger.adjust(
+        identity,
+        cpu=count * core_size.cpu,
+        memory=count * core_size.mem / 1024.0,
+        instance_count=count)
+
+
+def _adjust_quota_usage_for_resize(identity, old_size, new_size):
+    """
+    Count a resized instance with new_size instead of old_size in the QuotaUsageLedger
+    """
+    QuotaUsageLedger.adjust(
+        identity,
+        cpu=new_size.cpu - old_size.cpu,
+        memory=(new_size.mem - old_size.mem) / 1024.0)
+
+
 def os_cleanup_networking(core_identity_uuid):
     """
     NOTE: this relies on celery to 'kick these tasks off' as we return the destroyed instance back to the user.
@@ -1137,7 +1187,8 @@ def _complete_launch_instance(
         user, token, password)
 
     # FIXME: Remove duplicate line below, this happens inside convert_esh_instance
-    _first_update(driver, identity, core_instance, instance)
+    history = _first_update(driver, identity, core_instance, instance)
+    _adjust_quota_usage(identity, history.size, 1)
     # call async task to deploy to instance.
     task.deploy_init_task(driver, instance, identity, user.username,
                           password, token, deploy=deploy)
@@ -2019,7 +2070,7 @@ def run_instance_action(user, identity, instance_id, action_type, action_params)
             esh_driver, esh_instance,
             provider_uuid, identity_uuid, user)
     elif 'revert_resize' == action_type:
-        result_obj = esh_driver.revert_resize_instance(esh_instance)
+        result_obj = revert_resize(esh_driver, esh_instance, provider_uuid)
     elif 'redeploy' == action_type:
         result_obj = redeploy_instance(esh_driver, esh_instance, identity, user=user)
     elif 'resume' == action_type:
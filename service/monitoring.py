@@ -3,7 +3,8 @@ import time
 from datetime import timedelta
 from django.core.exceptions import ObjectDoesNotExist
 import pytz
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone
 from threepio import logger
 from core.models import AtmosphereUser as User
@@ -14,9 +15,11 @@ from core.models.credential import Credential
 from core.models import IdentityMembership, Identity, InstanceStatusHistory
 from core.models.instance import Instance as CoreInstance
 from core.models.instance import (
-    convert_esh_instance, _esh_instance_size_to_core
+    convert_esh_instance, _esh_instance_size_to_core, _find_esh_ip,
+    _get_status_name_for_provider
 )
-from core.models.size import convert_esh_size
+from core.models.instance_history import InstanceStatus
+from core.models.size import Size, convert_esh_size
 from allocation.models import Allocation, AllocationResult
 from service.cache import get_cached_instances, get_cached_driver
 from service.instance import suspend_instance, stop_instance, destroy_instance, shelve_instance, offload_instance
@@ -24,6 +27,9 @@ from allocation.engine import calculate_allocation
 from django.conf import settings
 from rtwo.exceptions import LibcloudInvalidCredsError
 
+# Rows updated/inserted per query by `_reconcile_instances`
+RECONCILE_BATCH_SIZE = 500
+
 # Private
 def _include_all_idents(identities, owner_map):
     # Include all identities with 0 instances to the monitoring
@@ -270,6 +276,159 @@ def _cleanup_missing_instances(
     return instances
 
 
+def _batches(items, batch_size=None):
+    batch_size = batch_size or RECONCILE_BATCH_SIZE
+    for index in range(0, len(items), batch_size):
+        yield items[index:index + batch_size]
+
+
+def _reconcile_instances(provider, instance_map):
+    """
+    Set-based equivalent of `convert_esh_instance` (for every running
+    instance in `instance_map`) followed by `_cleanup_missing_instances`
+    (for every tenant).
+
+    Core instances and their open histories are fetched in bulk and
+    diffed against the cloud by `provider_alias`:
+    - Unchanged instances are left alone.
+    - Status/Size changes end-date the open history and bulk_create
+      the new histories.
+    - Missing instances (and their open histories) are end-dated
+      in batches of `RECONCILE_BATCH_SIZE`.
+    - Anything else (New instances, conflicting histories, ...) falls
+      back to `convert_esh_instance`.
+
+    Returns the running core instances and the counts of changed rows.
+    """
+    started = time.time()
+    now_time = timezone.now()
+    stats = dict.fromkeys([
+        'unchanged', 'converted', 'status_changes', 'ip_changes',
+        'conflicts', 'end_dated_instances', 'end_dated_histories',
+        'failed_tenants'], 0)
+    identities = []
+    for tenant_name in sorted(instance_map.keys()):
+        identity = _get_identity_from_tenant_name(provider, tenant_name)
+        if identity:
+            identities.append((tenant_name, identity))
+    identity_ids = [ident.id for _, ident in identities]
+
+    core_instances = {}
+    for instance in CoreInstance.objects.filter(
+            Q(end_date=None) | Q(instancestatushistory__end_date=None),
+            created_by_identity__in=identity_ids,
+            created_by=F('created_by_identity__created_by'))\
+            .select_related('source__provider').distinct():
+        core_instances[instance.provider_alias] = instance
+    open_histories = {}
+    for history in InstanceStatusHistory.objects.filter(
+            end_date=None,
+            instance__created_by_identity__in=identity_ids)\
+            .select_related('status', 'size'):
+        open_histories.setdefault(history.instance_id, []).append(history)
+    sizes = dict((size.alias, size) for size in
+                 Size.objects.filter(provider=provider))
+    statuses = {}
+
+    seen_instances = []
+    seen_ids = set()
+    cleaned_identity_ids = set()
+    ended_history_ids = []
+    new_histories = []
+    ip_changes = []
+    for tenant_name, identity in identities:
+        running_instances = instance_map[tenant_name]
+        tenant_instances = []
+        try:
+            driver = get_cached_driver(identity=identity) if running_instances else None
+            for esh_instance in running_instances:
+                core_instance = core_instances.get(esh_instance.id)
+                histories = open_histories.get(core_instance.id, []) if core_instance else []
+                size = sizes.get(getattr(esh_instance.size, 'id', None))
+                if not core_instance or core_instance.end_date \
+                        or len(histories) != 1 or not size:
+                    core_instance = convert_esh_instance(
+                        driver, esh_instance, provider.uuid,
+                        identity.uuid, identity.created_by)
+                    stats['converted'] += 1
+                    tenant_instances.append(core_instance)
+                    continue
+                core_instance.esh = esh_instance
+                tenant_instances.append(core_instance)
+                ip_address = _find_esh_ip(esh_instance)
+                if core_instance.ip_address != ip_address:
+                    core_instance.ip_address = ip_address
+                    ip_changes.append(core_instance)
+                status_name = _get_status_name_for_provider(
+                    core_instance.source.provider,
+                    esh_instance.extra['status'],
+                    esh_instance.extra.get('task'),
+                    esh_instance.extra.get('metadata', {}).get('tmp_status', "MISSING"))
+                last_history = histories[0]
+                if last_history.status.name == status_name \
+                        and last_history.size_id == size.id:
+                    stats['unchanged'] += 1
+                    continue
+                if status_name not in statuses:
+                    statuses[status_name], _ = InstanceStatus.objects.get_or_create(name=status_name)
+                ended_history_ids.append(last_history.id)
+                new_histories.append(InstanceStatusHistory(
+                    instance=core_instance, size=size,
+                    status=statuses[status_name],
+                    activity=core_instance.esh_activity(),
+                    start_date=now_time))
+        except Exception:
+            logger.exception(
+                "Could not convert running instances for %s" % tenant_name)
+            stats['failed_tenants'] += 1
+            continue
+        seen_instances.extend(tenant_instances)
+        seen_ids.update(instance.id for instance in tenant_instances)
+        cleaned_identity_ids.add(identity.id)
+
+    with transaction.atomic():
+        for batch in _batches(ended_history_ids):
+            InstanceStatusHistory.objects.filter(
+                id__in=batch, end_date=None).update(end_date=now_time)
+        InstanceStatusHistory.objects.bulk_create(
+            new_histories, batch_size=RECONCILE_BATCH_SIZE)
+        stats['status_changes'] = len(new_histories)
+        for instance in ip_changes:
+            CoreInstance.objects.filter(id=instance.id).update(
+                ip_address=instance.ip_address)
+        stats['ip_changes'] = len(ip_changes)
+
+        missing_ids = [
+            instance.id for instance in core_instances.values()
+            if instance.created_by_identity_id in cleaned_identity_ids
+            and instance.id not in seen_ids]
+        for batch in _batches(missing_ids):
+            stats['end_dated_histories'] += InstanceStatusHistory.objects.filter(
+                instance__in=batch, end_date=None).update(end_date=now_time)
+            stats['end_dated_instances'] += CoreInstance.objects.filter(
+                id__in=batch, end_date=None).update(end_date=now_time)
+
+    # Conflicting (> 1) open histories are resolved one instance at a time
+    identities_by_id = dict((ident.id, ident) for _, ident in identities)
+    for instance in seen_instances:
+        if len(open_histories.get(instance.id, [])) < 2:
+            continue
+        non_end_dated_history = instance.instancestatushistory_set.filter(
+            end_date=None)
+        if len(non_end_dated_history) < 2:
+            continue
+        new_history = _resolve_history_conflict(
+            identities_by_id[instance.created_by_identity_id],
+            instance, non_end_dated_history)
+        stats['conflicts'] += 1
+        logger.warn("Instance %s contained %s NON END DATED history. "
+                    "New History: %s" % (instance.provider_alias,
+                                         len(non_end_dated_history),
+                                         new_history))
+    stats['seconds'] = round(time.time() - started, 3)
+    return seen_instances, stats
+
+
 def _resolve_history_conflict(
         identity, core_running_instance,
         bad_history, reset_time=None):
@@ -0,0 +1,50 @@
+"""
+Redis publish/subscribe shared by the per-process caches
+(i.e. plugin decisions, maintenance windows), so that a change saved in
+one process clears the caches of every process.
+"""
+import os
+
+import redis
+
+from threepio import logger
+
+
+class ChannelListener(object):
+    """
+    The subscription of this process to `channel`, made on first use and
+    again after a fork (a subscription can not be shared by processes).
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.pubsub = None
+        self.pid = None
+
+    def messages(self):
+        """
+        Returns the messages published since the last call,
+        or None when Redis is unavailable (i.e. anything may have changed)
+        """
+        from service.cache import redis_connection
+        try:
+            if self.pubsub is None or self.pid != os.getpid():
+                self.pubsub = redis_connection().pubsub(ignore_subscribe_messages=True)
+                self.pubsub.subscribe(self.channel)
+                self.pid = os.getpid()
+            messages = []
+            message = self.pubsub.get_message()
+            while message:
+                messages.append(message['data'])
+                message = self.pubsub.get_message()
+            return messages
+        except redis.exceptions.ConnectionError:
+            self.pubsub = None
+            return None
+
+
+def publish(channel, message):
+    from service.cache import redis_connection
+    try:
+        redis_connection().publish(channel, message)
+    except redis.exceptions.ConnectionError:
+        logger.warn("Could not publish '%s' on %s", message, channel)
@@ -1,21 +1,269 @@
+import threading
+import time
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
 from threepio import logger
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.utils.timezone import timedelta
 
-from core.models import IdentityMembership, Identity
-from core.models.quota import (
-    has_floating_ip_count_quota,
-    has_port_count_quota,
-    has_instance_count_quota,
-    has_cpu_quota,
-    has_mem_quota,
-    has_storage_quota,
-    has_storage_count_quota,
-    has_snapshot_count_quota
-    )
+from core.models import IdentityMembership, Identity, QuotaUsageLedger
 from service.cache import get_cached_driver
 from service.driver import get_account_driver
 
+# (Quota field, listing, resource name, negative limits are unlimited)
+QUOTA_FIELDS = [
+    ('cpu', 'instances', 'CPU', True),
+    ('memory', 'instances', 'Memory', True),
+    ('instance_count', 'instances', 'Instance', True),
+    ('floating_ip_count', 'floating_ips', 'Floating IP', True),
+    ('port_count', 'ports', 'Fixed IP', True),
+    ('storage', 'volumes', 'Storage Size', False),
+    ('storage_count', 'volumes', 'Volume', False),
+    ('snapshot_count', 'snapshots', 'Snapshot', True),
+]
+QUOTA_LISTINGS = dict((field, listing) for field, listing, _, _ in QUOTA_FIELDS)
+DEFAULT_QUOTA_USAGE_TTL = 10
+DEFAULT_QUOTA_LEDGER_MAX_AGE = timedelta(hours=1)
+
+usage_cache = {}
+usage_lock = threading.Lock()
+quota_metrics = defaultdict(int)
+
+
+def _instance_cpu(instance):
+    try:
+        return instance.size._size.extra['cpu']
+    except (AttributeError, KeyError):
+        # Instance running on an unknown size..
+        return 1
+
+
+def _instance_memory(instance):
+    try:
+        return instance.size._size.ram / 1024.0
+    except (AttributeError, KeyError):
+        # Instance running on an unknown size..
+        return 1
+
+
+class QuotaUsage(object):
+    """
+    Cloud usage of an identity, listed once (concurrently) and shared by
+    every Quota field evaluated against it.
+
+    Resources requested by passing quota checks are `reserved`, so
+    checks made while the usage is cached account for them.
+    """
+    def __init__(self, identity, driver):
+        self.identity = identity
+        self.driver = driver
+        self.listings = {}
+        self.reserved = defaultdict(int)
+        self.created = time.time()
+        self.cloud_calls = 0
+        self.lock = threading.Lock()
+
+    def _call(self, method, *args):
+        with self.lock:
+            self.cloud_calls += 1
+        return method(*args)
+
+    def _list_instances(self):
+        provider = self.driver.provider
+        if not provider.sizeCls.sizes.get(provider.identifier):
+            self._call(_pre_cache_sizes, self.driver)
+        return self._call(self.driver.list_instances)
+
+    def _list_floating_ips(self):
+        return self._call(self.driver._connection.ex_list_floating_ips)
+
+    def _list_ports(self):
+        # Consider the quota met if the ports can not be listed
+        try:
+            from service.instance import _to_network_driver
+            network_driver = _to_network_driver(self.identity)
+            port_list = self._call(network_driver.list_ports)
+        except Exception as exc:
+            logger.warn("Could not verify quota due to failed call to network_driver.list_ports() - %s" % exc)
+            return None
+        project_id = self._call(network_driver.get_tenant_id)
+        return [port for port in port_list if
+                'compute:' in port['device_owner'] and port.get('project_id', project_id) == project_id]
+
+    def _list_volumes(self):
+        return self._call(self.driver.list_volumes)
+
+    def _list_snapshots(self):
+        return self._call(self.driver._connection.ex_list_snapshots)
+
+    def fetch(self, listings):
+        """
+        List the resources not listed yet, each in its own thread.
+        """
+        missing = [listing for listing in set(listings)
+                   if listing not in self.listings]
+        if not missing:
+            return
+        if len(missing) == 1:
+            self.listings[missing[0]] = getattr(self, '_list_%s' % missing[0])()
+            return
+
+        def fetch_listing(listing):
+            try:
+                return getattr(self, '_list_%s' % listing)()
+            finally:
+                # Each thread opens its own DB connection
+                connection.close()
+
+        pool = ThreadPool(len(missing))
+        try:
+            pending = [(listing, pool.apply_async(fetch_listing, (listing,)))
+                       for listing in missing]
+            for listing, result in pending:
+                self.listings[listing] = result.get()
+        finally:
+            pool.close()
+
+    def used(self, field):
+        """
+        Returns the usage of a Quota field (or None, if unknown)
+        """
+        instances = self.listings.get('instances') or []
+        volumes = self.listings.get('volumes') or []
+        if field == 'cpu':
+            used = sum(_instance_cpu(instance) for instance in instances)
+        elif field == 'memory':
+            used = sum(_instance_memory(instance) for instance in instances)
+        elif field == 'instance_count':
+            used = len(instances)
+        elif field == 'storage':
+            used = sum(volume.size for volume in volumes)
+        elif field == 'storage_count':
+            used = len(volumes)
+        else:
+            listing = self.listings.get(QUOTA_LISTINGS[field])
+            if listing is None:
+                return None
+            used = len(listing)
+        return used + self.reserved[field]
+
+    def reserve(self, requested):
+        for field, amount in requested.items():
+            self.reserved[field] += amount
+
+
+def get_quota_usage(identity, driver=None, force=False):
+    """
+    Returns the QuotaUsage of `identity`, cached for QUOTA_USAGE_CACHE_TTL seconds
+    """
+    ttl = getattr(settings, 'QUOTA_USAGE_CACHE_TTL', DEFAULT_QUOTA_USAGE_TTL)
+    now = time.time()
+    with usage_lock:
+        usage = usage_cache.get(identity.uuid)
+        if usage and not force and now - usage.created < ttl:
+            quota_metrics['cache_hits'] += 1
+            return usage
+        for key, cached_usage in usage_cache.items():
+            if now - cached_usage.created >= ttl:
+                del usage_cache[key]
+        usage = QuotaUsage(identity, driver or get_cached_driver(identity=identity))
+        usage_cache[identity.uuid] = usage
+        quota_metrics['cache_misses'] += 1
+    return usage
+
+
+def get_quota_metrics():
+    """
+    Returns the number of quota checks, cache hits/misses and cloud calls
+    """
+    with usage_lock:
+        return dict(quota_metrics)
+
+
+def _raise_quota_error(resource_name, current_count, new_count, limit_count):
+    raise ValidationError(
+        "%s Quota Exceeded: Using %s + Requested %s but limited to %s"
+        % (resource_name, current_count, new_count, limit_count))
+
+
+def _pre_cache_sizes(driver):
+    """
+    Pre-caching sizes is required to get 'extra' data from size,
+    rather than MockSize (default)
+    """
+    cached_sizes = driver.provider.sizeCls.sizes.get(driver.provider.identifier)
+    if not cached_sizes:
+        driver.list_sizes()
+
+
+def check_quota_usage(identity, quota, requested, raise_exc=True):
+    """
+    Evaluate every Quota field against the usage of identity: fields of
+    its (recently reconciled) QuotaUsageLedger are read from the DB, the
+    others from a single QuotaUsage listed on the cloud.
+    param - requested - the new resources (i.e. {'cpu': 2, 'memory': 4.0})
+      Fields that are not requested are not checked.
+      'memory' and 'storage' are in GB.
+
+    return True if passing
+    return False if ValidationError occurs and raise_exc=False
+    """
+    if not quota:
+        return True
+    limits = []
+    for field, listing, resource_name, negative_is_unlimited in QUOTA_FIELDS:
+        if field not in requested:
+            continue
+        limit = getattr(quota, field)
+        if not limit or (negative_is_unlimited and limit < 0):
+            continue
+        limits.append((field, listing, resource_name, limit))
+    if not limits:
+        return True
+    started = time.time()
+    used = {}
+    if getattr(settings, 'QUOTA_USAGE_LEDGER', True):
+        used = QuotaUsageLedger.usage_for(
+            identity, [field for field, _, _, _ in limits],
+            getattr(settings, 'QUOTA_LEDGER_MAX_AGE', DEFAULT_QUOTA_LEDGER_MAX_AGE))
+    live_limits = [checked for checked in limits if checked[0] not in used]
+    usage = None
+    calls_made = 0
+    if live_limits:
+        usage = get_quota_usage(identity)
+        calls_made = usage.cloud_calls
+        usage.fetch([listing for _, listing, _, _ in live_limits])
+        calls_made = usage.cloud_calls - calls_made
+        for field, _, _, _ in live_limits:
+            used[field] = usage.used(field)
+    with usage_lock:
+        quota_metrics['checks'] += 1
+        quota_metrics['cloud_calls'] += calls_made
+        quota_metrics['ledger_fields'] += len(limits) - len(live_limits)
+    logger.debug("Quota check for %s made %s cloud calls in %.3fs",
+                 identity, calls_made, time.time() - started)
+    try:
+        for field, listing, resource_name, limit in limits:
+            if used[field] is None:
+                continue
+            new_size = requested[field]
+            total_size = used[field] + new_size
+            if field == 'memory':
+                total_size = int(total_size)
+            if total_size > limit:
+                _raise_quota_error(resource_name, used[field], new_size, limit)
+    except ValidationError:
+        if raise_exc:
+            raise
+        return False
+    if usage:
+        usage.reserve(requested)
+    return True
+
 
 def check_over_instance_quota(
         username, identity_uuid, esh_size=None,
@@ -39,7 +287,6 @@ def check_over_instance_quota(
         membership = memberships_available.first()
     identity = membership.identity
     quota = identity.quota
-    driver = get_cached_driver(identity=identity)
     new_port = new_floating_ip = new_instance = new_cpu = new_ram = 0
     if esh_size:
         new_cpu += esh_size.cpu
@@ -49,17 +296,13 @@ def check_over_instance_quota(
     if include_networking:
         new_floating_ip += 1
     # Will throw ValidationError if false.
-    try:
-        has_cpu_quota(driver, quota, new_cpu)
-        has_mem_quota(driver, quota, new_ram)
-        has_instance_count_quota(driver, quota, new_instance)
-        has_floating_ip_count_quota(driver, quota, new_floating_ip)
-        has_port_count_quota(identity, driver, quota, new_port)
-        return True
-    except ValidationError:
-        if raise_exc:
-            raise
-        return False
+    return check_quota_usage(identity, quota, {
+        'cpu': new_cpu,
+        'memory': new_ram / 1024.0,
+        'instance_count': new_instance,
+        'floating_ip_count': new_floating_ip,
+        'port_count': new_port,
+    }, raise_exc=raise_exc)
 
 
 def check_over_storage_quota(
@@ -82,7 +325,6 @@ def check_over_storage_quota(
         membership = memberships_available.first()
     identity = membership.identity
     quota = identity.quota
-    driver = get_cached_driver(identity=identity)
 
     # FIXME: I don't believe that 'snapshot' size and 'volume' size share
     # the same quota, so for now we ignore 'snapshot-size',
@@ -92,15 +334,11 @@ def check_over_storage_quota(
     new_disk = new_volume_size
     new_volume = 1 if new_volume_size > 0 else 0
     # Will throw ValidationError if false.
-    try:
-        has_storage_quota(driver, quota, new_disk)
-        has_storage_count_quota(driver, quota, new_volume)
-        has_snapshot_count_quota(driver, quota, new_snapshot)
-        return True
-    except ValidationError:
-        if raise_exc:
-            raise
-        return False
+    return check_quota_usage(identity, quota, {
+        'storage': new_disk,
+        'storage_count': new_volume,
+        'snapshot_count': new_snapshot,
+    }, raise_exc=raise_exc)
 
 
 def set_provider_quota(identity_uuid, quota=None, limit_dict=None):
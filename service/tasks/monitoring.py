@@ -1,37 +1,40 @@
+import time
 from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
-from django.db.models import Q, Count
-from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+from django.db.models import Q, Count, Sum
 from django.utils import timezone
 
 from celery.decorators import task
 
 from core.query import (
-    contains_credential, only_current, only_current_source,
+    only_current, only_current_source,
     source_in_range, inactive_versions)
 from core.models.group import Group
 from core.models.size import Size, convert_esh_size
-from core.models.volume import Volume, convert_esh_volume
-from core.models.instance import Instance, convert_esh_instance
+from core.models.volume import Volume, convert_esh_volume, convert_known_esh_volumes
+from core.models.instance_source import InstanceSource
+from core.models.instance import Instance
 from core.models.provider import Provider
 from core.models.machine import convert_glance_image, get_or_create_provider_machine, ProviderMachine, ProviderMachineMembership
 from core.models.application import Application, ApplicationMembership
 from core.models.allocation_source import AllocationSource
 from core.models.application_version import ApplicationVersion
-from core.models import Allocation, Credential, IdentityMembership
+from core.models import Allocation, Credential, Identity, IdentityMembership
+from core.models.instance_history import InstanceStatusHistory
+from core.models.quota import QuotaUsageLedger
 
 from service.machine import (
     update_db_membership_for_group,
     update_cloud_membership_for_machine
 )
 from service.monitoring import (
-    _cleanup_missing_instances,
     _get_instance_owner_map,
-    _get_identity_from_tenant_name,
+    _reconcile_instances,
     allocation_source_overage_enforcement_for)
-from service.driver import get_account_driver
-from service.cache import get_cached_driver
+from service.driver import get_account_driver, get_admin_driver
 from service.exceptions import TimeoutError
 from rtwo.models.size import OSSize
 from rtwo.exceptions import GlanceConflict, GlanceForbidden
@@ -157,7 +160,7 @@ def monitor_machines():
 
 
 @task(name="monitor_machines_for")
-def monitor_machines_for(provider_id, limit_machines=[], print_logs=False, dry_run=False):
+def monitor_machines_for(provider_id, limit_machines=[], print_logs=False, dry_run=False, cloud_machines=None):
     """
     Run the set of tasks related to monitoring machines for a provider.
     Optionally, provide a list of usernames to monitor
@@ -177,7 +180,8 @@ def monitor_machines_for(provider_id, limit_machines=[], print_logs=False, dry_r
         _exit_stdout_logging(console_handler)
         return []
 
-    cloud_machines = account_driver.list_all_images()
+    if cloud_machines is None:
+        cloud_machines = account_driver.list_all_images()
     if limit_machines:
         cloud_machines = [cm for cm in cloud_machines if cm.id in limit_machines]
     db_machines = []
@@ -546,21 +550,72 @@ def monitor_resources():
 def monitor_resources_for(provider_id, users=None, print_logs=False):
     """
     Run the set of tasks related to monitoring all cloud resources for a provider.
+
+    The cloud listings (sizes, volumes, machines and instances) are fetched
+    concurrently, then reconciled with the DB one resource at a time.
+    Returns the monitored resources, and the seconds spent on each stage.
     """
+    started = time.time()
+    provider = Provider.objects.get(id=provider_id)
+    listing_methods = {
+        'sizes': lambda: get_admin_driver(provider).list_sizes(),
+        'volumes': lambda: get_account_driver(provider).admin_driver.list_all_volumes(timeout=30),
+        'machines': lambda: get_account_driver(provider).list_all_images(),
+    }
+    if 'openstack' in provider.type.name.lower():
+        listing_methods['instances'] = lambda: _get_instance_owner_map(provider, users=users)
+    listings, timings = _list_cloud_resources(listing_methods)
+
     resources = {}
-    sizes = monitor_sizes_for(provider_id, print_logs=print_logs)
-    volumes = monitor_volumes_for(provider_id, print_logs=print_logs)
-    machines = monitor_machines_for(provider_id, print_logs=print_logs)
-    instances = monitor_instances_for(provider_id, users=users, print_logs=print_logs)
-    resources.update({
-        'instances': instances,
-        'machines': machines,
-        'sizes': sizes,
-        'volumes': volumes,
-    })
+    reconcile_methods = [
+        ('sizes', lambda: monitor_sizes_for(
+            provider_id, print_logs=print_logs, cloud_sizes=listings['sizes'])),
+        ('volumes', lambda: monitor_volumes_for(
+            provider_id, print_logs=print_logs, cloud_volumes=listings['volumes'])),
+        ('machines', lambda: monitor_machines_for(
+            provider_id, print_logs=print_logs, cloud_machines=listings['machines'])),
+        ('instances', lambda: monitor_instances_for(
+            provider_id, users=users, print_logs=print_logs,
+            instance_map=listings.get('instances'))),
+    ]
+    for resource, reconcile_method in reconcile_methods:
+        stage_started = time.time()
+        resources[resource] = reconcile_method()
+        timings['%s_reconcile' % resource] = round(time.time() - stage_started, 3)
+    timings['total'] = round(time.time() - started, 3)
+    celery_logger.info("Monitored resources for %s: %s" % (provider, timings))
+    resources['timings'] = timings
     return resources
 
 
+def _list_cloud_resources(listing_methods):
+    """
+    Call every listing method in its own thread.
+    Returns the listings and the seconds spent on each of them.
+    """
+    def timed_listing(listing_method):
+        started = time.time()
+        try:
+            return listing_method(), round(time.time() - started, 3)
+        finally:
+            # Each thread opens its own DB connection
+            connection.close()
+
+    pool = ThreadPool(len(listing_methods))
+    try:
+        pending = dict(
+            (resource, pool.apply_async(timed_listing, (listing_method,)))
+            for resource, listing_method in listing_methods.items())
+        listings = {}
+        timings = {}
+        for resource, result in pending.items():
+            listings[resource], timings['%s_listing' % resource] = result.get()
+    finally:
+        pool.close()
+        pool.join()
+    return listings, timings
+
+
 @task(name="monitor_instances")
 def monitor_instances():
     """
@@ -611,53 +666,32 @@ def allocation_source_overage_enforcement_for_user(allocation_source, user):
 
 @task(name="monitor_instances_for")
 def monitor_instances_for(provider_id, users=None,
-                          print_logs=False, start_date=None, end_date=None):
+                          print_logs=False, start_date=None, end_date=None,
+                          instance_map=None):
     """
     Run the set of tasks related to monitoring instances for a provider.
     Optionally, provide a list of usernames to monitor
     While debugging, print_logs=True can be very helpful.
     start_date and end_date allow you to search a 'non-standard' window of time.
+    instance_map (See `_get_instance_owner_map`) skips listing the instances.
     """
     provider = Provider.objects.get(id=provider_id)
 
     # For now, lets just ignore everything that isn't openstack.
     if 'openstack' not in provider.type.name.lower():
         return
-    instance_map = _get_instance_owner_map(provider, users=users)
+    if instance_map is None:
+        instance_map = _get_instance_owner_map(provider, users=users)
 
     if print_logs:
         console_handler = _init_stdout_logging()
-    seen_instances = []
-    # DEVNOTE: Potential slowdown running multiple functions
-    # Break this out when instance-caching is enabled
     if not settings.ENFORCING:
         celery_logger.debug('Settings dictate allocations are NOT enforced')
-    for tenant_name in sorted(instance_map.keys()):
-        running_instances = instance_map[tenant_name]
-        identity = _get_identity_from_tenant_name(provider, tenant_name)
-        if identity and running_instances:
-            try:
-                driver = get_cached_driver(identity=identity)
-                core_running_instances = [
-                    convert_esh_instance(
-                        driver,
-                        inst,
-                        identity.provider.uuid,
-                        identity.uuid,
-                        identity.created_by) for inst in running_instances]
-                seen_instances.extend(core_running_instances)
-            except Exception as exc:
-                celery_logger.exception(
-                    "Could not convert running instances for %s" %
-                    tenant_name)
-                continue
-        else:
-            # No running instances.
-            core_running_instances = []
-        # Using the 'known' list of running instances, cleanup the DB
-        core_instances = _cleanup_missing_instances(
-            identity,
-            core_running_instances)
+    seen_instances, stats = _reconcile_instances(provider, instance_map)
+    celery_logger.info("Reconciled instances for %s in %ss: %s"
+                       % (provider, stats['seconds'], stats))
+    if not users:
+        _reconcile_quota_usage(provider, 'instances')
     if print_logs:
         _exit_stdout_logging(console_handler)
     return seen_instances
@@ -672,7 +706,7 @@ def monitor_volumes():
         monitor_volumes_for.apply_async(args=[p.id])
 
 @task(name="monitor_volumes_for")
-def monitor_volumes_for(provider_id, print_logs=False):
+def monitor_volumes_for(provider_id, print_logs=False, cloud_volumes=None):
     """
     Run the set of tasks related to monitoring sizes for a provider.
     Optionally, provide a list of usernames to monitor
@@ -680,7 +714,6 @@ def monitor_volumes_for(provider_id, print_logs=False):
     start_date and end_date allow you to search a 'non-standard' window of time.
     """
     from service.driver import get_account_driver
-    from core.models import Identity
     if print_logs:
         console_handler = _init_stdout_logging()
 
@@ -688,39 +721,41 @@ def monitor_volumes_for(provider_id, print_logs=False):
     account_driver = get_account_driver(provider)
     # Non-End dated volumes on this provider
     db_volumes = Volume.objects.filter(only_current_source(), instance_source__provider=provider)
-    all_volumes = account_driver.admin_driver.list_all_volumes(timeout=30)
-    seen_volumes = []
-    for cloud_volume in all_volumes:
-        try:
-            core_volume = convert_esh_volume(cloud_volume, provider_uuid=provider.uuid)
-            seen_volumes.append(core_volume)
-        except ObjectDoesNotExist:
-            tenant_id = cloud_volume.extra['object']['os-vol-tenant-attr:tenant_id']
-            tenant = account_driver.get_project_by_id(tenant_id)
-            tenant_name = tenant.name if tenant else tenant_id
-            try:
-                if not tenant:
-                    celery_logger.warn("Warning: tenant_id %s found on volume %s, but did not exist from the account driver perspective.", tenant_id, cloud_volume)
-                    raise ObjectDoesNotExist()
-                identity = Identity.objects.filter(
-                    contains_credential('ex_project_name', tenant_name), provider=provider
-                ).first()
-                if not identity:
-                    raise ObjectDoesNotExist()
-                core_volume = convert_esh_volume(
-                    cloud_volume,
-                    provider.uuid, identity.uuid,
-                    identity.created_by)
-            except ObjectDoesNotExist:
-                celery_logger.info("Skipping Volume %s - No Identity for: Provider:%s + Project Name:%s" % (cloud_volume.id, provider, tenant_name))
-            pass
+    if cloud_volumes is None:
+        all_volumes = account_driver.admin_driver.list_all_volumes(timeout=30)
+    else:
+        all_volumes = cloud_volumes
+    # Volumes known to the DB (Including end-dated volumes) are updated in bulk
+    seen_volumes, new_volumes = convert_known_esh_volumes(all_volumes, provider)
+    tenant_names = None
+    identities = None
+    for cloud_volume in new_volumes:
+        if tenant_names is None:
+            tenant_names = tenant_id_to_name_map(account_driver)
+            identities = _identities_by_project_name(provider)
+        tenant_id = cloud_volume.extra['object']['os-vol-tenant-attr:tenant_id']
+        tenant_name = tenant_names.get(tenant_id, tenant_id)
+        if tenant_id not in tenant_names:
+            celery_logger.warn("Warning: tenant_id %s found on volume %s, but did not exist from the account driver perspective.", tenant_id, cloud_volume)
+        identity = identities.get(tenant_name)
+        if tenant_id not in tenant_names or not identity:
+            celery_logger.info("Skipping Volume %s - No Identity for: Provider:%s + Project Name:%s" % (cloud_volume.id, provider, tenant_name))
+            continue
+        core_volume = convert_esh_volume(
+            cloud_volume,
+            provider.uuid, identity.uuid,
+            identity.created_by)
+        seen_volumes.append(core_volume)
 
     now_time = timezone.now()
-    needs_end_date = [volume for volume in db_volumes if volume not in seen_volumes]
-    for volume in needs_end_date:
-        celery_logger.debug("End dating inactive volume: %s" % volume)
-        volume.end_date = now_time
-        volume.save()
+    seen_ids = set(volume.id for volume in seen_volumes)
+    needs_end_date = [source_id for volume_id, source_id
+                      in db_volumes.values_list('id', 'instance_source_id')
+                      if volume_id not in seen_ids]
+    if needs_end_date:
+        celery_logger.debug("End dating %s inactive volumes" % len(needs_end_date))
+        InstanceSource.objects.filter(id__in=needs_end_date).update(end_date=now_time)
+    _reconcile_quota_usage(provider, 'volumes')
 
     if print_logs:
         _exit_stdout_logging(console_handler)
@@ -728,6 +763,75 @@ def monitor_volumes_for(provider_id, print_logs=False):
         vol.esh = None
     return seen_volumes
 
+def _reconcile_quota_usage(provider, resource):
+    """
+    Reconcile the QuotaUsageLedger of every identity on provider with its
+    'instances' or 'volumes', as just synced with the cloud.
+    Like the quota checks listing the cloud, usage is counted per project:
+    identities sharing an 'ex_project_name' share their usage.
+    Differences are logged as drift.
+    """
+    identity_usage = {}
+    if resource == 'instances':
+        usage = InstanceStatusHistory.objects.filter(
+            end_date=None, instance__end_date=None,
+            instance__source__provider=provider
+        ).values('instance__created_by_identity').annotate(
+            cpu=Sum('size__cpu'), mem=Sum('size__mem'),
+            instance_count=Count('instance', distinct=True))
+        for row in usage:
+            identity_usage[row['instance__created_by_identity']] = {
+                'cpu': row['cpu'],
+                'memory': row['mem'] / 1024.0,
+                'instance_count': row['instance_count']}
+    else:
+        usage = Volume.objects.filter(
+            only_current_source(), instance_source__provider=provider
+        ).values('instance_source__created_by_identity').annotate(
+            storage=Sum('size'), storage_count=Count('id'))
+        for row in usage:
+            identity_usage[row['instance_source__created_by_identity']] = {
+                'storage': row['storage'],
+                'storage_count': row['storage_count']}
+    project_names = dict(Credential.objects.filter(
+        key='ex_project_name', identity__provider=provider
+    ).values_list('identity_id', 'value'))
+
+    def project_of(identity_id):
+        return ('project', project_names[identity_id]) if identity_id in project_names\
+            else ('identity', identity_id)
+    project_usage = {}
+    for identity_id, usage in identity_usage.items():
+        totals = project_usage.setdefault(project_of(identity_id), {})
+        for field, value in usage.items():
+            totals[field] = totals.get(field, 0) + value
+    identities = list(Identity.objects.filter(provider=provider))
+    cloud_usage = dict((identity.id, project_usage.get(project_of(identity.id), {}))
+                       for identity in identities)
+    drift = QuotaUsageLedger.reconcile(resource, cloud_usage, identities)
+    if drift:
+        identity_names = dict((identity.id, str(identity)) for identity in identities)
+        celery_logger.warn(
+            "Quota usage drift (%s) for %s of %s identities on %s: %s" % (
+                resource, len(drift), len(identities), provider,
+                dict((identity_names[identity_id], differences)
+                     for identity_id, differences in drift.items())))
+    return drift
+
+
+def _identities_by_project_name(provider):
+    """
+    Returns the (first) identity of each 'ex_project_name' on `provider`
+    """
+    identities = {}
+    credentials = Credential.objects.filter(
+        key='ex_project_name', identity__provider=provider
+    ).select_related('identity__created_by').order_by('identity__id')
+    for credential in credentials:
+        identities.setdefault(credential.value, credential.identity)
+    return identities
+
+
 @task(name="monitor_sizes")
 def monitor_sizes():
     """
@@ -738,7 +842,7 @@ def monitor_sizes():
 
 
 @task(name="monitor_sizes_for")
-def monitor_sizes_for(provider_id, print_logs=False):
+def monitor_sizes_for(provider_id, print_logs=False, cloud_sizes=None):
     """
     Run the set of tasks related to monitoring sizes for a provider.
     Optionally, provide a list of usernames to monitor
@@ -754,18 +858,17 @@ def monitor_sizes_for(provider_id, print_logs=False):
     admin_driver = get_admin_driver(provider)
     # Non-End dated sizes on this provider
     db_sizes = Size.objects.filter(only_current(), provider=provider)
-    all_sizes = admin_driver.list_sizes()
+    all_sizes = admin_driver.list_sizes() if cloud_sizes is None else cloud_sizes
     seen_sizes = []
     for cloud_size in all_sizes:
         core_size = convert_esh_size(cloud_size, provider.uuid)
         seen_sizes.append(core_size)
 
     now_time = timezone.now()
-    needs_end_date = [size for size in db_sizes if size not in seen_sizes]
-    for size in needs_end_date:
-        celery_logger.debug("End dating inactive size: %s" % size)
-        size.end_date = now_time
-        size.save()
+    seen_ids = set(size.id for size in seen_sizes)
+    end_dated = db_sizes.exclude(id__in=seen_ids).update(end_date=now_time)
+    if end_dated:
+        celery_logger.debug("End dated %s inactive sizes" % end_dated)
 
     # Find home for 'Unknown Size'
     unknown_sizes = Size.objects.filter(provider=provider, name__contains='Unknown Size')
@@ -6,7 +6,7 @@ from celery.exceptions import SoftTimeLimitExceeded
 
 from threepio import logger
 
-from core.models import Identity
+from core.models import Identity, QuotaUsageLedger
 from core.models.volume import convert_esh_volume
 
 from service.cache import get_cached_driver
@@ -101,6 +101,7 @@ def create_volume_from_image(identity_uuid, image_id, size_id, name,
 
         if not success:
             raise Exception("Could not create volume from image")
+        QuotaUsageLedger.adjust(identity, storage=esh_volume.size, storage_count=1)
 
         # Save the new volume to the database
         convert_esh_volume(
@@ -142,6 +143,7 @@ def create_volume_from_snapshot(identity_uuid, snapshot_id, size_id, name,
 
         if not success:
             raise Exception("Could not create volume from snapshot")
+        QuotaUsageLedger.adjust(identity, storage=esh_volume.size, storage_count=1)
 
         # Save the new volume to the database
         convert_esh_volume(
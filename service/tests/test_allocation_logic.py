@@ -0,0 +1,260 @@
+import os
+import time
+import uuid
+from datetime import timedelta
+from unittest import skipUnless
+
+import freezegun
+from dateutil.parser import parse
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from api.tests.factories import (
+    UserFactory, IdentityFactory, ProviderFactory, ProviderMachineFactory,
+    InstanceFactory, InstanceHistoryFactory, InstanceStatusFactory, SizeFactory,
+    AllocationSourceFactory)
+from core.models import EventTable, Instance, UserAllocationCheckpoint
+from core.models.allocation_source import total_usage
+from core.models.instance_history import InstanceStatusHistory
+from service.allocation_logic import allocation_usage, create_report
+
+BENCHMARK_HISTORY_COUNT = int(os.environ.get('ATMO_BENCHMARK_HISTORIES', 100000))
+
+
+def _comparable(rows):
+    """
+    `burn_rate` is a running total whose per-row value depends on the
+    (unordered) instance iteration, so it is compared separately.
+    """
+    return sorted(
+        (sorted((key, value) for key, value in row.items() if key != 'burn_rate')
+         for row in rows))
+
+
+class AllocationReportTestCase(TestCase):
+    def setUp(self):
+        self.report_start = parse('2017-01-01T00:00:00+00:00')
+        self.report_end = parse('2017-02-01T00:00:00+00:00')
+        self.user = UserFactory.create(username='test-username')
+        self.other_user = UserFactory.create(username='other-username')
+        self.provider = ProviderFactory.create()
+        self.identity = IdentityFactory.create_identity(created_by=self.user, provider=self.provider)
+        self.other_identity = IdentityFactory.create_identity(created_by=self.other_user, provider=self.provider)
+        self.machine = ProviderMachineFactory.create_provider_machine(self.user, self.identity)
+        self.active = InstanceStatusFactory.create(name='active')
+        self.suspended = InstanceStatusFactory.create(name='suspended')
+        self.small = SizeFactory.create(provider=self.provider, cpu=1, mem=2, disk=10)
+        self.large = SizeFactory.create(provider=self.provider, cpu=4, mem=8, disk=40)
+        self.source_a = AllocationSourceFactory.create(name='TG-A', compute_allowed=1000)
+        self.source_b = AllocationSourceFactory.create(name='TG-B', compute_allowed=1000)
+
+        # Started before the report, moved to another allocation source during it, still running
+        self.long_running = self._create_instance(self.user, self.identity, '2016-12-15T00:00:00+00:00')
+        self._create_history(self.long_running, self.active, self.small,
+                             '2016-12-15T00:00:00+00:00', '2017-01-05T00:00:00+00:00')
+        self._create_history(self.long_running, self.suspended, self.small,
+                             '2017-01-05T00:00:00+00:00', '2017-01-10T00:00:00+00:00')
+        self._create_history(self.long_running, self.active, self.large,
+                             '2017-01-10T00:00:00+00:00', None)
+        self._create_event(self.user, self.long_running, self.source_a, '2016-12-15T00:00:00+00:00')
+        self._create_event(self.user, self.long_running, self.source_b, '2017-01-20T00:00:00+00:00')
+
+        # Started and ended inside the report without any allocation source
+        self.short_lived = self._create_instance(self.user, self.identity, '2017-01-03T00:00:00+00:00')
+        self._create_history(self.short_lived, self.active, self.small,
+                             '2017-01-03T00:00:00+00:00', '2017-01-04T12:00:00+00:00')
+
+        # Another user's instance, assigned after it started
+        self.other_instance = self._create_instance(self.other_user, self.other_identity, '2017-01-02T00:00:00+00:00')
+        self._create_history(self.other_instance, self.active, self.large,
+                             '2017-01-02T00:00:00+00:00', None)
+        self._create_event(self.other_user, self.other_instance, self.source_a, '2017-01-02T06:00:00+00:00')
+
+        # Ended before the report
+        self.old_instance = self._create_instance(self.user, self.identity, '2016-11-01T00:00:00+00:00')
+        self._create_history(self.old_instance, self.active, self.small,
+                             '2016-11-01T00:00:00+00:00', '2016-11-02T00:00:00+00:00')
+
+    def _create_instance(self, user, identity, start_date):
+        return InstanceFactory.create(
+            provider_alias=str(uuid.uuid4()),
+            source=self.machine.instance_source,
+            created_by=user,
+            created_by_identity=identity,
+            start_date=parse(start_date))
+
+    def _create_history(self, instance, status, size, start_date, end_date):
+        return InstanceHistoryFactory.create(
+            instance=instance,
+            status=status,
+            size=size,
+            start_date=parse(start_date),
+            end_date=parse(end_date) if end_date else None)
+
+    def _create_event(self, user, instance, allocation_source, timestamp):
+        return EventTable.objects.create(
+            name='instance_allocation_source_changed',
+            entity_id=user.username,
+            payload={'instance_id': instance.provider_alias,
+                     'allocation_source_name': allocation_source.name},
+            timestamp=parse(timestamp))
+
+
+class AllocationReportEngineTest(AllocationReportTestCase):
+    def _assert_engines_match(self, **kwargs):
+        with freezegun.freeze_time('2017-02-15T00:00:00Z'):
+            legacy = create_report(self.report_start, self.report_end, engine='legacy', **kwargs)
+            bulk = create_report(self.report_start, self.report_end, engine='bulk', **kwargs)
+        self.assertTrue(legacy)
+        self.assertEqual(_comparable(legacy), _comparable(bulk))
+        self.assertEqual(max(row['burn_rate'] for row in legacy),
+                         max(row['burn_rate'] for row in bulk))
+        return bulk
+
+    def test_engines_match_for_all_users(self):
+        rows = self._assert_engines_match()
+        self.assertEqual(len(rows), 7)
+
+    def test_engines_match_for_user(self):
+        rows = self._assert_engines_match(user_id=self.user.username)
+        self.assertEqual(set(row['username'] for row in rows), {self.user.username})
+
+    def test_engines_match_for_allocation_source(self):
+        rows = self._assert_engines_match(user_id=self.user.username, allocation_source_name='TG-B')
+        self.assertEqual(len(rows), 1)
+        # 4 CPUs from the event on 2017-01-20 until the end of the report
+        self.assertEqual(rows[0]['applicable_duration'], 12 * 24 * 3600 * 4)
+
+    def test_bulk_engine_query_count_is_constant(self):
+        with CaptureQueriesContext(connection) as small_report:
+            create_report(self.report_start, self.report_end, engine='bulk')
+        for _ in range(5):
+            instance = self._create_instance(self.user, self.identity, '2017-01-06T00:00:00+00:00')
+            self._create_history(instance, self.active, self.small,
+                                 '2017-01-06T00:00:00+00:00', '2017-01-07T00:00:00+00:00')
+            self._create_event(self.user, instance, self.source_a, '2017-01-06T00:00:00+00:00')
+        with CaptureQueriesContext(connection) as large_report:
+            create_report(self.report_start, self.report_end, engine='bulk')
+        self.assertEqual(len(small_report.captured_queries), len(large_report.captured_queries))
+
+
+class AllocationUsageTest(AllocationReportTestCase):
+    @freezegun.freeze_time('2017-02-15T00:00:00Z')
+    def test_usage_matches_total_usage_of_each_pair(self):
+        start_dates = {
+            (self.user.username, 'TG-A'): self.report_start,
+            (self.user.username, 'TG-B'): parse('2017-01-22T00:00:00+00:00'),
+            (self.other_user.username, 'TG-A'): parse('2017-01-10T00:00:00+00:00'),
+            (self.other_user.username, 'TG-B'): self.report_start,
+        }
+        with CaptureQueriesContext(connection) as queries:
+            usage = allocation_usage(start_dates, self.report_end)
+        for (username, source_name), start_date in start_dates.items():
+            self.assertEqual(
+                usage[(username, source_name)],
+                total_usage(username, start_date, allocation_source_name=source_name, end_date=self.report_end))
+        self.assertEqual(usage[(self.other_user.username, 'TG-B')], 0)
+        self.assertLessEqual(len(queries.captured_queries), 5)
+
+
+@override_settings(ALLOCATION_CHECKPOINT_DELAY=timedelta(hours=1))
+@freezegun.freeze_time('2017-02-15T00:00:00Z')
+class UserAllocationCheckpointTest(AllocationReportTestCase):
+    def _usage(self, end_date, **kwargs):
+        return UserAllocationCheckpoint.usage(self.user, self.source_b, self.report_start, parse(end_date), **kwargs)
+
+    def _total_usage(self, end_date):
+        return total_usage(self.user.username, self.report_start, allocation_source_name=self.source_b.name,
+                           end_date=parse(end_date), burn_rate=True)
+
+    def test_incremental_usage_matches_total_usage(self):
+        for end_date in ['2017-01-21T00:00:00+00:00',
+                         '2017-01-25T12:30:00+00:00',
+                         '2017-01-25T13:00:00+00:00',
+                         '2017-02-01T00:00:00+00:00']:
+            self.assertEqual(self._usage(end_date), self._total_usage(end_date))
+        checkpoint = UserAllocationCheckpoint.objects.get(user=self.user, allocation_source=self.source_b)
+        self.assertEqual(checkpoint.last_processed, parse('2017-01-31T23:00:00+00:00'))
+        self.assertTrue(checkpoint.is_consistent())
+
+    def test_checkpoint_is_rebuilt_when_allocation_is_renewed(self):
+        self._usage('2017-01-25T00:00:00+00:00')
+        renewal_date = parse('2017-01-22T00:00:00+00:00')
+        UserAllocationCheckpoint.usage(self.user, self.source_b, renewal_date, parse('2017-01-25T00:00:00+00:00'))
+        checkpoint = UserAllocationCheckpoint.objects.get(user=self.user, allocation_source=self.source_b)
+        self.assertEqual(checkpoint.start_date, renewal_date)
+        # 4 CPUs for 3 days, less the (unsettled) last hour
+        self.assertEqual(checkpoint.compute_used_seconds, (3 * 24 - 1) * 3600 * 4)
+
+    def test_inconsistent_checkpoint_is_detected(self):
+        self._usage('2017-01-25T00:00:00+00:00')
+        checkpoint = UserAllocationCheckpoint.objects.get(user=self.user, allocation_source=self.source_b)
+        checkpoint.compute_used_seconds += 3600
+        checkpoint.save()
+        self.assertFalse(checkpoint.is_consistent())
+        self.assertEqual(self._usage('2017-01-26T00:00:00+00:00', rebuild=True),
+                         self._total_usage('2017-01-26T00:00:00+00:00'))
+
+
+@skipUnless(os.environ.get('ATMO_BENCHMARK'), 'Set ATMO_BENCHMARK=1 to run allocation report benchmarks')
+class AllocationReportEngineBenchmark(TestCase):
+    """
+    Compare both report engines over a synthetic fixture of
+    `BENCHMARK_HISTORY_COUNT` status histories (5 per instance).
+    """
+    histories_per_instance = 5
+
+    def setUp(self):
+        self.report_start = parse('2017-01-01T00:00:00+00:00')
+        self.report_end = parse('2017-02-01T00:00:00+00:00')
+        provider = ProviderFactory.create()
+        users = [UserFactory.create() for _ in range(100)]
+        identity = IdentityFactory.create_identity(created_by=users[0], provider=provider)
+        machine = ProviderMachineFactory.create_provider_machine(users[0], identity)
+        statuses = [InstanceStatusFactory.create(name='active'), InstanceStatusFactory.create(name='suspended')]
+        size = SizeFactory.create(provider=provider, cpu=2)
+        allocation_source = AllocationSourceFactory.create(name='TG-BENCHMARK', compute_allowed=1000)
+
+        instance_count = BENCHMARK_HISTORY_COUNT // self.histories_per_instance
+        Instance.objects.bulk_create([
+            Instance(name='benchmark-%d' % index,
+                     provider_alias='benchmark-%d' % index,
+                     source=machine.instance_source,
+                     created_by=users[index % len(users)],
+                     start_date=self.report_start - timedelta(days=1) + timedelta(minutes=index))
+            for index in xrange(instance_count)], batch_size=5000)
+        histories = []
+        events = []
+        for instance in Instance.objects.filter(name__startswith='benchmark-').select_related('created_by'):
+            start_date = instance.start_date
+            for index in xrange(self.histories_per_instance):
+                end_date = start_date + timedelta(days=2)
+                histories.append(InstanceStatusHistory(
+                    instance=instance, size=size, status=statuses[index % 2],
+                    start_date=start_date,
+                    end_date=end_date if index < self.histories_per_instance - 1 else None))
+                start_date = end_date
+            events.append(EventTable(
+                name='instance_allocation_source_changed',
+                entity_id=instance.created_by.username,
+                payload={'instance_id': instance.provider_alias,
+                         'allocation_source_name': allocation_source.name},
+                timestamp=instance.start_date))
+        InstanceStatusHistory.objects.bulk_create(histories, batch_size=5000)
+        EventTable.objects.bulk_create(events, batch_size=5000)
+
+    def _time_engine(self, engine):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            rows = create_report(self.report_start, self.report_end, engine=engine)
+            elapsed = time.time() - start
+        print "%s engine: %s rows, %s queries, %.2fs" % (
+            engine, len(rows), len(queries.captured_queries), elapsed)
+        return rows
+
+    def test_benchmark_report_engines(self):
+        with freezegun.freeze_time('2017-02-15T00:00:00Z'):
+            bulk = self._time_engine('bulk')
+            legacy = self._time_engine('legacy')
+        self.assertEqual(_comparable(legacy), _comparable(bulk))
@@ -0,0 +1,193 @@
+import cPickle as pickle
+import threading
+import time
+from datetime import timedelta
+
+import mock
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from api.tests.factories import ProviderFactory
+from core.models.instance import _esh_instance_size_to_core
+from service import cache, cache_schema
+from service.mock import MockInstance
+
+
+class FakeRedis(object):
+    """
+    The subset of redis.StrictRedis used by service.cache
+    """
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        with self.lock:
+            if nx and key in self.values:
+                return None
+            self.values[key] = value
+            self.expires[key] = ex
+            return True
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.values.pop(key, None)
+
+    def hincrby(self, key, field, amount=1):
+        with self.lock:
+            counts = self.hashes.setdefault(key, {})
+            counts[field] = counts.get(field, 0) + amount
+
+    def hgetall(self, key):
+        return self.hashes.get(key, {})
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+
+class CachedListingTest(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(cache, 'redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.size = cache_schema.CachedSize(
+            {'id': 'size-1', 'alias': 'size-1', 'name': 'm1.small',
+             'cpu': 2, 'ram': 4096, 'disk': 20, 'ephemeral': 0}, None)
+        self.instances = [
+            MockInstance(id='instance-%s' % index, ip='10.0.0.%s' % index,
+                         name='Instance %s' % index, size=self.size if index else None,
+                         extra={'status': 'active', 'task': None,
+                                'metadata': {'tmp_status': ''}})
+            for index in range(3)]
+        self.data_method = mock.Mock(return_value=self.instances)
+
+    def _get_cached(self, **kwargs):
+        return cache._get_cached('instances.test', self.data_method, 'instances', None, **kwargs)
+
+    def test_cache_hit_restores_instances(self):
+        self._get_cached()
+        cached_instances = self._get_cached()
+        self.assertEqual(self.data_method.call_count, 1)
+        self.assertEqual([(i.id, i.name, i.ip, i.extra['status']) for i in cached_instances],
+                         [(i.id, i.name, i.ip, i.extra['status']) for i in self.instances])
+        self.assertEqual(cached_instances[0].size.id, 'Unknown')
+        self.assertEqual(
+            [(size.id, size.name, size.cpu, size.ram, size.disk)
+             for size in [cached_instances[1].size, cached_instances[2].size]],
+            [('size-1', 'm1.small', 2, 4096, 20)] * 2)
+
+    def test_cached_sizes_are_not_looked_up_again(self):
+        provider = ProviderFactory.create()
+        self._get_cached()
+        cached_instance = self._get_cached()[1]
+        driver = mock.Mock()
+        core_size = _esh_instance_size_to_core(driver, cached_instance, provider.uuid)
+        self.assertFalse(driver.get_size.called)
+        self.assertEqual((core_size.alias, core_size.cpu, core_size.mem), ('size-1', 2, 4096))
+
+    def test_force_skips_the_cache(self):
+        self._get_cached()
+        self._get_cached(force=True)
+        self.assertEqual(self.data_method.call_count, 2)
+
+    @override_settings(DRIVER_CACHE_TTL={'instances': 120}, DRIVER_CACHE_STALE_TTL=60)
+    def test_ttl_per_resource_type(self):
+        self._get_cached()
+        self.assertEqual(self.redis.expires['instances.test.fresh'], 120)
+        self.assertEqual(self.redis.expires['instances.test'], 180)
+
+    def test_stale_data_is_served_while_refreshing(self):
+        self._get_cached()
+        # Expire the data, then refresh it while another worker reads it
+        self.redis.delete('instances.test.fresh')
+        self.redis.set('instances.test.refresh_lock', 'another-worker')
+        self.assertEqual(len(self._get_cached()), 3)
+        self.assertEqual(self.data_method.call_count, 1)
+        self.assertEqual(cache.get_cache_metrics()['instances']['stale_hits'], 1)
+
+    def _read_concurrently(self, readers=50):
+        def slow_data_method():
+            time.sleep(0.5)
+            return self.instances
+        self.data_method.side_effect = slow_data_method
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self._get_cached()))
+                   for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), readers)
+        self.assertTrue(all(len(result) == 3 for result in results))
+
+    def test_single_refresh_of_expired_data(self):
+        self._get_cached()
+        self.redis.delete('instances.test.fresh')
+        self._read_concurrently()
+        self.assertEqual(self.data_method.call_count, 2)
+
+    def test_single_refresh_of_empty_cache(self):
+        self._read_concurrently()
+        self.assertEqual(self.data_method.call_count, 1)
+
+    def test_other_schema_versions_are_ignored(self):
+        self.redis.set('instances.test', pickle.dumps(self.instances))
+        self._get_cached()
+        with mock.patch.object(cache_schema, 'CACHE_SCHEMA_VERSION', cache_schema.CACHE_SCHEMA_VERSION + 1):
+            self._get_cached()
+        self.assertEqual(self.data_method.call_count, 2)
+
+    def test_metrics(self):
+        self._get_cached()
+        self._get_cached()
+        self._get_cached()
+        metrics = cache.get_cache_metrics()['instances']
+        self.assertEqual(metrics['hits'], 2)
+        self.assertEqual(metrics['misses'], 1)
+        self.assertEqual(metrics['writes'], 1)
+        self.assertEqual(metrics['payload_bytes'], len(self.redis.get('instances.test')))
+
+
+class DriverPoolTest(TestCase):
+    def setUp(self):
+        self.pool = cache.DriverPool()
+        self.build_method = mock.Mock(side_effect=lambda: mock.Mock(_connection=None))
+
+    def test_drivers_are_reused(self):
+        driver = self.pool.get('identity-1', self.build_method)
+        self.assertIs(self.pool.get('identity-1', self.build_method), driver)
+        self.assertEqual(self.build_method.call_count, 1)
+        self.assertEqual(self.pool.stats()['hits'], 1)
+        self.assertEqual(self.pool.stats()['misses'], 1)
+
+    def test_force_rebuilds_the_driver(self):
+        driver = self.pool.get('identity-1', self.build_method)
+        self.assertIsNot(self.pool.get('identity-1', self.build_method, force=True), driver)
+
+    @override_settings(DRIVER_POOL_SIZE=2)
+    def test_least_recently_used_drivers_are_evicted(self):
+        self.pool.get('identity-1', self.build_method)
+        self.pool.get('identity-2', self.build_method)
+        self.pool.get('identity-1', self.build_method)
+        self.pool.get('identity-3', self.build_method)
+        self.assertEqual(list(self.pool.drivers.keys()), ['identity-1', 'identity-3'])
+        self.assertEqual(self.pool.stats()['evictions'], 1)
+
+    @override_settings(DRIVER_POOL_EXPIRY_MARGIN=timedelta(minutes=5))
+    def test_drivers_are_rebuilt_before_their_token_expires(self):
+        def build_method():
+            driver = mock.Mock()
+            driver._connection.connection.auth_token_expires = timezone.now() + timedelta(minutes=2)
+            return driver
+        driver = self.pool.get('identity-1', build_method)
+        self.assertIsNot(self.pool.get('identity-1', build_method), driver)
@@ -0,0 +1,195 @@
+import os
+import time
+import uuid
+from unittest import skipUnless
+
+import mock
+from dateutil.parser import parse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api.tests.factories import (
+    UserFactory, IdentityFactory, ProviderFactory, ProviderMachineFactory,
+    InstanceFactory, InstanceHistoryFactory, InstanceStatusFactory, SizeFactory)
+from core.models import Instance, InstanceStatusHistory, Volume
+from core.models.volume import VolumeStatus, VolumeStatusHistory
+from core.models.instance_source import InstanceSource
+from service import monitoring
+from service.mock import MockInstance
+from service.tasks.monitoring import _list_cloud_resources, monitor_volumes_for
+
+BENCHMARK_VOLUME_COUNT = int(os.environ.get('ATMO_BENCHMARK_VOLUMES', 20000))
+
+
+class ReconcileInstancesTest(TestCase):
+    def setUp(self):
+        self.user = UserFactory.create(username='test-username')
+        self.provider = ProviderFactory.create()
+        self.identity = IdentityFactory.create_identity(created_by=self.user, provider=self.provider)
+        self.machine = ProviderMachineFactory.create_provider_machine(self.user, self.identity)
+        self.active = InstanceStatusFactory.create(name='active')
+        self.size = SizeFactory.create(provider=self.provider)
+        self.unchanged = self._create_instance()
+        self.suspended = self._create_instance()
+        self.deleted = self._create_instance()
+        patchers = [
+            mock.patch.object(monitoring, '_get_identity_from_tenant_name', return_value=self.identity),
+            mock.patch.object(monitoring, 'get_cached_driver'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _create_instance(self):
+        instance = InstanceFactory.create(
+            provider_alias=str(uuid.uuid4()),
+            source=self.machine.instance_source,
+            created_by=self.user,
+            created_by_identity=self.identity,
+            ip_address='10.0.0.1',
+            start_date=parse('2017-01-01T00:00:00+00:00'))
+        InstanceHistoryFactory.create(
+            instance=instance, status=self.active, size=self.size,
+            start_date=instance.start_date, end_date=None)
+        return instance
+
+    def _esh_instance(self, instance, status):
+        return MockInstance(id=instance.provider_alias, ip='10.0.0.1',
+                            size=mock.Mock(id=self.size.alias),
+                            extra={'status': status, 'metadata': {}})
+
+    def test_reconcile_instances(self):
+        instance_map = {'test-username': [
+            self._esh_instance(self.unchanged, 'active'),
+            self._esh_instance(self.suspended, 'suspended')]}
+        seen_instances, stats = monitoring._reconcile_instances(self.provider, instance_map)
+
+        self.assertEqual(set(seen_instances), {self.unchanged, self.suspended})
+        self.assertEqual(stats['unchanged'], 1)
+        self.assertEqual(stats['status_changes'], 1)
+        self.assertEqual(stats['end_dated_instances'], 1)
+        self.assertEqual(stats['end_dated_histories'], 1)
+        self.assertEqual(stats['converted'], 0)
+        open_histories = InstanceStatusHistory.objects.filter(end_date=None)
+        self.assertEqual(
+            sorted((history.instance_id, history.status.name) for history in open_histories),
+            sorted([(self.unchanged.id, 'active'), (self.suspended.id, 'suspended')]))
+        self.assertIsNotNone(Instance.objects.get(id=self.deleted.id).end_date)
+
+    def test_failed_tenants_are_not_cleaned_up(self):
+        broken_instance = self._esh_instance(self.unchanged, 'active')
+        broken_instance.size = None
+        with mock.patch.object(monitoring, 'convert_esh_instance', side_effect=Exception("Boom")):
+            _, stats = monitoring._reconcile_instances(
+                self.provider, {'test-username': [broken_instance]})
+        self.assertEqual(stats['failed_tenants'], 1)
+        self.assertEqual(Instance.objects.filter(end_date=None).count(), 3)
+
+
+class ListCloudResourcesTest(TestCase):
+    def test_listings_run_concurrently(self):
+        def slow_listing(result):
+            def listing_method():
+                time.sleep(0.5)
+                return result
+            return listing_method
+        started = time.time()
+        listings, timings = _list_cloud_resources({
+            'sizes': slow_listing(['size']),
+            'volumes': slow_listing(['volume']),
+            'machines': slow_listing(['machine']),
+            'instances': slow_listing({'tenant': []}),
+        })
+        self.assertLess(time.time() - started, 1.5)
+        self.assertEqual(listings['volumes'], ['volume'])
+        self.assertEqual(listings['instances'], {'tenant': []})
+        self.assertEqual(set(timings), {'sizes_listing', 'volumes_listing',
+                                        'machines_listing', 'instances_listing'})
+
+
+class MonitorVolumesTest(TestCase):
+    volume_count = 3
+
+    def setUp(self):
+        self.user = UserFactory.create()
+        self.provider = ProviderFactory.create()
+        self.identity = IdentityFactory.create_identity(created_by=self.user, provider=self.provider)
+        InstanceSource.objects.bulk_create([
+            InstanceSource(identifier='volume-%d' % index, provider=self.provider,
+                           created_by=self.user, created_by_identity=self.identity)
+            for index in xrange(self.volume_count)])
+        Volume.objects.bulk_create([
+            Volume(name=source.identifier, size=1, instance_source=source)
+            for source in InstanceSource.objects.filter(provider=self.provider)])
+        self.volumes = dict((volume.instance_source.identifier, volume) for volume in
+                            Volume.objects.select_related('instance_source'))
+        # Already monitored: the volumes are 'available' since the last run
+        available = VolumeStatus.objects.create(name='available')
+        VolumeStatusHistory.objects.bulk_create([
+            VolumeStatusHistory(volume=volume, status=available)
+            for volume in self.volumes.values()])
+        # Every other volume is still in the cloud
+        self.cloud_volumes = [self._cloud_volume(alias) for alias in sorted(self.volumes)[::2]]
+        account_driver = mock.Mock()
+        account_driver.admin_driver.list_all_volumes.return_value = self.cloud_volumes
+        account_driver.list_projects.return_value = []
+        patcher = mock.patch('service.driver.get_account_driver', return_value=account_driver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _cloud_volume(self, alias):
+        cloud_volume = mock.Mock(id=alias, size=1,
+                                 extra={'status': 'available', 'attachments': [], 'metadata': {}})
+        cloud_volume.name = alias
+        return cloud_volume
+
+    def _end_dated_aliases(self):
+        return set(InstanceSource.objects.filter(
+            provider=self.provider, end_date__isnull=False).values_list('identifier', flat=True))
+
+    def test_missing_volumes_are_end_dated(self):
+        seen_volumes = monitor_volumes_for(self.provider.id)
+        self.assertEqual(set(volume.instance_source.identifier for volume in seen_volumes),
+                         set(volume.id for volume in self.cloud_volumes))
+        self.assertEqual(self._end_dated_aliases(),
+                         set(self.volumes) - set(volume.id for volume in self.cloud_volumes))
+        # The status of the volumes still in the cloud did not change
+        self.assertEqual(VolumeStatusHistory.objects.count(), len(self.volumes))
+
+    def test_changed_volumes_are_updated(self):
+        for cloud_volume in self.cloud_volumes:
+            cloud_volume.extra.update(status='in-use', attachments=[
+                {'serverId': 'instance-%s' % cloud_volume.id, 'device': '/dev/vdb'}])
+        InstanceSource.objects.filter(identifier=self.cloud_volumes[0].id).update(
+            end_date=timezone.now())
+        monitor_volumes_for(self.provider.id)
+        for cloud_volume in self.cloud_volumes:
+            histories = VolumeStatusHistory.objects.filter(
+                volume=self.volumes[cloud_volume.id]).order_by('start_date')
+            self.assertEqual([history.status.name for history in histories], ['available', 'in-use'])
+            self.assertIsNotNone(histories[0].end_date)
+            self.assertIsNone(histories[1].end_date)
+            self.assertEqual((histories[1].device, histories[1].instance_alias),
+                             ('/dev/vdb', 'instance-%s' % cloud_volume.id))
+        self.assertEqual(self._end_dated_aliases(),
+                         set(self.volumes) - set(volume.id for volume in self.cloud_volumes))
+
+
+@skipUnless(os.environ.get('ATMO_BENCHMARK'), 'Set ATMO_BENCHMARK=1 to run monitoring benchmarks')
+class MonitorVolumesBenchmark(MonitorVolumesTest):
+    """
+    End-date half of `BENCHMARK_VOLUME_COUNT` volumes, converting the other
+    half with the real `convert_esh_volume`
+    """
+    volume_count = BENCHMARK_VOLUME_COUNT
+
+    def test_missing_volumes_are_end_dated(self):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.time()
+            monitor_volumes_for(self.provider.id)
+            elapsed = time.time() - started
+        print "monitor_volumes_for: %s volumes, %s queries, %.2fs" % (
+            self.volume_count, len(queries.captured_queries), elapsed)
+        self.assertEqual(len(self._end_dated_aliases()), self.volume_count // 2)
@@ -0,0 +1,34 @@
+import mock
+import redis
+from django.test import SimpleTestCase
+
+from service import cache, pubsub
+
+
+class ChannelListenerTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = mock.Mock()
+        self.subscription = self.redis.pubsub.return_value
+        patcher = mock.patch.object(cache, 'redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.listener = pubsub.ChannelListener('test.changed')
+
+    def test_published_messages_are_drained(self):
+        self.subscription.get_message.side_effect = [{'data': '1'}, {'data': '2'}, None, None]
+        self.assertEqual(self.listener.messages(), ['1', '2'])
+        self.assertEqual(self.listener.messages(), [])
+        self.subscription.subscribe.assert_called_once_with('test.changed')
+
+    def test_forked_process_subscribes_again(self):
+        self.subscription.get_message.return_value = None
+        self.listener.messages()
+        with mock.patch('os.getpid', return_value=-1):
+            self.listener.messages()
+        self.assertEqual(self.subscription.subscribe.call_count, 2)
+
+    def test_redis_unavailable(self):
+        self.redis.pubsub.side_effect = redis.exceptions.ConnectionError
+        self.assertIsNone(self.listener.messages())
+        self.redis.publish.side_effect = redis.exceptions.ConnectionError
+        pubsub.publish('test.changed', 'changed')
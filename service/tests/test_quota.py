@@ -0,0 +1,163 @@
+import time
+import uuid
+
+import mock
+from django.core.exceptions import ValidationError
+from django.test import TestCase, override_settings
+from django.utils.timezone import timedelta
+
+from api.tests.factories import UserFactory, IdentityFactory, ProviderFactory
+from core.models import Credential, QuotaUsageLedger
+from service import instance as instance_service
+from service import quota as service_quota
+
+
+@override_settings(QUOTA_USAGE_LEDGER=False)
+class QuotaUsageTest(TestCase):
+    def setUp(self):
+        self.identity = mock.Mock(uuid=uuid.uuid4())
+        self.quota = mock.Mock(cpu=4, memory=16, instance_count=10,
+                               floating_ip_count=10, port_count=-1)
+        self.driver = mock.Mock()
+        self.driver.provider.identifier = 'test-provider'
+        self.driver.provider.sizeCls.sizes = {'test-provider': ['size']}
+        instance = mock.Mock()
+        instance.size._size.extra = {'cpu': 1}
+        instance.size._size.ram = 2048
+        self.driver.list_instances.side_effect = self._slow_listing([instance])
+        self.driver._connection.ex_list_floating_ips.side_effect = self._slow_listing([])
+        patcher = mock.patch.object(service_quota, 'get_cached_driver', return_value=self.driver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        service_quota.usage_cache.clear()
+        service_quota.quota_metrics.clear()
+
+    def _slow_listing(self, listing):
+        def listing_method():
+            time.sleep(0.3)
+            return listing
+        return listing_method
+
+    def _check(self, cpu=1, memory=2.0, **kwargs):
+        requested = {'cpu': cpu, 'memory': memory, 'instance_count': 1,
+                     'floating_ip_count': 1, 'port_count': 1}
+        return service_quota.check_quota_usage(self.identity, self.quota, requested, **kwargs)
+
+    def test_one_concurrent_snapshot_per_check(self):
+        started = time.time()
+        self.assertTrue(self._check())
+        self.assertLess(time.time() - started, 0.6)
+        self.assertEqual(self.driver.list_instances.call_count, 1)
+        self.assertEqual(self.driver._connection.ex_list_floating_ips.call_count, 1)
+        metrics = service_quota.get_quota_metrics()
+        self.assertEqual(metrics['checks'], 1)
+        self.assertEqual(metrics['cloud_calls'], 2)
+
+    def test_cached_usage_includes_passing_checks(self):
+        self.assertTrue(self._check(cpu=2))
+        # 1 cpu in use + 2 reserved by the previous check
+        with self.assertRaises(ValidationError):
+            self._check(cpu=2)
+        self.assertFalse(self._check(cpu=2, raise_exc=False))
+        self.assertEqual(self.driver.list_instances.call_count, 1)
+        self.assertEqual(service_quota.get_quota_metrics()['cache_hits'], 2)
+
+    @override_settings(QUOTA_USAGE_CACHE_TTL=0)
+    def test_usage_is_listed_again_once_expired(self):
+        self._check()
+        self._check()
+        self.assertEqual(self.driver.list_instances.call_count, 2)
+
+    def test_unlimited_fields_are_not_listed(self):
+        self.quota.cpu = self.quota.memory = self.quota.instance_count = -1
+        self.assertTrue(self._check(cpu=100))
+        self.assertFalse(self.driver.list_instances.called)
+
+
+class QuotaUsageLedgerTest(TestCase):
+    def setUp(self):
+        self.user = UserFactory.create()
+        self.provider = ProviderFactory.create()
+        self.identity = IdentityFactory.create_identity(created_by=self.user, provider=self.provider)
+        self.other_identity = IdentityFactory.create_identity(created_by=self.user, provider=self.provider)
+        self.identities = [self.identity, self.other_identity]
+
+    def test_reconcile_reports_drift(self):
+        cloud_usage = {self.identity.id: {'cpu': 4, 'memory': 8.0, 'instance_count': 2}}
+        self.assertEqual(QuotaUsageLedger.reconcile('instances', cloud_usage, self.identities), {})
+        # Launched, and then deleted outside of atmosphere
+        QuotaUsageLedger.adjust(self.identity, cpu=2, memory=4.0, instance_count=1)
+        drift = QuotaUsageLedger.reconcile('instances', cloud_usage, self.identities)
+        self.assertEqual(drift, {self.identity.id: {'cpu': (6, 4), 'memory': (12.0, 8.0),
+                                                    'instance_count': (3, 2)}})
+        ledger = QuotaUsageLedger.objects.get(identity=self.other_identity)
+        self.assertEqual((ledger.cpu, ledger.instance_count), (0, 0))
+
+    def test_usage_of_reconciled_fields(self):
+        QuotaUsageLedger.reconcile(
+            'instances', {self.identity.id: {'cpu': 4, 'memory': 8.0, 'instance_count': 2}},
+            self.identities)
+        self.assertEqual(
+            QuotaUsageLedger.usage_for(self.identity, ['cpu', 'storage', 'port_count'], timedelta(hours=1)),
+            {'cpu': 4})
+        self.assertEqual(
+            QuotaUsageLedger.usage_for(self.identity, ['cpu'], timedelta(0)), {})
+
+    def test_quota_checks_use_the_ledger(self):
+        QuotaUsageLedger.reconcile(
+            'instances', {self.identity.id: {'cpu': 4, 'memory': 8.0, 'instance_count': 2}},
+            self.identities)
+        quota = mock.Mock(cpu=5, memory=16, instance_count=10)
+        with mock.patch.object(service_quota, 'get_quota_usage') as get_quota_usage:
+            self.assertTrue(service_quota.check_quota_usage(
+                self.identity, quota, {'cpu': 1, 'memory': 2.0, 'instance_count': 1}))
+            with self.assertRaises(ValidationError):
+                service_quota.check_quota_usage(self.identity, quota, {'cpu': 2})
+        self.assertFalse(get_quota_usage.called)
+
+    def _reconcile(self, cpu=2, memory=4.0, storage=10):
+        QuotaUsageLedger.reconcile(
+            'instances', {self.identity.id: {'cpu': cpu, 'memory': memory, 'instance_count': 1}},
+            self.identities)
+        QuotaUsageLedger.reconcile(
+            'volumes', {self.identity.id: {'storage': storage, 'storage_count': 1}},
+            self.identities)
+
+    def test_identities_of_a_project_share_their_usage(self):
+        for identity in self.identities:
+            Credential.objects.create(key='ex_project_name', value='project', identity=identity)
+        self._reconcile()
+        QuotaUsageLedger.adjust(self.identity, cpu=2, instance_count=1)
+        ledger = QuotaUsageLedger.objects.get(identity=self.other_identity)
+        self.assertEqual((ledger.cpu, ledger.instance_count), (2, 1))
+
+    def test_resize_counts_the_new_size(self):
+        self._reconcile()
+        core_instance = mock.Mock(created_by_identity=self.identity)
+        core_instance.get_last_history.return_value.size = mock.Mock(cpu=2, mem=4096)
+        with mock.patch.object(instance_service, '_permission_to_act'), \
+                mock.patch.object(instance_service, 'resize_and_redeploy'), \
+                mock.patch.object(instance_service, 'update_status'), \
+                mock.patch.object(instance_service, 'find_instance', return_value=core_instance), \
+                mock.patch.object(instance_service, 'convert_esh_size',
+                                  return_value=mock.Mock(cpu=4, mem=8192)):
+            instance_service.resize_instance(
+                mock.Mock(), mock.Mock(), 'large', self.provider.uuid, self.identity.uuid, self.user)
+        ledger = QuotaUsageLedger.objects.get(identity=self.identity)
+        self.assertEqual((ledger.cpu, ledger.memory, ledger.instance_count), (4, 8.0, 1))
+
+    def test_v1_volume_delete_releases_the_storage(self):
+        from api.v1.views import volume as volume_views
+        self._reconcile()
+        driver = mock.Mock()
+        driver.get_volume.return_value = mock.Mock(size=10)
+        driver.destroy_volume.return_value = True
+        core_volume = mock.Mock()
+        core_volume.instance_source.created_by_identity = self.identity
+        with mock.patch.object(volume_views, 'prepare_driver', return_value=driver), \
+                mock.patch.object(volume_views, 'convert_esh_volume', return_value=core_volume), \
+                mock.patch.object(volume_views, 'VolumeSerializer'):
+            volume_views.Volume().delete(
+                mock.Mock(user=self.user), self.provider.uuid, self.identity.uuid, 'volume-id')
+        ledger = QuotaUsageLedger.objects.get(identity=self.identity)
+        self.assertEqual((ledger.storage, ledger.storage_count), (0, 0))
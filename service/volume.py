@@ -1,9 +1,8 @@
 from threepio import logger
 
 from django.core.exceptions import ValidationError
-from core.models.quota import get_quota, has_storage_count_quota,\
-    has_storage_quota
 from core.models.identity import Identity
+from core.models.quota import QuotaUsageLedger
 from core.models.volume import Volume
 from core.models.instance_source import InstanceSource
 
@@ -138,15 +137,12 @@ def create_snapshot(esh_driver, username, identity_uuid, name,
 def create_esh_volume(esh_driver, username, identity_uuid, name, size,
                   description=None, metadata=None, snapshot=None, image=None,
                   raise_exception=False):
-    quota = get_quota(identity_uuid)
+    # Checks the storage size *and* the number of volumes
     try:
         check_over_storage_quota(username, identity_uuid, new_volume_size=size)
     except ValidationError as over_quota:
         raise exceptions.OverQuotaError(
             message=over_quota.message)
-    if not has_storage_count_quota(esh_driver, quota, 1):
-        raise exceptions.OverQuotaError(
-            message="Maximum # of Storage Volumes Exceeded")
     # NOTE: Calling non-standard create_volume_obj so we know the ID
     # of newly created volume. Libcloud just returns 'True'... --Steve
     conn_kwargs = {'max_attempts': 1}
@@ -160,6 +156,9 @@ def create_esh_volume(esh_driver, username, identity_uuid, name, size,
 
     if not success and raise_exception:
         raise exceptions.VolumeError("The volume failed to be created.")
+    if success:
+        QuotaUsageLedger.adjust(
+            Identity.objects.get(uuid=identity_uuid), storage=size, storage_count=1)
 
     return success, esh_volume
 
@@ -192,6 +191,7 @@ def destroy_volume_or_fail(volume, user, cascade=False):
     # destroy the volume successfully or raise an exception
     if not driver.destroy_volume(esh_volume):
         raise Exception("Encountered an error destroying the volume.")
+    QuotaUsageLedger.adjust(identity, storage=-esh_volume.size, storage_count=-1)
 
 
 def create_bootable_volume(